@@ -1,72 +1,695 @@
 import socket
 import threading
+import argparse
+import array
 import json
+import os
+import queue
+import re
 import requests
 import time
+from collections import OrderedDict
+from protocol import FRAME_TEXT, read_frames, send_json
 
-def ask_ai(prompt, model="qwen3:4b"):
+OLLAMA_URL = "http://localhost:11434" # Endereco da API do Ollama
+HTTP_POOL_SIZE = 4                    # Conexoes keep-alive mantidas com o Ollama
+HEALTH_TTL = 30                       # Segundos em que um "Ollama no ar" e reaproveitado
+HEALTH_RETRY = 5                      # Com o Ollama fora do ar, intervalo minimo entre novas verificacoes
+OLLAMA_TIMEOUT = (5, 30)              # (conexao, segundos sem receber nenhum token)
+STREAM_FLUSH_SECONDS = 1.5            # Intervalo maximo entre trechos da resposta enviados ao chat
+STREAM_MIN_CHARS = 40                 # Tamanho minimo de um trecho enviado ao fim de uma frase
+CACHE_MAX_ENTRIES = 500               # Respostas guardadas no cache
+CACHE_MAX_BYTES = 4 * 1024 * 1024     # Memoria maxima das respostas em cache (4MB)
+CACHE_TTL = 24 * 60 * 60              # Validade de uma resposta em cache (24h)
+CACHE_SAVE_INTERVAL = 5.0             # Segundos entre gravacoes do cache em disco (apenas se mudou)
+SESSION_MAX_TOKENS = 4096             # Janela de contexto guardada por usuario (tokens mais recentes)
+SESSION_IDLE_TIMEOUT = 15 * 60        # Conversas paradas ha mais tempo que isso sao esquecidas
+SESSION_MAX_TOTAL_TOKENS = 1_000_000  # Limite somado de tokens de todas as conversas (~4MB)
+CONVERSATION_COMMANDS = ("/conversa", "/nova") # Mensagens que iniciam uma conversa (com contexto) com o ChatBot
+RESET_COMMANDS = ("/reset", "/fim")   # Mensagens que encerram a conversa (perguntas voltam a ser avulsas)
+AI_WORKERS = 2                        # Prompts processados ao mesmo tempo pelo ChatBot
+AI_QUEUE_LIMIT = 20                   # Prompts aguardando na fila antes de recusar novos
+
+def create_session(pool_size=HTTP_POOL_SIZE):
     """
-    Envia prompt para o Ollama e retorna a resposta da IA
+    Cria a sessao HTTP compartilhada com o Ollama
     
     Args:
-        prompt (str): Texto/pergunta para enviar ao modelo de IA
-        model (str): Nome do modelo Ollama a ser usado (padrao: qwen3:4b)
+        pool_size (int): Quantidade maxima de conexoes keep-alive reaproveitadas
     
     Returns:
-        str: Resposta da IA ou mensagem de erro
+        requests.Session: Sessao com pool de conexoes (sem novo handshake TCP por requisicao)
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class HealthCheck:
+    """
+    Estado de saude do Ollama guardado em cache
     
-    Processo:
-        1. Testa se Ollama esta rodando
-        2. Envia requisicao POST com o prompt
-        3. Retorna resposta ou mensagem de erro apropriada
+    Funcionalidades:
+        - A primeira consulta verifica /api/tags de forma sincrona
+        - Com o Ollama no ar, o resultado vale por HEALTH_TTL segundos; depois
+          disso e renovado em segundo plano, sem atrasar o prompt atual
+        - Com o Ollama fora do ar, uma nova verificacao sincrona e feita no
+          maximo a cada HEALTH_RETRY segundos
+        - report() registra o resultado das proprias requisicoes de geracao:
+          uma resposta HTTP prova que o Ollama esta no ar, uma falha de conexao
+          marca como fora do ar
     """
-    try:
-        print(f"🤖 Enviando prompt para Ollama: {prompt[:50]}...")
-        
-        # Testar se Ollama esta rodando verificando endpoint de saude
-        health_response = requests.get('http://localhost:11434/api/tags', timeout=5)
-        if health_response.status_code != 200:
-            return "❌ Ollama não está rodando. Execute 'ollama serve' primeiro."
+    def __init__(self, session, url=OLLAMA_URL, ttl=HEALTH_TTL, retry=HEALTH_RETRY):
+        self.session = session
+        self.url = url
+        self.ttl = ttl
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.healthy = None    # None = ainda nao verificado
+        self.checked_at = 0.0  # time.monotonic() da ultima verificacao
+        self.refreshing = False
+
+    def refresh(self):
+        """
+        Verifica o endpoint de saude agora
         
-        # Enviar o prompt para geracao
-        response = requests.post('http://localhost:11434/api/generate',
-                               json={
-                                   'model': model, # Modelo a ser usado
-                                   'prompt': prompt, # Texto de entrada
-                                   'stream': False # Resposta completa (nao streaming)
-                               },
-                               timeout=30)  # 30 second timeout
+        Returns:
+            bool: True se o Ollama respondeu com status 200
+        """
+        try:
+            healthy = self.session.get(f"{self.url}/api/tags", timeout=5).status_code == 200
+        except requests.exceptions.RequestException:
+            healthy = False
+        self.report(healthy)
+        return healthy
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def report(self, healthy):
+        """
+        Registra o estado do Ollama
         
-        print(f"📡 Status da resposta Ollama: {response.status_code}")
+        Args:
+            healthy (bool): True se o Ollama respondeu, False se a conexao falhou
+        """
+        with self.lock:
+            self.healthy = healthy
+            self.checked_at = time.monotonic()
+
+    def is_healthy(self):
+        """
+        Estado do Ollama, verificando apenas quando o cache expirou
         
-        # Processar resposta baseada no status HTTP
-        if response.status_code == 200:
-            # Sucesso - extrair resposta do JSON
-            result = response.json()
-            ai_response = result.get('response', 'Resposta vazia do modelo')
-            print(f"✅ Resposta recebida: {ai_response[:100]}...")
-            return ai_response
-        elif response.status_code == 404:
-            # Modelo nao encontrado
-            return f"❌ Modelo '{model}' não encontrado. Verifique se está instalado com 'ollama list'"
-        else:
-            # Outros erros HTTP
-            print(f"❌ Erro HTTP {response.status_code}: {response.text}")
-            return f"❌ Erro HTTP {response.status_code} ao comunicar com Ollama"
-            
+        Returns:
+            bool: True se o Ollama esta (ou estava ha pouco) respondendo
+        """
+        with self.lock:
+            healthy = self.healthy
+            age = time.monotonic() - self.checked_at
+            start_background = healthy and age >= self.ttl and not self.refreshing
+            if start_background:
+                self.refreshing = True
+
+        if healthy is None or (not healthy and age >= self.retry):
+            return self.refresh()
+        if start_background:
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return healthy
+
+# Sessao e estado de saude compartilhados por todas as chamadas a ask_ai
+ollama_session = create_session()
+ollama_health = HealthCheck(ollama_session)
+
+class AIError(Exception):
+    """Falha ao consultar o Ollama; a mensagem ja esta pronta para ser mostrada ao usuario"""
+
+class ReplyBatcher:
+    """
+    Agrupa os tokens recebidos do Ollama em trechos para o chat
+    
+    Funcionalidades:
+        - Envia um trecho ao fim de cada frase (. ! ? ou quebra de linha) que
+          tenha pelo menos min_chars caracteres
+        - Se nenhuma frase terminar, envia o que tiver acumulado a cada
+          `window` segundos (cortando no ultimo espaco)
+        - flush() envia o restante ao fim da geracao
+    
+    Args:
+        emit (callable): Funcao chamada com cada trecho pronto
+        window (float): Intervalo maximo (segundos) entre trechos
+        min_chars (int): Tamanho minimo de um trecho enviado no fim de uma frase
+    """
+    SENTENCE_END = re.compile(r"[.!?](?=\s)|\n")
+
+    def __init__(self, emit, window=STREAM_FLUSH_SECONDS, min_chars=STREAM_MIN_CHARS):
+        self.emit = emit
+        self.window = window
+        self.min_chars = min_chars
+        self.buffer = ""
+        self.last_emit = time.monotonic()
+
+    def add(self, text):
+        """Acrescenta tokens e envia um trecho se uma frase terminou ou a janela passou"""
+        self.buffer += text
+        cut = 0
+        for match in self.SENTENCE_END.finditer(self.buffer):
+            if match.end() >= self.min_chars:
+                cut = match.end()
+        if not cut and time.monotonic() - self.last_emit >= self.window:
+            cut = self.buffer.rfind(" ") + 1
+        if cut:
+            self._emit(self.buffer[:cut])
+            self.buffer = self.buffer[cut:]
+
+    def flush(self):
+        """Envia o que restou no buffer"""
+        self._emit(self.buffer)
+        self.buffer = ""
+
+    def _emit(self, text):
+        text = text.strip()
+        if text:
+            self.emit(text)
+        self.last_emit = time.monotonic()
+
+def generate(prompt, model="qwen3:4b", on_text=None, context=None):
+    """
+    Gera a resposta do Ollama em streaming
+    
+    Args:
+        prompt (str): Texto/pergunta para enviar ao modelo de IA
+        model (str): Nome do modelo Ollama a ser usado
+        on_text (callable, optional): Chamada com cada pedaco de texto assim que chega
+        context (list, optional): Tokens de contexto devolvidos pela geracao anterior;
+            o Ollama continua a conversa sem reprocessar o texto anterior
+    
+    Returns:
+        tuple: (resposta completa, ultimo objeto JSON do Ollama com as estatisticas)
+    
+    Raises:
+        AIError: Ollama fora do ar, modelo inexistente, timeout ou erro HTTP
+    """
+    # Testar se Ollama esta rodando (resultado em cache, ver HealthCheck)
+    if not ollama_health.is_healthy():
+        raise AIError("❌ Ollama não está rodando. Execute 'ollama serve' primeiro.")
+
+    request = {
+        'model': model, # Modelo a ser usado
+        'prompt': prompt, # Texto de entrada
+        'stream': True # Tokens enviados conforme sao gerados
+    }
+    if context:
+        request['context'] = list(context) # Estado da conversa (apenas os tokens novos sao processados)
+
+    try:
+        # Enviar o prompt para geracao; os tokens chegam em linhas JSON
+        with ollama_session.post(f'{OLLAMA_URL}/api/generate',
+                                 json=request,
+                                 stream=True,
+                                 timeout=OLLAMA_TIMEOUT) as response:
+            ollama_health.report(True)
+            print(f"📡 Status da resposta Ollama: {response.status_code}")
+
+            if response.status_code == 404:
+                # Modelo nao encontrado
+                raise AIError(f"❌ Modelo '{model}' não encontrado. Verifique se está instalado com 'ollama list'")
+            if response.status_code != 200:
+                # Outros erros HTTP
+                print(f"❌ Erro HTTP {response.status_code}: {response.text}")
+                raise AIError(f"❌ Erro HTTP {response.status_code} ao comunicar com Ollama")
+
+            parts = []
+            final = {}
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise AIError(f"❌ Erro do Ollama: {chunk['error']}")
+                text = chunk.get("response", "")
+                if text:
+                    parts.append(text)
+                    if on_text is not None:
+                        on_text(text)
+                if chunk.get("done"):
+                    final = chunk
+                    break
+            return "".join(parts), final
+
     except requests.exceptions.ConnectionError:
-        # Ollama nao esta rodando ou inacessivel
-        return "❌ Não foi possível conectar ao Ollama. Verifique se está rodando na porta 11434"
+        # Ollama nao esta rodando ou inacessivel: a proxima chamada verifica de novo
+        ollama_health.report(False)
+        raise AIError("❌ Não foi possível conectar ao Ollama. Verifique se está rodando na porta 11434")
     except requests.exceptions.Timeout:
-        # Timeout na requisicao
-        return "❌ Timeout ao aguardar resposta do Ollama (>30s)"
+        # Nenhum token dentro do intervalo (a geracao em si pode demorar mais)
+        raise AIError(f"❌ Timeout: Ollama ficou {OLLAMA_TIMEOUT[1]}s sem enviar resposta")
     except requests.exceptions.RequestException as e:
         # Outros erros de requisicao
-        return f"❌ Erro de requisição Ollama: {e}"
+        raise AIError(f"❌ Erro de requisição Ollama: {e}")
+    except ValueError as e:
+        # Linha que nao e JSON valido
+        raise AIError(f"❌ Resposta inválida do Ollama: {e}")
+
+def normalize_prompt(prompt):
+    """
+    Normaliza um prompt para uso como chave do cache
+    
+    Args:
+        prompt (str): Texto digitado pelo usuario
+    
+    Returns:
+        str: Texto sem diferenca de maiusculas, espacos repetidos ou pontuacao final
+    """
+    return " ".join(prompt.casefold().split()).rstrip(" ?!.")
+
+class ResponseCache:
+    """
+    Cache de respostas do ChatBot (LRU + TTL)
+    
+    Funcionalidades:
+        - Chave: modelo + prompt normalizado (ver normalize_prompt)
+        - Limitado em quantidade de entradas e em bytes; as menos usadas saem primeiro
+        - Entradas expiram depois de `ttl` segundos
+        - Contadores de acertos e falhas (stats)
+        - Com `path`, as respostas sao salvas em JSON e recarregadas ao reiniciar;
+          put() apenas marca o cache como alterado e uma thread grava o arquivo a
+          cada `save_interval` segundos (e close() grava o que faltar)
+    
+    Args:
+        max_entries (int): Quantidade maxima de respostas
+        max_bytes (int): Tamanho maximo somado das respostas (bytes em utf-8)
+        ttl (float): Validade de cada resposta em segundos
+        path (str, optional): Arquivo para persistir o cache
+        save_interval (float): Segundos entre gravacoes em disco
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL, path=None,
+                 save_interval=CACHE_SAVE_INTERVAL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = None
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock() # Uma gravacao por vez (thread periodica e close)
+        self.stop_event = threading.Event()
+        self.saver = None
+        self.entries = OrderedDict() # chave -> (momento de criacao, resposta, tamanho)
+        self.total_bytes = 0
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load(path)
+
+    @staticmethod
+    def key(prompt, model):
+        return f"{model}\n{normalize_prompt(prompt)}"
+
+    def get(self, prompt, model):
+        """
+        Busca a resposta de um prompt
+        
+        Returns:
+            str or None: Resposta em cache ou None (ausente ou expirada)
+        """
+        key = self.key(prompt, model)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, prompt, model, response):
+        """Guarda a resposta de um prompt e descarta as menos usadas se passar dos limites"""
+        key = self.key(prompt, model)
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._insert(key, time.time(), response, size)
+            self.dirty = True
+
+    def _insert(self, key, created, response, size):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (created, response, size)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def load(self, path):
+        """Carrega as respostas salvas em `path` (ignorando as expiradas) e passa a salvar nele"""
+        self.path = path
+        if self.saver is None and self.save_interval:
+            self.saver = threading.Thread(target=self._save_loop, daemon=True)
+            self.saver.start()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            # Salvas da menos para a mais usada: a ordem LRU e preservada
+            for key, created, response in saved:
+                if now - created <= self.ttl:
+                    self._insert(key, created, response, len(response.encode("utf-8")))
+
+    def save(self):
+        """Grava o cache em disco, se mudou (arquivo temporario + rename, atomico)"""
+        with self.save_lock:
+            with self.lock:
+                if not self.path or not self.dirty:
+                    return
+                saved = [[key, created, response] for key, (created, response, _) in self.entries.items()]
+                self.dirty = False
+            # Nome unico: outro processo usando o mesmo arquivo nao grava no mesmo temporario
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(temporary, "w", encoding="utf-8") as f:
+                    json.dump(saved, f, ensure_ascii=False)
+                os.replace(temporary, self.path)
+            except OSError as e:
+                with self.lock:
+                    self.dirty = True # Tenta de novo na proxima gravacao
+                print(f"⚠️  Não foi possível salvar o cache de respostas: {e}")
+
+    def _save_loop(self):
+        while not self.stop_event.wait(self.save_interval):
+            self.save()
+
+    def close(self):
+        """Para a gravacao periodica e grava o que estiver pendente"""
+        self.stop_event.set()
+        self.save()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Entradas, bytes, acertos, falhas e taxa de acerto
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+# Cache de respostas compartilhado pelos workers (persistencia opcional, ver AIClient)
+response_cache = ResponseCache()
+
+class ConversationSessions:
+    """
+    Conversa de cada usuario com o ChatBot
+    
+    Funcionalidades:
+        - A conversa e opcional: comeca com start() (comando /conversa) e
+          termina com reset(); sem ela as perguntas sao avulsas e passam pelo
+          cache de respostas e pela deduplicacao (ver ask_ai)
+        - Guarda os tokens de `context` devolvidos pelo Ollama: a pergunta
+          seguinte envia apenas o texto novo
+        - Janela limitada: apenas os `max_tokens` tokens mais recentes
+        - Conversas sem uso ha mais de `idle_timeout` segundos sao descartadas
+        - Limite de memoria: acima de `max_total_tokens` somados, as conversas
+          usadas ha mais tempo sao descartadas primeiro
+    
+    Args:
+        max_tokens (int): Tokens guardados por usuario
+        idle_timeout (float): Segundos sem uso ate esquecer a conversa
+        max_total_tokens (int): Tokens somados de todas as conversas
+    """
+    def __init__(self, max_tokens=SESSION_MAX_TOKENS, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 max_total_tokens=SESSION_MAX_TOTAL_TOKENS):
+        self.max_tokens = max_tokens
+        self.idle_timeout = idle_timeout
+        self.max_total_tokens = max_total_tokens
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict() # usuario -> {"context": array, "used": float}
+        self.total_tokens = 0
+
+    def start(self, user):
+        """Inicia uma conversa nova do usuario (descarta o contexto anterior, se houver)"""
+        with self.lock:
+            self._remove(user)
+            self.sessions[user] = {"context": array.array("I"), "used": time.monotonic()}
+
+    def get(self, user):
+        """
+        Estado da conversa de um usuario
+        
+        Returns:
+            array or None: Tokens de contexto (vazio no inicio da conversa) ou
+            None se o usuario nao esta em uma conversa
+        """
+        with self.lock:
+            self._evict_idle()
+            session = self.sessions.get(user)
+            if session is None:
+                return None
+            session["used"] = time.monotonic()
+            self.sessions.move_to_end(user)
+            return session["context"]
+
+    def update(self, user, context):
+        """
+        Guarda os tokens devolvidos pela ultima geracao (ja incluem as trocas anteriores)
+        Ignorado se a conversa terminou durante a geracao
+        """
+        tokens = array.array("I", context[-self.max_tokens:]) # uint32: ~4 bytes por token
+        with self.lock:
+            if user not in self.sessions:
+                return
+            self._remove(user)
+            self.sessions[user] = {"context": tokens, "used": time.monotonic()}
+            self.total_tokens += len(tokens)
+            while self.total_tokens > self.max_total_tokens and len(self.sessions) > 1:
+                self._remove(next(iter(self.sessions)))
+
+    def reset(self, user):
+        """Esquece a conversa de um usuario"""
+        with self.lock:
+            self._remove(user)
+
+    def _remove(self, user):
+        session = self.sessions.pop(user, None)
+        if session is not None:
+            self.total_tokens -= len(session["context"])
+
+    def _evict_idle(self):
+        """Remove as conversas paradas (as mais antigas ficam no inicio do OrderedDict)"""
+        now = time.monotonic()
+        while self.sessions:
+            user, session = next(iter(self.sessions.items()))
+            if now - session["used"] <= self.idle_timeout:
+                break
+            self._remove(user)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Quantidade de conversas e tokens guardados
+        """
+        with self.lock:
+            return {"sessions": len(self.sessions), "tokens": self.total_tokens}
+
+# Conversas por usuario compartilhadas pelos workers
+conversations = ConversationSessions()
+
+class InFlightRequest:
+    """
+    Uma geracao em andamento compartilhada por todos que fizeram a mesma pergunta
+    
+    Funcionalidades:
+        - publish() repassa cada trecho a todos os inscritos, na ordem
+        - subscribe() entrega os trechos ja gerados a quem chegou depois e
+          inscreve para os proximos
+        - finish() registra o resultado e libera quem esta esperando em wait()
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+        self.listeners = []
+        self.done = threading.Event()
+        self.result = None
+        self.ok = False
+
+    def subscribe(self, on_partial):
+        if on_partial is None:
+            return
+        with self.lock:
+            for part in self.parts:
+                on_partial(part)
+            self.listeners.append(on_partial)
+
+    def publish(self, text):
+        with self.lock:
+            self.parts.append(text)
+            for listener in self.listeners:
+                try:
+                    listener(text)
+                except Exception as e:
+                    print(f"❌ Erro ao repassar resposta: {e}")
+
+    def finish(self, result, ok):
+        self.result = result
+        self.ok = ok
+        self.done.set()
+
+    def wait(self):
+        """
+        Returns:
+            tuple: (resposta ou mensagem de erro, True se a geracao teve sucesso)
+        """
+        self.done.wait()
+        return self.result, self.ok
+
+class InFlightRequests:
+    """
+    Perguntas identicas em andamento (mesmo modelo e texto normalizado)
+    
+    A primeira pergunta faz a requisicao ao Ollama; as iguais que chegam
+    enquanto ela gera apenas aguardam e recebem a mesma resposta. A carga no
+    modelo fica limitada ao numero de perguntas diferentes, nao de usuarios.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # chave (ResponseCache.key) -> InFlightRequest
+        self.coalesced = 0  # Perguntas atendidas por uma geracao de outro usuario
+
+    def join(self, key):
+        """
+        Returns:
+            tuple: (InFlightRequest, True se quem chamou deve fazer a geracao)
+        """
+        with self.lock:
+            request = self.requests.get(key)
+            if request is not None:
+                self.coalesced += 1
+                return request, False
+            request = self.requests[key] = InFlightRequest()
+            return request, True
+
+    def finish(self, key, result, ok):
+        """Conclui a geracao; novas perguntas iguais passam a usar o cache"""
+        with self.lock:
+            request = self.requests.pop(key)
+        request.finish(result, ok)
+
+# Geracoes em andamento compartilhadas pelos workers
+in_flight = InFlightRequests()
+
+def generate_reply(prompt, model, on_partial, user=None, context=None):
+    """
+    Gera a resposta no Ollama entregando os trechos por frase ou janela de tempo
+    
+    Args:
+        prompt (str): Pergunta do usuario
+        model (str): Nome do modelo Ollama
+        on_partial (callable, optional): Recebe cada trecho (e a mensagem de erro, se houver)
+        user (str, optional): Usuario cuja conversa recebe o novo contexto
+        context (array, optional): Tokens de contexto da conversa
+    
+    Returns:
+        tuple: (resposta ou mensagem de erro, True se a geracao teve sucesso)
+    """
+    print(f"🤖 Enviando prompt para Ollama: {prompt[:50]}...")
+    batcher = ReplyBatcher(on_partial) if on_partial is not None else None
+    try:
+        ai_response, final = generate(prompt, model, batcher.add if batcher else None, context)
+        if user and final.get("context"):
+            conversations.update(user, final["context"])
+        if batcher:
+            batcher.flush()
+        if not ai_response:
+            ai_response = 'Resposta vazia do modelo'
+            if on_partial is not None:
+                on_partial(ai_response)
+            return ai_response, False
+        print(f"✅ Resposta recebida: {ai_response[:100]}...")
+        return ai_response, True
+    except AIError as e:
+        error = str(e)
     except Exception as e:
         # Erros inesperados
         print(f"❌ Erro inesperado na função ask_ai: {e}")
-        return f"❌ Erro inesperado na API Ollama: {e}"
+        error = f"❌ Erro inesperado na API Ollama: {e}"
+
+    if batcher:
+        batcher.flush() # Entrega o que ja tinha sido gerado antes do erro
+        on_partial(error)
+    return error, False
+
+def ask_ai(prompt, model="qwen3:4b", on_partial=None, user=None):
+    """
+    Envia prompt para o Ollama e retorna a resposta da IA
+    
+    Args:
+        prompt (str): Texto/pergunta para enviar ao modelo de IA
+        model (str): Nome do modelo Ollama a ser usado (padrao: qwen3:4b)
+        on_partial (callable, optional): Recebe a resposta em trechos (por frase
+            ou janela de tempo, ver ReplyBatcher) enquanto o modelo gera; se
+            informado, mensagens de erro tambem sao entregues por ele
+        user (str, optional): Usuario que perguntou; se ele iniciou uma conversa
+            (/conversa), continua o contexto anterior dele (ver ConversationSessions)
+    
+    Returns:
+        str: Resposta da IA ou mensagem de erro
+    
+    Processo:
+        1. Em uma conversa, gera com o contexto do usuario (sem cache nem
+           deduplicacao: a resposta depende desse contexto)
+        2. Pergunta avulsa: procura a resposta no cache (prompt normalizado + modelo)
+        3. Se a mesma pergunta ja esta sendo gerada para outro usuario, aguarda
+           e recebe os mesmos trechos (ver InFlightRequests)
+        4. Senao, gera no Ollama (POST em streaming por uma conexao keep-alive),
+           repassa os trechos conforme chegam e guarda no cache
+    """
+    context = conversations.get(user) if user else None
+    if context is not None:
+        return generate_reply(prompt, model, on_partial, user, context or None)[0]
+
+    cached = response_cache.get(prompt, model)
+    if cached is not None:
+        print(f"💾 Resposta em cache para: {prompt[:50]}...")
+        if on_partial is not None:
+            on_partial(cached)
+        return cached
+
+    key = ResponseCache.key(prompt, model)
+    request, leader = in_flight.join(key)
+    request.subscribe(on_partial)
+    if not leader:
+        print(f"🔗 Aguardando geração em andamento para: {prompt[:50]}...")
+        return request.wait()[0]
+
+    result, ok = None, False
+    try:
+        result, ok = generate_reply(prompt, model, request.publish)
+        if ok:
+            # Erros e respostas vazias nao entram no cache
+            response_cache.put(prompt, model, result)
+        return result
+    finally:
+        in_flight.finish(key, result, ok)
 
 def test_ollama_connection():
     """
@@ -79,11 +702,13 @@ def test_ollama_connection():
         - Verifica se Ollama esta acessivel
         - Lista todos os modelos instalados
         - Fornece feedback detalhado sobre o status
+        - Atualiza o estado de saude em cache usado por ask_ai
     """
     try:
         print("🔍 Testando conexão com Ollama...")
         # Fazer requisicao para listar modelos
-        response = requests.get('http://localhost:11434/api/tags', timeout=5)
+        response = ollama_session.get(f'{OLLAMA_URL}/api/tags', timeout=5)
+        ollama_health.report(response.status_code == 200)
         if response.status_code == 200:
             # Sucesso - extrair lista de modelos
             models = response.json().get('models', [])
@@ -98,6 +723,7 @@ def test_ollama_connection():
             print(f"❌ Ollama respondeu com status {response.status_code}")
             return False
     except Exception as e:
+        ollama_health.report(False)
         print(f"❌ Erro ao testar Ollama: {e}")
         return False
 
@@ -148,8 +774,9 @@ class AIClient:
     Funcionalidades:
         - Conecta ao servidor de chat como usuario "ChatBot"
         - Monitora mensagens privadas direcionadas ao bot
-        - Processa mensagens usando Ollama AI
+        - Processa mensagens usando Ollama AI em um pool limitado de workers
         - Responde automaticamente ao remetente
+        - Avisa quando o prompt entrou na fila (bot ocupado) ou foi recusado (fila cheia)
     
     Attributes:
         SERVER_IP (str): IP do servidor de chat
@@ -157,18 +784,27 @@ class AIClient:
         ADDR (tuple): Endereco completo (IP, porta)
         FORMAT (str): Codificacao de caracteres (utf-8)
         client (socket): Socket de conexao com o servidor
+        prompts (queue.Queue): Fila limitada de (remetente, mensagem) aguardando um worker
     """
-    def __init__(self, server_ip=None, port=5050):
+    def __init__(self, server_ip=None, port=5050, workers=AI_WORKERS, queue_limit=AI_QUEUE_LIMIT,
+                 cache_file=None):
         """
         Inicializa o cliente AI
         
         Args:
             server_ip (str, optional): IP do servidor. Se None, tenta descobrir automaticamente
             port (int): Porta do servidor (padrao: 5050)
+            workers (int): Quantidade de prompts processados em paralelo
+            queue_limit (int): Tamanho maximo da fila de prompts pendentes
+            cache_file (str, optional): Arquivo para persistir o cache de respostas
         
         Raises:
             ConnectionError: Se nao conseguir encontrar ou conectar ao servidor
         """
+        if cache_file:
+            response_cache.load(cache_file)
+            print(f"💾 Cache de respostas: {response_cache.stats()['entries']} respostas carregadas")
+        
         # Testar conexao com Ollama antes de conectar ao chat
         if not test_ollama_connection():
             print("⚠️  Continuando sem Ollama funcional...")
@@ -182,6 +818,13 @@ class AIClient:
         self.PORT = port
         self.ADDR = (self.SERVER_IP, self.PORT)
         self.FORMAT = 'utf-8'
+        self.send_lock = threading.Lock() # Workers e thread de recepcao enviam pelo mesmo socket
+        
+        # Pool de workers: a thread de recepcao apenas enfileira os prompts
+        self.workers = workers
+        self.prompts = queue.Queue(maxsize=queue_limit)
+        self.busy_lock = threading.Lock()
+        self.busy = 0 # Workers gerando uma resposta neste momento
         
         # Criar e conectar socket TCP
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -201,10 +844,11 @@ class AIClient:
         Processo:
             - Converte dicionario para JSON
             - Codifica em UTF-8
-            - Envia via socket
+            - Envia via socket dentro de um frame (ver protocol.py)
         """
         try:
-            self.client.send(json.dumps(message).encode(self.FORMAT))
+            with self.send_lock:
+                send_json(self.client, message)
         except Exception as e:
             print(f"Erro ao enviar: {e}")
 
@@ -251,10 +895,13 @@ class AIClient:
         Formato esperado das mensagens privadas:
             "[NomeUsuario -> ChatBot]: Qual e a capital do Brasil?"
         """
-        while True:
-            try:
-                # Receber mensagem do servidor
-                msg = self.client.recv(2048).decode(self.FORMAT)
+        try:
+            # Receber mensagens do servidor: cada frame de texto e uma mensagem completa
+            for frame_type, payload in read_frames(self.client):
+                if frame_type != FRAME_TEXT:
+                    continue
+
+                msg = payload.decode(self.FORMAT)
                 print(f"DEBUG: Mensagem recebida: {msg}")
                 if msg:
                     # Separar tipo da mensagem do conteudo
@@ -279,23 +926,74 @@ class AIClient:
                             print(f"\n💬 Mensagem privada de {sender} para {destinatario}: {message}")
 
                             # Só responde se o destinatário for o próprio ChatBot
-                            if destinatario == "ChatBot":
-                                print(f"🎯 Processando mensagem para ChatBot...")
-                                response = ask_ai(message)
-                                time.sleep(1)
-                                self.send_response(sender, response)
+                            command = message.strip().lower()
+                            if destinatario == "ChatBot" and command in CONVERSATION_COMMANDS:
+                                conversations.start(sender)
+                                self.send_response(sender, "💬 Conversa iniciada: lembro das suas perguntas "
+                                                           "anteriores até você enviar /fim.")
+                            elif destinatario == "ChatBot" and command in RESET_COMMANDS:
+                                conversations.reset(sender)
+                                self.send_response(sender, "🧹 Conversa encerrada. Perguntas avulsas "
+                                                           "(envie /conversa para manter o contexto).")
+                            elif destinatario == "ChatBot":
+                                self.submit_prompt(sender, message)
                                 
+        except Exception as e:
+            print(f"❌ Erro ao receber mensagem: {e}")
+            import traceback
+            traceback.print_exc()
+
+    def submit_prompt(self, sender, message):
+        """
+        Coloca um prompt na fila dos workers sem bloquear a thread de recepcao
+        
+        Args:
+            sender (str): Usuario que enviou a pergunta
+            message (str): Texto da pergunta
+        
+        Comportamento:
+            - Fila cheia: recusa e avisa o usuario na hora
+            - Todos os workers ocupados: avisa que o prompt entrou na fila
+        """
+        with self.busy_lock:
+            all_busy = self.busy + self.prompts.qsize() >= self.workers
+        try:
+            self.prompts.put_nowait((sender, message))
+        except queue.Full:
+            print(f"⚠️  Fila cheia, prompt de {sender} recusado")
+            self.send_response(sender, "Estou com muitas perguntas agora. Tente novamente em instantes.")
+            return
+        
+        print(f"🎯 Prompt de {sender} na fila ({self.prompts.qsize()} aguardando)")
+        if all_busy:
+            self.send_response(sender, f"⏳ Sua pergunta está na fila (posição {self.prompts.qsize()}). "
+                                       f"Respondo assim que possível.")
+
+    def worker_loop(self):
+        """
+        Thread worker: retira prompts da fila, consulta a IA e responde ao remetente
+        """
+        while True:
+            sender, message = self.prompts.get()
+            with self.busy_lock:
+                self.busy += 1
+            try:
+                print(f"🎯 Processando mensagem de {sender} para ChatBot...")
+                # Resposta enviada em trechos conforme o modelo gera (inclusive erros)
+                ask_ai(message, on_partial=lambda text: self.send_response(sender, text), user=sender)
             except Exception as e:
-                print(f"❌ Erro ao receber mensagem: {e}")
-                import traceback
-                traceback.print_exc()
-                break
+                print(f"❌ Erro ao processar prompt de {sender}: {e}")
+            finally:
+                with self.busy_lock:
+                    self.busy -= 1
+                self.prompts.task_done()
 
     def start(self):
         """
         Inicia o cliente AI
         
         Funcionalidades:
+            - Cria as threads workers que consultam a IA
             - Cria thread daemon para processar mensagens
             - Mantem thread principal ativo
             - Trata interrupcao por teclado (Ctrl+C)
@@ -303,6 +1001,9 @@ class AIClient:
         """
         print("🤖 Iniciando AI Client...")
         
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker_loop, daemon=True).start()
+        
         # Criar thread daemon para processar mensagens em backgroundd
         thread = threading.Thread(target=self.handle_messages, daemon=True)
         thread.start()
@@ -312,15 +1013,26 @@ class AIClient:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
+            stats = response_cache.stats()
+            print(f"💾 Cache: {stats['hits']} acertos, {stats['misses']} falhas "
+                  f"({stats['hit_rate']:.0%} de acerto), {in_flight.coalesced} perguntas repetidas em andamento")
             print("\n👋 AI Client desconectado.")
         finally:
-            # Garantir fechamento da conexao
+            # Garantir fechamento da conexao e gravar o cache pendente
             self.client.close()
+            response_cache.close()
 
 # Ponto de entrada do programa
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ChatBot com Ollama para o chat")
+    parser.add_argument("--server", default=None,
+                        help="IP do servidor (padrao: descoberta automatica)")
+    parser.add_argument("--cache-file", default=None,
+                        help="arquivo JSON para manter o cache de respostas entre execucoes")
+    args = parser.parse_args()
+
     try:
-        ai_client = AIClient()
+        ai_client = AIClient(server_ip=args.server, cache_file=args.cache_file)
         ai_client.start()
     except Exception as e:
         print(f"❌ Erro no AI Client: {e}")
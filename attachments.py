@@ -0,0 +1,340 @@
+#attachments.py
+
+import base64
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+# ARMAZENAMENTO DOS ANEXOS (enderecado por conteudo):
+#
+# <diretorio>/ab/abcdef...       spool: bytes originais do arquivo,
+#                                nome = sha256 do conteudo
+# <diretorio>/ab/abcdef....b64   mesmo conteudo em base64, criado apenas na
+#                                primeira entrega a um cliente sem "binary_chunks"
+# <diretorio>/index.json         {hash: [referencias, tamanho original]}
+#
+# O mesmo arquivo enviado varias vezes (para todos, para varios usuarios)
+# ocupa o disco uma unica vez; cada mensagem do historico guarda apenas
+# hash, nome e tamanho. Os spools guardam exatamente os bytes que vao nos
+# frames (FRAME_BINARY ou "file="), entao a entrega e feita com os.sendfile,
+# sem ler o arquivo no Python.
+
+GC_INTERVAL = 60.0                     # Segundos entre cada coleta de anexos sem referencias
+GC_GRACE = 60.0                        # Idade minima (s) de um anexo sem referencias antes de apagar
+BASE64_SUFFIX = ".b64"
+ENCODE_BLOCK = 3 * 256 * 1024          # Bytes lidos por vez ao gerar o spool em base64 (multiplo de 3)
+
+_upload_ids = itertools.count(1) # Nomes dos spools temporarios das transferencias em streaming
+
+class AttachmentStore:
+    """
+    Anexos em disco, sem duplicatas, com contagem de referencias
+    - put(dados) grava o arquivo apenas se o conteudo ainda nao existir e
+      acrescenta uma referencia; retorna (hash, tamanho)
+    - upload() recebe um anexo em pedacos (transferencias em streaming), com o
+      mesmo resultado de put() ao concluir
+    - release(hash) remove uma referencia; anexos sem referencias sao apagados
+      pela coleta periodica depois de GC_GRACE segundos (reenvios nesse
+      intervalo reaproveitam o arquivo)
+    - open_spool(hash) abre os bytes originais para envio com sendfile;
+      open_spool(hash, base64_text=True) abre a versao em base64 (codificada
+      uma unica vez, na primeira entrega a um cliente antigo)
+    - As contagens sao salvas em index.json pela thread de coleta e ao fechar;
+      depois de uma queda, set_references() as substitui pelas contadas nos logs
+    Seguro para uso por varias threads.
+    """
+    def __init__(self, directory, gc_interval=GC_INTERVAL, gc_grace=GC_GRACE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.gc_grace = gc_grace
+        self.lock = threading.Lock()
+        self.entries = {}            # hash -> [referencias, tamanho, momento em que ficou sem referencias]
+        self.dirty = False
+        self.counts = {"stored": 0, "deduplicated": 0, "deduplicated_bytes": 0, "collected": 0}
+        self._load()
+
+        self.stop_event = threading.Event()
+        if gc_interval:
+            threading.Thread(target=self._gc_loop, args=(gc_interval,), daemon=True).start()
+
+    def path(self, digest):
+        """Caminho do spool (bytes originais) de um anexo"""
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _load(self):
+        """Le o indice e confere com os arquivos que realmente existem em disco"""
+        saved = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = {}
+
+        now = time.time()
+        for folder in os.listdir(self.directory):
+            folder_path = os.path.join(self.directory, folder)
+            if folder.startswith("tmp-"):
+                # Transferencia em streaming interrompida (nunca concluida)
+                os.remove(folder_path)
+                continue
+            if len(folder) != 2 or not os.path.isdir(folder_path):
+                continue
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                if name.startswith("tmp-"):
+                    # Escrita interrompida: nunca chegou a ser referenciada
+                    os.remove(path)
+                    continue
+                if name.endswith(BASE64_SUFFIX):
+                    digest = name[:-len(BASE64_SUFFIX)]
+                    if os.path.exists(self.path(digest)):
+                        continue
+                    # Spool so em base64 (versao anterior): recria os bytes originais
+                    with open(path, "rb") as f:
+                        self._write_spool(digest, base64.b64decode(f.read()))
+                else:
+                    digest = name
+                refs, size = saved.get(digest, (0, None))
+                if size is None:
+                    size = os.path.getsize(self.path(digest))
+                self.entries[digest] = [refs, size, None if refs else now]
+        self.dirty = len(self.entries) != len(saved)
+
+    def put(self, data):
+        """Guarda o conteudo (se ainda nao existir) e acrescenta uma referencia"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                entry[0] += 1
+                entry[2] = None
+                self.counts["deduplicated"] += 1
+                self.counts["deduplicated_bytes"] += len(data)
+                self.dirty = True
+                return digest, entry[1]
+
+        # Grava fora do lock
+        self._write_spool(digest, data)
+
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.entries[digest] = [1, len(data), None]
+                self.counts["stored"] += 1
+            else:
+                # Outra thread gravou o mesmo conteudo ao mesmo tempo
+                entry[0] += 1
+                entry[2] = None
+            self.dirty = True
+        return digest, len(data)
+
+    def upload(self):
+        """Inicia um anexo recebido em pedacos (ver AttachmentUpload)"""
+        return AttachmentUpload(self)
+
+    def _adopt(self, digest, size, temporary):
+        """
+        Guarda um spool ja gravado em `temporary` (fim de um upload) e acrescenta
+        uma referencia; se o conteudo ja existir, o temporario e apagado
+        """
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                entry[0] += 1
+                entry[2] = None
+                self.counts["deduplicated"] += 1
+                self.counts["deduplicated_bytes"] += size
+                os.remove(temporary)
+            else:
+                path = self.path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temporary, path)
+                self.entries[digest] = [1, size, None]
+                self.counts["stored"] += 1
+            self.dirty = True
+        return digest, size
+
+    def set_references(self, counts):
+        """
+        Substitui as contagens de referencias por `counts` ({hash: referencias})
+        - Usado ao abrir, com as referencias contadas nos logs de mensagens: o
+          index.json pode estar ate GC_INTERVAL segundos atrasado (queda do servidor)
+        - Anexos sem referencias passam a contar o prazo para a coleta
+        """
+        now = time.time()
+        with self.lock:
+            for digest, entry in self.entries.items():
+                refs = counts.get(digest, 0)
+                if refs != entry[0]:
+                    entry[0] = refs
+                    self.dirty = True
+                if refs:
+                    entry[2] = None
+                elif entry[2] is None:
+                    entry[2] = now
+
+    def release(self, digest):
+        """Remove uma referencia do anexo"""
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None or entry[0] == 0:
+                return
+            entry[0] -= 1
+            if entry[0] == 0:
+                entry[2] = time.time()
+            self.dirty = True
+
+    def _write_spool(self, digest, data):
+        """Grava o spool em um arquivo temporario e renomeia (atomico)"""
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(path), f"tmp-{digest}-{threading.get_ident()}")
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def _write_base64(self, digest):
+        """Gera o spool em base64 a partir dos bytes originais, em blocos (sem carregar o arquivo)"""
+        path = self.path(digest)
+        temporary = os.path.join(os.path.dirname(path), f"tmp-{digest}-{threading.get_ident()}{BASE64_SUFFIX}")
+        with open(path, "rb") as source, open(temporary, "wb") as f:
+            while True:
+                block = source.read(ENCODE_BLOCK)
+                if not block:
+                    break
+                f.write(base64.b64encode(block))
+        os.replace(temporary, path + BASE64_SUFFIX)
+
+    def open_spool(self, digest, base64_text=False):
+        """
+        Abre o spool para envio: retorna (arquivo, tamanho) ou None
+        - base64_text: versao em base64 para o frame "file=" (gerada na primeira vez)
+        O arquivo aberto continua valido mesmo se a coleta apagar o anexo depois
+        """
+        path = self.path(digest)
+        try:
+            if base64_text:
+                if not os.path.exists(path + BASE64_SUFFIX):
+                    self._write_base64(digest)
+                path += BASE64_SUFFIX
+            spool = open(path, "rb")
+        except OSError:
+            return None
+        return spool, os.fstat(spool.fileno()).st_size
+
+    def read(self, digest):
+        """Bytes originais do anexo ou None se nao existir"""
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def collect(self, now=None):
+        """Apaga os anexos sem referencias ha mais de gc_grace segundos; retorna quantos"""
+        now = time.time() if now is None else now
+        with self.lock:
+            expired = [digest for digest, (refs, _, released) in self.entries.items()
+                       if refs == 0 and released is not None and now - released >= self.gc_grace]
+            for digest in expired:
+                del self.entries[digest]
+                # Ainda com o lock: um put() do mesmo conteudo espera e grava de novo
+                for path in (self.path(digest), self.path(digest) + BASE64_SUFFIX):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            if expired:
+                self.counts["collected"] += len(expired)
+                self.dirty = True
+        return len(expired)
+
+    def save(self):
+        """Grava as contagens de referencias em index.json (se mudaram)"""
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = {digest: [refs, size] for digest, (refs, size, _) in self.entries.items()}
+            self.dirty = False
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(temporary, self.index_path)
+
+    def _gc_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.collect()
+                self.save()
+            except OSError:
+                pass
+
+    def stats(self):
+        """Estatisticas: anexos, bytes em disco, referencias e economia com duplicatas"""
+        with self.lock:
+            return {
+                "files": len(self.entries),
+                "bytes": sum(size for _, size, _ in self.entries.values()),
+                "references": sum(refs for refs, _, _ in self.entries.values()),
+                **self.counts
+            }
+
+    def close(self):
+        """Para a coleta periodica e salva o indice"""
+        self.stop_event.set()
+        self.save()
+
+class AttachmentUpload:
+    """
+    Anexo recebido aos poucos (transferencia em streaming)
+    - write(dados) grava cada pedaco no spool temporario e atualiza o sha256,
+      entao o arquivo nunca fica inteiro em memoria; retorna a posicao do
+      pedaco no spool
+    - open_reader(): o spool aberto para leitura, para repassar cada pedaco
+      aos destinatarios com sendfile enquanto a transferencia continua (aberto
+      na primeira chamada e compartilhado pelos pedacos seguintes)
+    - commit() guarda o anexo no AttachmentStore (reaproveitando um conteudo
+      igual) com uma referencia; retorna (hash, tamanho)
+    - abort() apaga o spool temporario (transferencia interrompida)
+    commit()/abort() soltam o reader: como os spools de open_spool(), ele e
+    fechado quando o ultimo frame que o usa e enviado ou descartado.
+    Usado apenas pela thread que recebe a transferencia.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.directory, f"tmp-upload-{os.getpid()}-{next(_upload_ids)}")
+        self.file = open(self.path, "wb")
+        self.reader = None
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        position = self.size
+        self.file.write(data)
+        self.file.flush() # Visivel para o sendfile pelo reader
+        self.hash.update(data)
+        self.size += len(data)
+        return position
+
+    def open_reader(self):
+        if self.reader is None:
+            self.reader = open(self.path, "rb")
+        return self.reader
+
+    def commit(self):
+        self.file.close()
+        self.reader = None
+        return self.store._adopt(self.hash.hexdigest(), self.size, self.path)
+
+    def abort(self):
+        self.file.close()
+        self.reader = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,550 @@
+#bench_load.py
+
+import argparse
+import base64
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from protocol import (CHUNK_SIZE, FRAME_JSON, FRAME_TEXT, FEATURE_BINARY, FEATURE_HISTORY, RECV_SIZE,
+                      FrameReader, encode_binary_chunk, encode_frame)
+
+# BENCHMARK DE CARGA DO SERVIDOR (sem interface grafica):
+#
+# Conecta N usuarios simulados pelo loopback e gera uma mistura configuravel
+# de operacoes do protocolo, medindo a latencia de ponta a ponta de cada uma:
+#
+# - broadcast: "msg" para "4all"; latencia ate cada destinatario receber
+# - private:   "msg" para outro usuario simulado
+# - file:      "file" (base64 em JSON) para "4all"; latencia ate cada destinatario
+# - stream:    "file_start", pedacos FRAME_BINARY e "file_end" para "4all";
+#              latencia ate cada destinatario receber o "file_end"
+# - online:    "online_usr"; latencia ate a resposta "online_users="
+# - join:      conexao + "name" ate a confirmacao "features=" (entrada inicial e churn)
+#
+# O instante de envio (time.perf_counter) vai dentro do proprio conteudo
+# ("bench|operacao|instante|..."), entao quem recebe calcula a latencia sem
+# estado compartilhado. Usuarios simulados e medicao ficam no mesmo processo;
+# com --spawn o servidor roda em outro processo (nao disputa o GIL).
+#
+# Uso:
+#   python bench_load.py --spawn events --users 200 --rate 2000 --duration 20
+#   python bench_load.py --users 50 --mix broadcast=60,private=30,online=10 --churn 5 --json run.json
+
+HOST = "127.0.0.1"
+PORT = 5050
+OPS = ("broadcast", "private", "file", "stream", "online")
+DEFAULT_MIX = "broadcast=70,private=20,file=2,stream=3,online=5"
+MARKER = b"]: bench|"          # Inicio do conteudo de uma mensagem do benchmark ("[a -> b]: bench|...")
+FILE_PREFIX_BYTES = 12         # Multiplo de 3: o base64 do prefixo aleatorio emenda no do corpo
+READY_TIMEOUT = 10.0           # Espera maxima pela confirmacao de entrada de cada usuario
+QUIET_SECONDS = 0.5            # Sem receber nada por esse tempo, a drenagem termina
+
+class SimulatedUser:
+    """
+    Um usuario simulado: socket bloqueante para envio (apenas a thread dona
+    envia) e leitura feita por uma thread leitora com selectors
+    """
+    def __init__(self, name, sock):
+        self.name = name
+        self.sock = sock
+        self.frames = FrameReader()
+        self.ready = threading.Event()  # "features=" recebido: usuario registrado
+        self.connected_at = time.perf_counter()
+        self.pending_online = deque()   # Instantes dos "online_usr" sem resposta (respostas chegam em ordem)
+        self.incoming = {}              # Transferencias recebidas em andamento: id -> (operacao, instante de envio)
+        self.next_transfer = 0          # Ids das transferencias enviadas (apenas a thread dona envia)
+        self.closed = False
+
+class BenchStats:
+    """
+    Contadores e latencias de uma thread (sem lock); as threads sao
+    combinadas com merge() no final
+    """
+    def __init__(self):
+        self.sent = dict.fromkeys(OPS, 0)
+        self.received = {}
+        self.latencies = {}      # operacao -> [segundos, ...]
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.errors = {}
+        self.last_receive = 0.0
+
+    def record(self, op, latency):
+        self.received[op] = self.received.get(op, 0) + 1
+        self.latencies.setdefault(op, []).append(latency)
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def merge(self, other):
+        for op, count in other.sent.items():
+            self.sent[op] = self.sent.get(op, 0) + count
+        for op, count in other.received.items():
+            self.received[op] = self.received.get(op, 0) + count
+        for op, values in other.latencies.items():
+            self.latencies.setdefault(op, []).extend(values)
+        for kind, count in other.errors.items():
+            self.errors[kind] = self.errors.get(kind, 0) + count
+        self.bytes_out += other.bytes_out
+        self.bytes_in += other.bytes_in
+
+def parse_bench_filename(filename):
+    """(operacao, instante de envio) de um arquivo "bench-<operacao>-<instante>.bin" ou None"""
+    if not filename.startswith(b"bench-"):
+        return None
+    op, _, sent_at = filename[6:-4].partition(b"-")
+    return op.decode(), float(sent_at)
+
+def percentile(sorted_values, fraction):
+    """Percentil pelo metodo do posto mais proximo (lista ja ordenada)"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def latency_summary(values):
+    """p50/p99/p999/max/media em milissegundos"""
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "p50": percentile(values, 0.50) * 1000,
+        "p99": percentile(values, 0.99) * 1000,
+        "p999": percentile(values, 0.999) * 1000,
+        "max": values[-1] * 1000,
+        "mean": sum(values) / len(values) * 1000
+    }
+
+def parse_mix(text):
+    """Converte "broadcast=70,private=20" em {"broadcast": 70.0, "private": 20.0}"""
+    mix = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        op, _, weight = item.partition("=")
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError(f"operação desconhecida '{op}' (use {', '.join(OPS)})")
+        mix[op] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("a mistura precisa de ao menos uma operação com peso positivo")
+    return mix
+
+class LoadBenchmark:
+    """
+    Executa o benchmark: conexao dos usuarios, envio da mistura de operacoes
+    por threads remetentes (cada usuario pertence a uma unica thread),
+    leitura por threads com selectors e churn de entradas/saidas
+    """
+    def __init__(self, host=HOST, port=PORT, users=50, rate=500.0, duration=10.0, warmup=1.0,
+                 mix=None, msg_bytes=100, file_kb=64, churn=0.0, senders=4, readers=2,
+                 drain=5.0, seed=None):
+        self.host = host
+        self.port = port
+        self.users_count = users
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.mix = mix or parse_mix(DEFAULT_MIX)
+        self.msg_bytes = msg_bytes
+        self.file_kb = file_kb
+        self.churn = churn
+        self.senders = max(1, senders)
+        self.readers = max(1, readers)
+        self.drain = drain
+        self.random = random.Random(seed)
+        self.run_id = f"{os.getpid() % 10000}{self.random.randrange(1000):03d}"
+
+        self.stop_sending = threading.Event()
+        self.stop_reading = threading.Event()
+        self.measure_start = float("inf")  # Antes disso (aquecimento) nada e contado
+        self.selectors = [selectors.DefaultSelector() for _ in range(self.readers)]
+        self.reader_stats = [BenchStats() for _ in range(self.readers)]
+        self.next_selector = 0
+        self.users = []
+        self.file_data = os.urandom(file_kb * 1024)
+        self.file_body = base64.b64encode(self.file_data).decode()
+
+    def connect_user(self, name):
+        """Conecta, registra na thread leitora e envia "name" (como o client.py)"""
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        user = SimulatedUser(name, sock)
+        selector = self.selectors[self.next_selector % self.readers]
+        self.next_selector += 1
+        selector.register(sock, selectors.EVENT_READ, user)
+        sock.sendall(encode_frame(FRAME_JSON, json.dumps(
+            {"type": "name", "control": "dontcare", "message": name,
+             "features": [FEATURE_BINARY, FEATURE_HISTORY]})))
+        return user
+
+    def close_user(self, user):
+        """Saida do usuario: a thread leitora ve o fim da conexao e fecha o socket"""
+        user.closed = True
+        try:
+            user.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def read_loop(self, selector, stats):
+        while not self.stop_reading.is_set():
+            for key, _ in selector.select(0.1):
+                user = key.data
+                try:
+                    data = user.sock.recv(RECV_SIZE)
+                except OSError:
+                    data = b""
+                if not data:
+                    if not user.closed:
+                        stats.error("disconnected")
+                    user.closed = True
+                    selector.unregister(user.sock)
+                    user.sock.close()
+                    continue
+                now = time.perf_counter()
+                stats.last_receive = now
+                if now >= self.measure_start:
+                    stats.bytes_in += len(data)
+                try:
+                    frames = user.frames.feed(data)
+                except Exception:
+                    stats.error("protocol")
+                    continue
+                for frame_type, payload in frames:
+                    self.handle_frame(user, frame_type, payload, now, stats)
+
+    def handle_frame(self, user, frame_type, payload, now, stats):
+        """Identifica o frame recebido e registra a latencia da operacao correspondente"""
+        if frame_type != FRAME_TEXT:
+            return
+        key, _, value = payload.partition(b"=")
+        if key == b"msg":
+            position = value.find(MARKER)
+            if position < 0:
+                if value.startswith(b"[Servidor]: \xe2\x9d\x8c"):  # "❌": erro informado pelo servidor
+                    stats.error("server_error")
+                return
+            op, sent_at, _ = value[position + len(MARKER):].split(b"|", 2)
+            self.record(stats, op.decode(), float(sent_at), now)
+        elif key == b"file":
+            # file=remetente||bench-<operacao>-<instante>.bin||dados (sem copiar os dados)
+            start = value.find(b"||") + 2
+            bench_file = parse_bench_filename(value[start:value.find(b"||", start)])
+            if bench_file and self.is_live(user, bench_file):
+                self.record(stats, *bench_file, now)
+        elif key == b"file_start":
+            # file_start=id||remetente||bench-<operacao>-<instante>.bin||tamanho
+            # (clientes com FEATURE_BINARY recebem tambem os anexos "file" assim)
+            transfer_id, _, filename, _ = value.split(b"||", 3)
+            bench_file = parse_bench_filename(filename)
+            if bench_file and self.is_live(user, bench_file):
+                user.incoming[transfer_id] = bench_file
+        elif key == b"file_end":
+            bench_file = user.incoming.pop(value, None)
+            if bench_file:
+                self.record(stats, *bench_file, now)
+        elif key == b"file_abort":
+            if user.incoming.pop(value, None):
+                stats.error("file_abort")
+        elif key == b"online_users":
+            if user.pending_online:
+                self.record(stats, "online", user.pending_online.popleft(), now)
+        elif key == b"features":
+            # Entradas sao medidas tambem fora da janela de medicao (conexao inicial)
+            stats.record("join", now - user.connected_at)
+            user.ready.set()
+
+    @staticmethod
+    def is_live(user, bench_file):
+        """
+        Arquivo enviado depois da entrada do usuario: os anteriores chegam pelo
+        reenvio do historico ao entrar (churn) e nao sao entregas da operacao
+        """
+        return bench_file[1] >= user.connected_at
+
+    def record(self, stats, op, sent_at, now):
+        if sent_at >= self.measure_start:
+            stats.record(op, now - sent_at)
+
+    def build_message(self, user, op, now):
+        """Frame JSON da operacao com o instante de envio no conteudo"""
+        if op == "online":
+            user.pending_online.append(now)
+            message = {"type": "online_usr", "control": "dontcare", "message": "dontcare"}
+        elif op == "file":
+            # Prefixo aleatorio: cada envio e um anexo diferente (sem deduplicacao no servidor)
+            prefix = base64.b64encode(os.urandom(FILE_PREFIX_BYTES)).decode()
+            message = {"type": "file", "control": "4all", "message": prefix + self.file_body,
+                       "filename": f"bench-file-{now:.6f}.bin"}
+        elif op == "stream":
+            return self.build_stream(user, now)
+        else:
+            content = f"bench|{op}|{now:.6f}|"
+            content += "x" * max(0, self.msg_bytes - len(content))
+            if op == "private":
+                target = self.random.choice(self.users)
+                while target is user and len(self.users) > 1:
+                    target = self.random.choice(self.users)
+                control = target.name
+            else:
+                control = "4all"
+            message = {"type": "msg", "control": control, "message": content}
+        return encode_frame(FRAME_JSON, json.dumps(message))
+
+    def build_stream(self, user, now):
+        """Frames de uma transferencia em streaming (como o client.py com FEATURE_BINARY), em um unico envio"""
+        user.next_transfer += 1
+        transfer_id = user.next_transfer
+        data = os.urandom(FILE_PREFIX_BYTES) + self.file_data
+        frames = [encode_frame(FRAME_JSON, json.dumps(
+            {"type": "file_start", "control": "4all", "message": "dontcare",
+             "filename": f"bench-stream-{now:.6f}.bin", "size": len(data), "transfer_id": transfer_id}))]
+        for offset in range(0, len(data), CHUNK_SIZE):
+            frames.append(encode_binary_chunk(transfer_id, data[offset:offset + CHUNK_SIZE]))
+        frames.append(encode_frame(FRAME_JSON, json.dumps(
+            {"type": "file_end", "control": "dontcare", "message": "dontcare", "transfer_id": transfer_id})))
+        return b"".join(frames)
+
+    def send_loop(self, users, stats, interval):
+        """
+        Envia operacoes sorteadas pelos pesos da mistura
+        - interval: segundos entre envios desta thread (0 = o mais rapido possivel,
+          limitado pela vazao do servidor via TCP)
+        """
+        ops = list(self.mix)
+        weights = [self.mix[op] for op in ops]
+        generator = random.Random(self.random.random())
+        next_time = time.perf_counter()
+        while not self.stop_sending.is_set() and users:
+            if interval:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += interval
+            user = generator.choice(users)
+            op = generator.choices(ops, weights)[0]
+            now = time.perf_counter()
+            frame = self.build_message(user, op, now)
+            try:
+                user.sock.sendall(frame)
+            except OSError:
+                stats.error("send_failed")
+                users.remove(user)
+                continue
+            if now >= self.measure_start:
+                stats.sent[op] += 1
+                stats.bytes_out += len(frame)
+
+    def churn_loop(self, stats):
+        """Entradas e saidas de usuarios extras em --churn por segundo"""
+        interval = 1.0 / self.churn
+        count = 0
+        next_time = time.perf_counter()
+        while not self.stop_sending.is_set():
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_time += interval
+            count += 1
+            try:
+                user = self.connect_user(f"bench{self.run_id}-churn{count}")
+            except OSError:
+                stats.error("connect_failed")
+                continue
+            if not user.ready.wait(READY_TIMEOUT):
+                stats.error("join_timeout")
+            self.close_user(user)
+
+    def run(self):
+        """Executa o benchmark completo e retorna o relatorio (dicionario)"""
+        readers = [threading.Thread(target=self.read_loop, args=(selector, stats), daemon=True)
+                   for selector, stats in zip(self.selectors, self.reader_stats)]
+        for thread in readers:
+            thread.start()
+
+        # Entrada dos usuarios
+        for index in range(self.users_count):
+            self.users.append(self.connect_user(f"bench{self.run_id}-u{index}"))
+        deadline = time.time() + READY_TIMEOUT
+        for user in self.users:
+            if not user.ready.wait(max(0, deadline - time.time())):
+                raise RuntimeError(f"{user.name} não foi confirmado pelo servidor em {READY_TIMEOUT:.0f}s")
+
+        # Carga: cada usuario pertence a uma unica thread remetente
+        interval = self.senders / self.rate if self.rate else 0
+        sender_stats = [BenchStats() for _ in range(self.senders)]
+        threads = [threading.Thread(target=self.send_loop, daemon=True,
+                                    args=(self.users[index::self.senders], stats, interval))
+                   for index, stats in enumerate(sender_stats)]
+        churn_stats = BenchStats()
+        if self.churn:
+            threads.append(threading.Thread(target=self.churn_loop, args=(churn_stats,), daemon=True))
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        time.sleep(self.warmup)
+        self.measure_start = time.perf_counter()
+        time.sleep(self.duration)
+        self.stop_sending.set()
+        elapsed = time.perf_counter() - self.measure_start
+        for thread in threads:
+            thread.join(READY_TIMEOUT)
+
+        # Drenagem: espera as entregas em andamento ate ficar QUIET_SECONDS sem receber nada
+        drain_end = time.perf_counter() + self.drain
+        while time.perf_counter() < drain_end:
+            last = max(stats.last_receive for stats in self.reader_stats)
+            if time.perf_counter() - last > QUIET_SECONDS:
+                break
+            time.sleep(0.1)
+
+        for user in self.users:
+            self.close_user(user)
+        time.sleep(0.2)
+        self.stop_reading.set()
+        for thread in readers:
+            thread.join(READY_TIMEOUT)
+
+        total = BenchStats()
+        for stats in self.reader_stats + sender_stats + [churn_stats]:
+            total.merge(stats)
+        return self.report(total, elapsed, time.perf_counter() - started)
+
+    def report(self, total, elapsed, wall):
+        sent = sum(total.sent.values())
+        received = sum(count for op, count in total.received.items() if op != "join")
+        return {
+            "config": {
+                "host": self.host, "port": self.port, "users": self.users_count,
+                "rate": self.rate, "duration": self.duration, "warmup": self.warmup,
+                "mix": self.mix, "msg_bytes": self.msg_bytes, "file_kb": self.file_kb,
+                "churn": self.churn, "senders": self.senders, "readers": self.readers
+            },
+            "elapsed": elapsed,
+            "wall": wall,
+            "totals": {
+                "sent": sent,
+                "received": received,
+                "sent_per_sec": sent / elapsed,
+                "received_per_sec": received / elapsed,
+                "bytes_out": total.bytes_out,
+                "bytes_in": total.bytes_in,
+                "bytes_out_per_sec": total.bytes_out / elapsed,
+                "bytes_in_per_sec": total.bytes_in / elapsed
+            },
+            "ops": {
+                op: {
+                    "sent": total.sent.get(op, 0),
+                    "received": total.received.get(op, 0),
+                    "latency_ms": latency_summary(total.latencies.get(op, []))
+                }
+                for op in OPS + ("join",)
+                if total.sent.get(op) or total.received.get(op)
+            },
+            "errors": total.errors
+        }
+
+def print_report(result, engine=None):
+    config = result["config"]
+    title = f"{config['users']} usuários, {result['elapsed']:.1f}s"
+    if engine:
+        title += f", motor {engine}"
+    print(f"\n=== Benchmark de carga: {title} ===")
+    print(f"{'operação':<10} {'enviadas':>9} {'recebidas':>10} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'p999 ms':>9} {'max ms':>9}")
+    for op, data in result["ops"].items():
+        latency = data["latency_ms"]
+        columns = "".join(f"{latency[k]:>10.2f}" if k in latency else f"{'-':>10}"
+                          for k in ("p50", "p99", "p999", "max"))
+        print(f"{op:<10} {data['sent']:>9} {data['received']:>10}{columns}")
+    totals = result["totals"]
+    print(f"\nEnviadas: {totals['sent_per_sec']:.0f} msgs/s, {totals['bytes_out_per_sec']/1024/1024:.2f} MB/s")
+    print(f"Entregues: {totals['received_per_sec']:.0f} msgs/s, {totals['bytes_in_per_sec']/1024/1024:.2f} MB/s")
+    if result["errors"]:
+        print(f"Erros: {json.dumps(result['errors'])}")
+
+def spawn_server(engine, port):
+    """Inicia o server.py headless, sem persistencia, e espera a porta aceitar conexoes"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(directory, "server.py"), "--headless", "--log", "none",
+         "--no-persist", "--engine", engine],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"servidor encerrou ao iniciar (código {process.returncode})")
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("servidor não abriu a porta a tempo")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga do servidor de chat (usuários simulados)")
+    parser.add_argument("--host", default=HOST, help="endereço do servidor (padrão: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=PORT, help="porta do servidor (padrão: 5050)")
+    parser.add_argument("--spawn", choices=("threads", "events"), default=None,
+                        help="inicia um server.py headless com o motor indicado durante o teste")
+    parser.add_argument("--users", type=int, default=50, help="usuários simulados conectados")
+    parser.add_argument("--rate", type=float, default=500,
+                        help="operações por segundo no total (0 = o mais rápido possível)")
+    parser.add_argument("--duration", type=float, default=10, help="segundos de medição")
+    parser.add_argument("--warmup", type=float, default=1, help="segundos de aquecimento (não medidos)")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"pesos das operações ({', '.join(OPS)}); padrão: {DEFAULT_MIX}")
+    parser.add_argument("--msg-bytes", type=int, default=100, help="tamanho do conteúdo das mensagens")
+    parser.add_argument("--file-kb", type=int, default=64, help="tamanho dos arquivos enviados (KB)")
+    parser.add_argument("--churn", type=float, default=0,
+                        help="entradas e saídas de usuários extras por segundo")
+    parser.add_argument("--senders", type=int, default=4, help="threads que enviam as operações")
+    parser.add_argument("--readers", type=int, default=2, help="threads que leem as respostas")
+    parser.add_argument("--drain", type=float, default=5, help="espera máxima pelas entregas pendentes (s)")
+    parser.add_argument("--seed", type=int, default=None, help="semente do sorteio das operações")
+    parser.add_argument("--json", default=None, help="grava o relatório em JSON no arquivo (- para stdout)")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.users < 2 and "private" in mix:
+        parser.error("mensagens privadas precisam de ao menos 2 usuários")
+
+    if args.spawn and args.port != PORT:
+        parser.error(f"--spawn usa a porta fixa do server.py ({PORT})")
+
+    server = spawn_server(args.spawn, args.port) if args.spawn else None
+    try:
+        benchmark = LoadBenchmark(args.host, args.port, args.users, args.rate, args.duration,
+                                  args.warmup, mix, args.msg_bytes, args.file_kb, args.churn,
+                                  args.senders, args.readers, args.drain, args.seed)
+        result = benchmark.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    result["config"]["engine"] = args.spawn
+
+    if args.json == "-":
+        print(json.dumps(result, indent=2))
+        return
+    print_report(result, args.spawn)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Relatório salvo em {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#bench_micro.py
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+import server
+from history import MessageHistory
+from protocol import FEATURE_BINARY, FEATURE_HISTORY, FRAME_JSON
+from registry import UserRegistry
+
+# MICROBENCHMARKS DAS FUNCOES QUENTES DO SERVIDOR:
+#
+# Cada funcao e medida com sockets falsos (nada sai da maquina) contra um
+# estado com N usuarios conectados e N mensagens em cada historico, para
+# N em --sizes (padrao 10, 1000 e 100000). O resultado e a curva de custo
+# por chamada e o expoente k de tempo ~ N^k entre o menor e o maior N:
+#
+#   k ~ 0   custo constante (O(1), O(log N) fica abaixo de ~0.2)
+#   k ~ 1   custo linear (O(N))
+#
+# O expoente nao depende da maquina, entao e o que se compara com o
+# baseline salvo (bench_baseline.json): se o expoente de alguma funcao
+# passar do baseline + --tolerance, o script termina com codigo 1.
+# Tempos absolutos so sao comparados com --time-tolerance (mesma maquina).
+#
+# Uso:
+#   python bench_micro.py                  # mede e compara com o baseline
+#   python bench_micro.py --save-baseline  # mede e grava um novo baseline
+
+SIZES = (10, 1000, 100000)
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+EXPONENT_TOLERANCE = 0.3      # Aumento maximo do expoente em relacao ao baseline
+MIN_MEASURE_SECONDS = 0.02    # Duracao minima de cada medicao (ajusta a quantidade de chamadas)
+REPEATS = 5                   # Medicoes por funcao e tamanho (vale a mais rapida)
+
+class FakeSocket:
+    """Socket que apenas conta os bytes enviados"""
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def sendall(self, data, replay=False):
+        self.bytes_sent += len(data)
+
+    def send(self, data):
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+def fake_user(index):
+    return {"conn": FakeSocket(), "addr": ("127.0.0.1", 10000 + index), "name": f"u{index}",
+            "transfers": {}, "features": {FEATURE_BINARY, FEATURE_HISTORY}}
+
+def populate(size):
+    """
+    Substitui o estado global do servidor: `size` usuarios conectados e
+    `size` mensagens no historico global e no privado (em memoria, sem log)
+    """
+    registry = UserRegistry()
+    users = [fake_user(index) for index in range(size)]
+    # Preenche o registro de uma vez: add() copia a tupla a cada entrada
+    registry.by_name = {user["name"]: user for user in users}
+    registry.users = tuple(users)
+    server.connections = registry
+
+    server.global_messages = MessageHistory(size, None, None)
+    server.private_messages = MessageHistory(size, None, None, index_key=server.conversation_key)
+    for index in range(size):
+        server.global_messages.append({"sender": f"u{index % size}", "destination": "all",
+                                       "type": "msg", "content": f"mensagem global {index}"})
+        server.private_messages.append({"sender": f"u{index % size}", "destination": f"u{(index + 1) % size}",
+                                        "type": "msg", "content": f"mensagem privada {index}"})
+    return users
+
+def benchmarks(users):
+    """Funcoes medidas: nome -> funcao sem argumentos (uma chamada)"""
+    sender = users[0]
+    target = users[1 % len(users)]
+    last = users[-1]["name"]
+    message = {"sender": sender["name"], "destination": target["name"], "type": "msg",
+               "content": "mensagem privada de teste"}
+    payload = json.dumps({"type": "msg", "control": target["name"],
+                          "message": "mensagem privada de teste"}).encode()
+    return {
+        "search_name_in_connections": lambda: server.search_name_in_connections(last),
+        "send_message_to_user": lambda: server.send_message_to_user(message, target, True),
+        "send_online_users_list": lambda: server.send_online_users_list(sender),
+        "view_global_history": lambda: server.view_global_history(sender),
+        # Caminho de handle_clients por frame: json.loads + roteamento + historico + envio
+        "handle_frame_private_msg": lambda: server.handle_frame(sender["conn"], sender["addr"], sender,
+                                                                FRAME_JSON, payload)
+    }
+
+def measure(function):
+    """Segundos por chamada (a mais rapida de REPEATS medicoes, sem coleta de lixo)"""
+    number = 1
+    while True:
+        elapsed = _time_calls(function, number)
+        if elapsed >= MIN_MEASURE_SECONDS:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(MIN_MEASURE_SECONDS / elapsed) + 1))
+    best = elapsed
+    for _ in range(REPEATS - 1):
+        best = min(best, _time_calls(function, number))
+    return best / number
+
+def _time_calls(function, number):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def exponent(sizes, times):
+    """Expoente k de tempo ~ N^k entre o menor e o maior tamanho"""
+    if len(sizes) < 2 or times[0] <= 0:
+        return 0.0
+    return math.log(times[-1] / times[0]) / math.log(sizes[-1] / sizes[0])
+
+def run(sizes):
+    """Mede todas as funcoes em cada tamanho; retorna {funcao: {"times_us": {...}, "exponent": k}}"""
+    server.set_log_sink(None)
+    times = {}
+    for size in sizes:
+        print(f"⏱️  N = {size}...", file=sys.stderr)
+        for name, function in benchmarks(populate(size)).items():
+            times.setdefault(name, []).append(measure(function))
+    return {
+        name: {
+            "times_us": {str(size): value * 1e6 for size, value in zip(sizes, values)},
+            "exponent": exponent(sizes, values)
+        }
+        for name, values in times.items()
+    }
+
+def compare(results, baseline, sizes, tolerance, time_tolerance):
+    """
+    Lista de regressoes em relacao ao baseline (vazia se tudo estiver dentro dos limites)
+    None se o baseline foi medido com outros tamanhos (expoentes nao comparaveis)
+    """
+    regressions = []
+    if [int(size) for size in baseline.get("sizes", [])] != list(sizes):
+        return None
+    for name, result in results.items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            continue
+        if result["exponent"] > reference["exponent"] + tolerance:
+            regressions.append(f"{name}: expoente {result['exponent']:.2f} "
+                               f"(baseline {reference['exponent']:.2f} + {tolerance})")
+        if time_tolerance is not None:
+            for size, value in result["times_us"].items():
+                limit = reference["times_us"].get(size, float("inf")) * (1 + time_tolerance)
+                if value > limit:
+                    regressions.append(f"{name}: {value:.2f}µs com N={size} (limite {limit:.2f}µs)")
+    return regressions
+
+def print_results(results, sizes, baseline=None):
+    header = f"{'função':<28}" + "".join(f"{'N=' + str(size):>12}" for size in sizes) + f"{'expoente':>10}"
+    if baseline:
+        header += f"{'baseline':>10}"
+    print(header)
+    for name, result in results.items():
+        line = f"{name:<28}" + "".join(f"{result['times_us'][str(size)]:>10.2f}µs" for size in sizes)
+        line += f"{result['exponent']:>10.2f}"
+        reference = (baseline or {}).get("results", {}).get(name)
+        if reference:
+            line += f"{reference['exponent']:>10.2f}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks e regressão de escala das funções do servidor")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="quantidades de usuários e mensagens (padrão: 10,1000,100000)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="arquivo do baseline (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="grava o resultado como novo baseline")
+    parser.add_argument("--tolerance", type=float, default=EXPONENT_TOLERANCE,
+                        help="aumento máximo do expoente de escala em relação ao baseline")
+    parser.add_argument("--time-tolerance", type=float, default=None,
+                        help="também compara os tempos absolutos (ex: 0.5 = até 50%% mais lento); "
+                             "use apenas na mesma máquina do baseline")
+    parser.add_argument("--json", default=None, help="grava o resultado em JSON no arquivo")
+    args = parser.parse_args()
+
+    try:
+        sizes = sorted(int(size) for size in args.sizes.split(","))
+    except ValueError:
+        parser.error("--sizes deve ser uma lista de inteiros separados por vírgula")
+    if sizes[0] < 2:
+        parser.error("os tamanhos precisam ser maiores que 1")
+
+    results = run(sizes)
+    report = {"sizes": sizes, "python": platform.python_version(), "results": results}
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, sizes, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Baseline salvo em {args.baseline}")
+        return
+    if baseline is None:
+        print(f"\n⚠️ Sem baseline em {args.baseline}: rode com --save-baseline para criar")
+        return
+
+    regressions = compare(results, baseline, sizes, args.tolerance, args.time_tolerance)
+    if regressions is None:
+        print(f"\n⚠️ Não comparável: baseline medido com tamanhos {baseline.get('sizes')}, "
+              f"esta execução com {sizes}")
+        sys.exit(2)
+    if regressions:
+        print("\n❌ Regressões em relação ao baseline:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    print("\n✅ Dentro do baseline")
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,13 @@ import json
 import sys
 import platform
 import time
+import itertools
 from tkinter import *
 from tkinter import scrolledtext, messagebox, filedialog, simpledialog
 from tkinter import ttk
 import datetime
+from protocol import (CHUNK_SIZE, FEATURE_BINARY, FEATURE_HISTORY, FRAME_BINARY, FRAME_TEXT, decode_binary_chunk,
+                      read_frames, send_binary_chunk, send_json)
 
 def discover_server(timeout=5):
     """
@@ -60,6 +63,7 @@ class ChatClientGUI:
         self.file_button = None
         self.private_button = None
         self.refresh_button = None
+        self.history_button = None
         
         # Controles de estado
         self.running = True
@@ -72,8 +76,18 @@ class ChatClientGUI:
         self.waiting_for_file_decision = False
         self.pending_file_data = None
         
-        # Socket do cliente
+        # Transferências em streaming
+        self.transfer_ids = itertools.count(1)
+        self.incoming_transfers = {}  # id -> {"sender", "filename", "size", "path", "file"}
+        self.server_features = set()  # Recursos confirmados pelo servidor (ex: FEATURE_BINARY)
+        
+        # Paginação do histórico global
+        self.history_before = None    # Seq da mensagem mais antiga já exibida
+        self.history_has_more = False
+        
+        # Socket do cliente (send_lock evita frames intercalados entre threads)
         self.client = None
+        self.send_lock = threading.Lock()
         
         # Inicializar GUI
         self.create_gui()
@@ -115,6 +129,15 @@ class ChatClientGUI:
                           bg="#34495e", fg="#ecf0f1")
         chat_label.pack(pady=10)
         
+        # Botão para carregar mensagens mais antigas do histórico
+        self.history_button = Button(chat_frame, text="⬆️ Mensagens anteriores", 
+                                    command=self.request_older_history,
+                                    font=("Arial", 9),
+                                    bg="#7f8c8d", fg="white",
+                                    relief="flat",
+                                    state=DISABLED)
+        self.history_button.pack(pady=(0, 5))
+        
         self.chat_text = scrolledtext.ScrolledText(
             chat_frame, 
             height=20, 
@@ -234,6 +257,54 @@ class ChatClientGUI:
         
         self.window.after(0, _update)
         
+    def show_history_page(self, history_page):
+        """
+        Exibe uma página do histórico global
+        - A primeira página (ao entrar) vai para o fim do chat
+        - Páginas anteriores são inseridas no topo, acima do que já está visível
+        """
+        first_page = self.history_before is None
+        messages = history_page.get("messages", [])
+        if messages:
+            self.history_before = history_page.get("before")
+        self.history_has_more = history_page.get("has_more", False)
+        
+        lines = []
+        for item in messages:
+            timestamp = datetime.datetime.fromtimestamp(item["time"]).strftime("%H:%M:%S")
+            lines.append(f"[{timestamp}] {item['text']}\n")
+        text = "".join(lines)
+        
+        def _update():
+            try:
+                self.chat_text.config(state=NORMAL)
+                if first_page:
+                    self.chat_text.insert(END, text, "history")
+                    self.chat_text.see(END)
+                else:
+                    self.chat_text.insert("1.0", text, "history")
+                    self.chat_text.see("1.0")
+                self.chat_text.tag_config("history", foreground="#95a5a6")
+                self.chat_text.config(state=DISABLED)
+                self.history_button.config(state=NORMAL if self.history_has_more else DISABLED)
+            except:
+                pass
+        
+        self.window.after(0, _update)
+        
+    def request_older_history(self):
+        """Pede ao servidor a página de mensagens anterior à mais antiga exibida"""
+        if not self.name_registered or not self.history_has_more:
+            return
+            
+        try:
+            message_formatted = {"type": "history", "control": "dontcare", "message": "dontcare",
+                                 "before": self.history_before}
+            self.send_to_server(message_formatted)
+            self.history_button.config(state=DISABLED)
+        except Exception as e:
+            messagebox.showerror("Erro", f"Erro ao buscar histórico: {e}")
+        
     def update_status(self, status, color="#e74c3c"):
         """Atualiza o status de conexão"""
         def _update():
@@ -300,6 +371,21 @@ class ChatClientGUI:
         """Evento de Ctrl+Enter para mensagem privada"""
         self.send_private_message()
         
+    def send_to_server(self, message_formatted):
+        """Envia um dicionario ao servidor (seguro para chamar de qualquer thread)"""
+        with self.send_lock:
+            send_json(self.client, message_formatted)
+            
+    def send_file_chunk(self, transfer_id, chunk):
+        """Envia um pedaço de arquivo: bytes crus se o servidor aceitar, senão base64 em JSON"""
+        if FEATURE_BINARY in self.server_features:
+            with self.send_lock:
+                send_binary_chunk(self.client, transfer_id, chunk)
+        else:
+            data = base64.b64encode(chunk).decode('utf-8')
+            self.send_to_server({"type": "file_chunk", "control": "dontcare", "message": data,
+                                 "transfer_id": transfer_id})
+            
     def send_message(self):
         """Envia mensagem global"""
         if not self.name_registered:
@@ -312,7 +398,7 @@ class ChatClientGUI:
             
         try:
             message_formatted = {"type": "msg", "control": "4all", "message": message}
-            self.client.send(json.dumps(message_formatted).encode('utf-8'))
+            self.send_to_server(message_formatted)
             self.message_entry.delete(0, END)
             self.log_message(f"[Você → todos]: {message}", "#27ae60")
         except Exception as e:
@@ -343,7 +429,7 @@ class ChatClientGUI:
             
         try:
             message_formatted = {"type": "msg", "control": target_user, "message": message}
-            self.client.send(json.dumps(message_formatted).encode('utf-8'))
+            self.send_to_server(message_formatted)
             self.log_message(f"[Você → {target_user}]: {message}", "#9b59b6")
         except Exception as e:
             messagebox.showerror("Erro", f"Erro ao enviar mensagem privada: {e}")
@@ -368,12 +454,12 @@ class ChatClientGUI:
         if not filepath or not os.path.isfile(filepath):
             return
             
-        # Verificar tamanho
+        # Verificar tamanho (o envio é em streaming, então o limite é só um aviso)
         size = os.path.getsize(filepath)
-        if size > 10 * 1024 * 1024:  # 10MB
+        if size > 100 * 1024 * 1024:  # 100MB
             if not messagebox.askyesno("Arquivo Grande", 
                                      f"Arquivo muito grande ({size/1024/1024:.1f}MB).\n"
-                                     "Máximo recomendado: 10MB\n"
+                                     "Máximo recomendado: 100MB\n"
                                      "Continuar mesmo assim?"):
                 return
                 
@@ -385,31 +471,48 @@ class ChatClientGUI:
             
         filename = os.path.basename(filepath)
         
+        if choice:  # Global
+            target_user = "4all"
+            self.log_message(f"[Você → todos]: 📎 {filename} ({size/1024:.1f}KB)", "#3498db")
+        else:  # Privado
+            target_user = self.get_selected_user()
+            if target_user is None:
+                target_user = simpledialog.askstring("Arquivo Privado", 
+                                                   "Digite o nome do destinatário:")
+                if not target_user:
+                    return
+                    
+            self.log_message(f"[Você → {target_user}]: 📎 {filename} ({size/1024:.1f}KB)", "#3498db")
+            
+        # Enviar em segundo plano para não travar a interface
+        upload_thread = threading.Thread(target=self.stream_file,
+                                         args=(filepath, filename, size, target_user),
+                                         daemon=True)
+        upload_thread.start()
+            
+    def stream_file(self, filepath, filename, size, target_user):
+        """
+        Envia um arquivo em streaming: file_start, vários file_chunk e file_end
+        - Lê CHUNK_SIZE bytes por vez, então a memória usada não depende do tamanho do arquivo
+        """
+        transfer_id = next(self.transfer_ids)
         try:
-            # Codificar arquivo
+            self.send_to_server({"type": "file_start", "control": target_user, "message": "dontcare",
+                                 "filename": filename, "size": size, "transfer_id": transfer_id})
+            
             with open(filepath, "rb") as file:
-                data = base64.b64encode(file.read()).decode('utf-8')
-                
-            if choice:  # Global
-                message_formatted = {"type": "file", "control": "4all", 
-                                   "message": data, "filename": filename}
-                self.log_message(f"[Você → todos]: 📎 {filename} ({size/1024:.1f}KB)", "#3498db")
-            else:  # Privado
-                target_user = self.get_selected_user()
-                if target_user is None:
-                    target_user = simpledialog.askstring("Arquivo Privado", 
-                                                       "Digite o nome do destinatário:")
-                    if not target_user:
-                        return
-                        
-                message_formatted = {"type": "file", "control": target_user, 
-                                   "message": data, "filename": filename}
-                self.log_message(f"[Você → {target_user}]: 📎 {filename} ({size/1024:.1f}KB)", "#3498db")
-                
-            self.client.send(json.dumps(message_formatted).encode('utf-8'))
+                while self.running:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.send_file_chunk(transfer_id, chunk)
+                    
+            self.send_to_server({"type": "file_end", "control": "dontcare", "message": "dontcare",
+                                 "transfer_id": transfer_id})
+            self.log_message(f"✅ Arquivo enviado: {filename}", "#3498db")
             
         except Exception as e:
-            messagebox.showerror("Erro", f"Erro ao enviar arquivo: {e}")
+            self.log_message(f"❌ Erro ao enviar arquivo: {e}", "#e74c3c")
             
     def refresh_users(self):
         """Solicita lista atualizada de usuários"""
@@ -418,10 +521,107 @@ class ChatClientGUI:
             
         try:
             message_formatted = {"type": "online_usr", "control": "dontcare", "message": "dontcare"}
-            self.client.send(json.dumps(message_formatted).encode('utf-8'))
+            self.send_to_server(message_formatted)
         except Exception as e:
             messagebox.showerror("Erro", f"Erro ao buscar usuários: {e}")
             
+    def unique_download_path(self, filename):
+        """Retorna um caminho livre em downloads/ (sem sobrescrever arquivos)"""
+        # Criar diretório downloads se não existir
+        if not os.path.exists("downloads"):
+            os.makedirs("downloads")
+            
+        # Evitar sobrescrever arquivos
+        filename = os.path.basename(filename)
+        base_name = os.path.splitext(filename)[0]
+        extension = os.path.splitext(filename)[1]
+        counter = 1
+        new_filename = filename
+        
+        while os.path.exists(os.path.join("downloads", new_filename)):
+            new_filename = f"{base_name}_{counter}{extension}"
+            counter += 1
+            
+        return os.path.join("downloads", new_filename)
+        
+    def process_streamed_file(self, sender, filename, part_path, file_size):
+        """Pergunta se o arquivo recebido em streaming (já salvo em .part) deve ser mantido"""
+        result = messagebox.askyesnocancel("Arquivo Recebido", 
+                                         f"📎 Arquivo recebido de {sender}\n"
+                                         f"📄 Nome: {filename}\n"
+                                         f"📊 Tamanho: {file_size/1024:.1f}KB\n\n"
+                                         f"Deseja baixar o arquivo?")
+        
+        try:
+            if result:  # Sim - manter
+                filepath = self.unique_download_path(filename)
+                os.replace(part_path, filepath)
+                actual_size = os.path.getsize(filepath)
+                self.log_message(f"✅ Arquivo baixado: {os.path.basename(filepath)} ({actual_size/1024:.1f}KB)", "#27ae60")
+                messagebox.showinfo("Sucesso", f"Arquivo salvo em:\n{filepath}")
+            else:
+                os.remove(part_path)
+                self.log_message(f"📎 Arquivo de {sender} ignorado: {filename}", "#95a5a6")
+        except Exception as e:
+            self.log_message(f"❌ Erro ao baixar arquivo: {e}", "#e74c3c")
+            messagebox.showerror("Erro", f"Erro ao baixar arquivo: {e}")
+            
+    def handle_file_stream(self, key, value):
+        """
+        Processa os frames de uma transferência em streaming
+        - file_start: cria um arquivo temporário .part em downloads/
+        - file_chunk: grava o pedaço (base64) direto no disco
+        - file_binary: igual a file_chunk, mas recebido em FRAME_BINARY (bytes crus)
+        - file_end: fecha o arquivo e pergunta ao usuário se deseja mantê-lo
+        - file_abort: descarta o arquivo parcial
+        """
+        if key == "file_start":
+            transfer_id, sender, filename, size = value.split("||", 3)
+            transfer_id = int(transfer_id)
+            part_path = self.unique_download_path(f".{transfer_id}_{os.path.basename(filename)}.part")
+            self.incoming_transfers[transfer_id] = {
+                "sender": sender,
+                "filename": filename,
+                "size": int(size),
+                "path": part_path,
+                "file": open(part_path, "wb")
+            }
+            self.log_message(f"📎 Recebendo arquivo de {sender}: {filename} ({int(size)/1024:.1f}KB)", "#3498db")
+            return
+            
+        if key == "file_chunk":
+            transfer_id, data = value.split("||", 1)
+            data = base64.b64decode(data)
+        elif key == "file_binary":
+            transfer_id, data = value
+        else:
+            transfer_id = value
+            
+        transfer = self.incoming_transfers.get(int(transfer_id))
+        if transfer is None:
+            return
+            
+        if key in ("file_chunk", "file_binary"):
+            transfer["file"].write(data)
+        elif key == "file_end":
+            del self.incoming_transfers[int(transfer_id)]
+            transfer["file"].close()
+            received = os.path.getsize(transfer["path"])
+            if received != transfer["size"]:
+                # O servidor pode descartar pedacos quando o cliente fica para tras
+                os.remove(transfer["path"])
+                self.log_message(f"❌ {transfer['filename']} de {transfer['sender']} chegou incompleto "
+                                 f"({received/1024:.1f}KB de {transfer['size']/1024:.1f}KB)", "#e74c3c")
+                return
+            # Processar arquivo na thread principal
+            self.window.after(0, self.process_streamed_file, transfer["sender"], transfer["filename"],
+                              transfer["path"], received)
+        elif key == "file_abort":
+            del self.incoming_transfers[int(transfer_id)]
+            transfer["file"].close()
+            os.remove(transfer["path"])
+            self.log_message(f"❌ Envio de {transfer['filename']} por {transfer['sender']} foi interrompido", "#e74c3c")
+            
     def process_file_offer(self, sender, filename, b64data, file_size):
         """Processa oferta de arquivo recebido"""
         result = messagebox.askyesnocancel("Arquivo Recebido", 
@@ -432,21 +632,8 @@ class ChatClientGUI:
         
         if result:  # Sim - baixar
             try:
-                # Criar diretório downloads se não existir
-                if not os.path.exists("downloads"):
-                    os.makedirs("downloads")
-                    
-                # Evitar sobrescrever arquivos
-                base_name = os.path.splitext(filename)[0]
-                extension = os.path.splitext(filename)[1]
-                counter = 1
-                new_filename = filename
-                
-                while os.path.exists(os.path.join("downloads", new_filename)):
-                    new_filename = f"{base_name}_{counter}{extension}"
-                    counter += 1
-                    
-                filepath = os.path.join("downloads", new_filename)
+                filepath = self.unique_download_path(filename)
+                new_filename = os.path.basename(filepath)
                 
                 # Salvar arquivo
                 with open(filepath, "wb") as f:
@@ -464,12 +651,22 @@ class ChatClientGUI:
             
     def handle_messages(self):
         """Thread para receber mensagens do servidor"""
-        while self.running:
-            try:
-                msg = self.client.recv(2048 * 10).decode('utf-8')
-                if not msg:
+        try:
+            # Cada frame de texto contem exatamente uma mensagem "chave=valor"
+            for frame_type, payload in read_frames(self.client):
+                if not self.running:
                     break
-                    
+                if frame_type == FRAME_BINARY:
+                    # Pedaço de arquivo em bytes crus (recurso negociado no login)
+                    try:
+                        self.handle_file_stream("file_binary", decode_binary_chunk(payload))
+                    except Exception as e:
+                        self.log_message(f"❌ Erro ao receber arquivo: {e}", "#e74c3c")
+                    continue
+                if frame_type != FRAME_TEXT:
+                    continue
+
+                msg = payload.decode('utf-8')
                 key, value = msg.split("=", 1)
                 
                 if key == "msg":
@@ -492,6 +689,16 @@ class ChatClientGUI:
                     else:
                         self.log_message(value, "#ecf0f1")
                         
+                elif key == "features":
+                    # Recursos do protocolo aceitos pelo servidor
+                    self.server_features = set(json.loads(value))
+                        
+                elif key == "history":
+                    # Página do histórico global (recurso FEATURE_HISTORY)
+                    history_page = json.loads(value)
+                    if history_page.get("control", "4all") == "4all":
+                        self.show_history_page(history_page)
+                        
                 elif key == "online_users":
                     # Processar lista de usuários
                     try:
@@ -510,14 +717,20 @@ class ChatClientGUI:
                         self.log_message(f"📎 Arquivo recebido de {sender}: {filename}", "#3498db")
                         
                         # Processar arquivo na thread principal
-                        self.window.after(0, lambda: self.process_file_offer(sender, filename, b64data, file_size))
+                        self.window.after(0, self.process_file_offer, sender, filename, b64data, file_size)
                     else:
                         self.log_message("❌ Arquivo recebido em formato inválido", "#e74c3c")
                         
-            except Exception as e:
-                if self.running:
-                    self.log_message(f"❌ Erro ao receber mensagem: {e}", "#e74c3c")
-                break
+                elif key in ("file_start", "file_chunk", "file_end", "file_abort"):
+                    # Processar arquivo recebido em streaming
+                    try:
+                        self.handle_file_stream(key, value)
+                    except Exception as e:
+                        self.log_message(f"❌ Erro ao receber arquivo: {e}", "#e74c3c")
+                        
+        except Exception as e:
+            if self.running:
+                self.log_message(f"❌ Erro ao receber mensagem: {e}", "#e74c3c")
                 
     def request_name(self):
         """Solicita nome do usuário"""
@@ -537,8 +750,9 @@ class ChatClientGUI:
                 continue
                 
             try:
-                message_formatted = {"type": "name", "control": "dontcare", "message": name}
-                self.client.send(json.dumps(message_formatted).encode('utf-8'))
+                message_formatted = {"type": "name", "control": "dontcare", "message": name,
+                                     "features": [FEATURE_BINARY, FEATURE_HISTORY]}
+                self.send_to_server(message_formatted)
                 self.current_user = name
                 time.sleep(1)  # Aguardar resposta
             except Exception as e:
@@ -553,8 +767,9 @@ class ChatClientGUI:
                                         parent=self.window)
             if name:
                 try:
-                    message_formatted = {"type": "name", "control": "dontcare", "message": name}
-                    self.client.send(json.dumps(message_formatted).encode('utf-8'))
+                    message_formatted = {"type": "name", "control": "dontcare", "message": name,
+                                         "features": [FEATURE_BINARY, FEATURE_HISTORY]}
+                    self.send_to_server(message_formatted)
                     self.current_user = name
                 except Exception as e:
                     messagebox.showerror("Erro", f"Erro ao enviar nome: {e}")
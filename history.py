@@ -0,0 +1,220 @@
+#history.py
+
+import itertools
+import threading
+import time
+from collections import deque
+
+MESSAGE_OVERHEAD = 200 # Estimativa (bytes) do custo fixo de cada registro em memoria
+
+def message_size(message):
+    """
+    Estima quantos bytes um registro de mensagem ocupa em memoria
+    - Soma o tamanho dos campos de texto (conteudo, nome do arquivo, ...)
+    - Acrescenta um custo fixo pelo proprio dicionario
+    """
+    size = MESSAGE_OVERHEAD
+    for value in message.values():
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+    return size
+
+class MessageHistory:
+    """
+    Historico de mensagens com limites de memoria
+    - max_messages: quantidade maxima de mensagens guardadas
+    - max_bytes: total maximo de bytes (estimado por message_size)
+    - max_age: idade maxima em segundos
+    Qualquer limite pode ser None (sem limite). Ao ultrapassar um limite,
+    as mensagens mais antigas sao descartadas primeiro. A mensagem mais
+    recente nunca e descartada por quantidade ou bytes, pois o servidor
+    ainda precisa entrega-la aos destinatarios.
+    index_key (opcional) agrupa as mensagens em conversas: funcao que recebe
+    a mensagem e retorna a chave (ex: (remetente, destinatario)). Com ela,
+    last(chave) e page(..., chave) nao precisam percorrer o historico todo.
+    on_discard (opcional) e chamado com cada mensagem descartada de vez (sem
+    log anexado), para liberar recursos associados a ela (ex: anexos).
+    Com um MessageLog anexado (attach_log), toda mensagem tambem e gravada em
+    disco e page() sem chave busca no log as paginas que ja sairam da memoria
+    (ou que sao de antes de reiniciar o servidor).
+    Seguro para uso por varias threads.
+    """
+    def __init__(self, max_messages=None, max_bytes=None, max_age=None, index_key=None, on_discard=None):
+        self.lock = threading.Lock()
+        self.entries = deque()  # [(timestamp, tamanho, seq, mensagem), ...] do mais antigo ao mais novo
+        self.next_seq = 1       # Numero de sequencia da proxima mensagem (usado na paginacao)
+        self.index_key = index_key
+        self.on_discard = on_discard
+        self.index = {}         # chave -> deque com as entradas daquela conversa (mesma ordem)
+        self.total_bytes = 0
+        self.log = None         # MessageLog opcional (persistencia em disco)
+        self.evicted = {"count": 0, "bytes": 0, "age": 0}  # Descartes por motivo
+        self.configure(max_messages, max_bytes, max_age)
+
+    def configure(self, max_messages=None, max_bytes=None, max_age=None):
+        """Altera os limites e aplica o descarte imediatamente"""
+        with self.lock:
+            self.max_messages = max_messages
+            self.max_bytes = max_bytes
+            self.max_age = max_age
+            self._evict(time.time())
+
+    def attach_log(self, log, preload=False):
+        """
+        Anexa um log em disco: as proximas mensagens sao gravadas nele e a
+        numeracao continua de onde o log parou
+        - preload: carrega as mensagens mais recentes do log para a memoria
+          (respeitando os limites), necessario para consultas por conversa
+        """
+        with self.lock:
+            self.log = log
+            self.next_seq = max(self.next_seq, log.next_seq)
+            if preload:
+                count = self.max_messages if self.max_messages is not None else log.next_seq
+                recent, _ = log.page(None, count)
+                for seq, timestamp, message in recent:
+                    self._insert((timestamp, message_size(message), seq, message))
+                self._evict(time.time())
+
+    def append(self, message):
+        """
+        Adiciona uma mensagem ao final do historico e aplica os limites
+        Retorna o numero de sequencia atribuido a mensagem
+        """
+        now = time.time()
+        size = message_size(message)
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            if self.log is not None:
+                self.log.append(seq, now, message)
+            self._insert((now, size, seq, message))
+            self._evict(now)
+        return seq
+
+    def _insert(self, entry):
+        """Coloca a entrada no final do historico e do indice (com o lock adquirido)"""
+        self.entries.append(entry)
+        if self.index_key is not None:
+            key = self.index_key(entry[3])
+            conversation = self.index.get(key)
+            if conversation is None:
+                conversation = self.index[key] = deque()
+            conversation.append(entry)
+        self.total_bytes += entry[1]
+
+    def _evict(self, now):
+        """Remove mensagens antigas ate respeitar todos os limites (com o lock adquirido)"""
+        if self.max_age is not None:
+            while self.entries and now - self.entries[0][0] > self.max_age:
+                self._pop_oldest("age")
+        if self.max_messages is not None:
+            while len(self.entries) > max(self.max_messages, 1):
+                self._pop_oldest("count")
+        if self.max_bytes is not None:
+            while len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+                self._pop_oldest("bytes")
+
+    def _pop_oldest(self, reason):
+        _, size, _, message = self.entries.popleft()
+        self.total_bytes -= size
+        if self.index_key is not None:
+            # A entrada mais antiga do historico e tambem a mais antiga da sua conversa
+            key = self.index_key(message)
+            conversation = self.index[key]
+            conversation.popleft()
+            if not conversation:
+                del self.index[key]
+        self.evicted[reason] += 1
+        if self.on_discard is not None and self.log is None:
+            # Com log anexado a mensagem continua em disco: quem libera e o log
+            self.on_discard(message)
+
+    def snapshot(self):
+        """Copia da lista de mensagens atuais (do mais antigo ao mais novo)"""
+        with self.lock:
+            self._evict(time.time())
+            return [message for _, _, _, message in self.entries]
+
+    def page(self, before=None, limit=50, key=None):
+        """
+        Retorna uma pagina do historico, sem copiar o restante
+        - before: numero de sequencia limite (exclusivo); None = a partir da mais recente
+        - limit: quantidade maxima de mensagens na pagina
+        - key: pagina apenas da conversa indicada (requer index_key)
+        - Sem key e com log anexado, paginas que comecam antes da mensagem mais
+          antiga em memoria sao lidas do disco
+        - Retorna ([(seq, timestamp, mensagem), ...] em ordem cronologica, ha_mais_antigas)
+        """
+        with self.lock:
+            self._evict(time.time())
+            if key is None and self.log is not None:
+                first_in_memory = self.entries[0][2] if self.entries else self.next_seq
+                end = self.next_seq if before is None else min(before, self.next_seq)
+                if end - limit < first_in_memory and self.log.first_seq < first_in_memory:
+                    return self.log.page(end, limit)
+            entries = self.entries if key is None else self.index.get(key)
+            if not entries:
+                return [], False
+
+            if before is None:
+                end = len(entries)
+            elif key is None:
+                # Os numeros de sequencia sao consecutivos, entao a posicao e calculada direto
+                end = max(0, min(len(entries), before - entries[0][2]))
+            else:
+                end = self._position(entries, before)
+            start = max(0, end - limit)
+            page = [(seq, timestamp, message)
+                    for timestamp, _, seq, message in self._slice(entries, start, end)]
+            return page, start > 0
+
+    @staticmethod
+    def _slice(entries, start, end):
+        """
+        Entradas [start, end) de uma deque, percorrendo a partir da ponta mais proxima
+        (islice comeca sempre do inicio: paginas recentes custariam O(tamanho do historico))
+        """
+        if start < len(entries) - end:
+            return itertools.islice(entries, start, end)
+        tail = list(itertools.islice(reversed(entries), len(entries) - end, len(entries) - start))
+        tail.reverse()
+        return tail
+
+    @staticmethod
+    def _position(entries, seq):
+        """Busca binaria: posicao da primeira entrada com numero de sequencia >= seq"""
+        low, high = 0, len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if entries[middle][2] < seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def last(self, key=None):
+        """Ultima mensagem do historico (ou da conversa indicada) ou None se nao houver"""
+        with self.lock:
+            entries = self.entries if key is None else self.index.get(key)
+            if not entries:
+                return None
+            return entries[-1][3]
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Estatisticas de uso: quantidade, bytes em memoria e descartes por motivo"""
+        with self.lock:
+            return {
+                "messages": len(self.entries),
+                "bytes": self.total_bytes,
+                "conversations": len(self.index),
+                "evicted_count": self.evicted["count"],
+                "evicted_bytes": self.evicted["bytes"],
+                "evicted_age": self.evicted["age"]
+            }
@@ -0,0 +1,363 @@
+#message_log.py
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# FORMATO DO LOG EM DISCO (um diretorio por historico):
+#
+# 00000000000000000001.log   registros, apenas acrescentados ao final
+# 00000000000000000001.idx   indice: posicao (uint64 little-endian) de cada registro
+#
+# Cada segmento e nomeado pelo numero de sequencia do seu primeiro registro.
+# Ao passar de segment_max_bytes, um novo segmento e aberto.
+#
+# Registro: +---------------+--------------+------------+------------------+---------+
+#           | tamanho (u32) | crc32 (u32)  | seq (u64)  | timestamp (f64)  | payload |
+#           +---------------+--------------+------------+------------------+---------+
+# - payload: mensagem em JSON (utf-8), o mesmo dicionario guardado no historico
+# - crc32 do payload: detecta registros cortados por uma queda no meio da escrita
+
+FORMAT = 'utf-8'
+RECORD_HEADER = struct.Struct("!IIQd")  # tamanho, crc32, seq, timestamp
+INDEX_ENTRY_SIZE = 8                    # uint64 por registro no .idx
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024    # Tamanho maximo de cada segmento (64MB)
+FSYNC_INTERVAL = 1.0                    # Segundos entre cada fsync (0 = apenas ao fechar)
+
+class Segment:
+    """Um segmento do log: arquivo de registros (.log) e indice de posicoes (.idx)"""
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = base + ".log"
+        self.idx_path = base + ".idx"
+        self.offsets = array.array("Q") # Posicao de cada registro no .log
+        self.size = 0                   # Bytes validos no .log
+        self.map = None                 # mmap somente leitura (criado na primeira leitura)
+        self.mapped_size = 0
+
+    @property
+    def next_seq(self):
+        return self.first_seq + len(self.offsets)
+
+    def view(self):
+        """mmap do segmento, refeito quando o arquivo cresceu desde o ultimo mapeamento"""
+        if self.map is None or self.mapped_size < self.size:
+            self.unmap()
+            with open(self.log_path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_size = len(self.map)
+        return self.map
+
+    def unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.mapped_size = 0
+
+def _index_to_bytes(offsets):
+    if sys.byteorder == "big":
+        offsets = array.array("Q", offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+def _index_from_bytes(data):
+    offsets = array.array("Q")
+    offsets.frombytes(data[:len(data) - len(data) % INDEX_ENTRY_SIZE])
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return offsets
+
+class MessageLog:
+    """
+    Log de mensagens em disco, segmentado e somente de acrescimo
+    - append() grava o registro no segmento ativo; o fsync acontece no maximo
+      a cada fsync_interval segundos (thread propria) e ao fechar
+    - O indice (.idx) guarda a posicao de cada registro: ler a mensagem N e
+      uma busca no array de posicoes e um unpack no mmap, sem varrer o arquivo
+    - page() le os segmentos via mmap e decodifica apenas as mensagens da pagina;
+      scan() percorre todos os registros (ex: recontar referencias ao abrir)
+    - Ao abrir, registros cortados no fim do ultimo segmento (queda durante a
+      escrita) sao descartados e o indice e reconstruido se estiver atrasado
+    - max_segments (opcional) apaga os segmentos mais antigos; on_discard(mensagem)
+      e chamado para cada mensagem apagada (ex: liberar anexos)
+    on_error(mensagem) e chamado quando uma escrita falha (ex: disco cheio);
+    o chat continua funcionando apenas em memoria.
+    Seguro para uso por varias threads.
+    """
+    def __init__(self, directory, segment_max_bytes=SEGMENT_MAX_BYTES,
+                 fsync_interval=FSYNC_INTERVAL, max_segments=None, on_error=None, on_discard=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval = fsync_interval
+        self.max_segments = max_segments
+        self.on_error = on_error
+        self.on_discard = on_discard
+        self.lock = threading.Lock()
+        self.segments = []       # Do mais antigo ao mais novo
+        self.first_seqs = []     # first_seq de cada segmento (busca binaria)
+        self.log_file = None     # Arquivos abertos do segmento ativo
+        self.idx_file = None
+        self.unflushed = False   # Dados no buffer do Python ainda nao entregues ao SO
+        self.unsynced = False    # Dados entregues ao SO ainda sem fsync
+        self.recovered_bytes = 0 # Bytes descartados na recuperacao (registros cortados)
+        self.write_errors = 0
+        self.closed = False
+        self._open_segments()
+
+        self.stop_event = threading.Event()
+        if fsync_interval:
+            threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    # ---------- Abertura e recuperacao ----------
+
+    def _open_segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        for position, name in enumerate(names):
+            try:
+                first_seq = int(name[:-4])
+            except ValueError:
+                continue
+            segment = Segment(self.directory, first_seq)
+            self._load_segment(segment, is_last=position == len(names) - 1)
+            self.segments.append(segment)
+            self.first_seqs.append(first_seq)
+
+    def _load_segment(self, segment, is_last):
+        """Carrega o indice do segmento e confere os registros que o indice ainda nao cobre"""
+        segment.size = os.path.getsize(segment.log_path)
+        indexed = 0
+        if os.path.exists(segment.idx_path):
+            with open(segment.idx_path, "rb") as f:
+                segment.offsets = _index_from_bytes(f.read())
+            indexed = len(segment.offsets)
+
+        with open(segment.log_path, "rb") as f:
+            # Entradas do indice que apontam para alem do arquivo sao descartadas
+            offset = 0
+            while segment.offsets:
+                if segment.offsets[-1] + RECORD_HEADER.size <= segment.size:
+                    f.seek(segment.offsets[-1])
+                    length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))[0]
+                    offset = segment.offsets[-1] + RECORD_HEADER.size + length
+                    if offset <= segment.size:
+                        break
+                segment.offsets.pop()
+                offset = 0
+            f.seek(offset)
+            tail = f.read()
+
+        # Varre os registros depois do ultimo indexado (o indice pode estar atrasado)
+        position = 0
+        while len(tail) - position >= RECORD_HEADER.size:
+            length, crc, seq, _ = RECORD_HEADER.unpack_from(tail, position)
+            end = position + RECORD_HEADER.size + length
+            if end > len(tail) or seq != segment.next_seq or \
+                    zlib.crc32(tail[position + RECORD_HEADER.size:end]) != crc:
+                break
+            segment.offsets.append(offset + position)
+            position = end
+
+        valid_size = offset + position
+        if valid_size < segment.size:
+            self.recovered_bytes += segment.size - valid_size
+            if is_last:
+                with open(segment.log_path, "r+b") as f:
+                    f.truncate(valid_size)
+        segment.size = valid_size
+
+        if len(segment.offsets) != indexed:
+            with open(segment.idx_path, "wb") as f:
+                f.write(_index_to_bytes(segment.offsets))
+
+    def _open_active(self):
+        segment = self.segments[-1]
+        self.log_file = open(segment.log_path, "ab")
+        self.idx_file = open(segment.idx_path, "ab")
+
+    def _roll(self, first_seq):
+        """Fecha o segmento ativo e abre um novo comecando em first_seq"""
+        self._close_active()
+        segment = Segment(self.directory, first_seq)
+        self.segments.append(segment)
+        self.first_seqs.append(first_seq)
+        self._open_active()
+
+        if self.max_segments is not None:
+            while len(self.segments) > max(self.max_segments, 1):
+                oldest = self.segments[0]
+                if self.on_discard is not None:
+                    for seq in range(oldest.first_seq, oldest.next_seq):
+                        record = self._read(seq)
+                        if record is not None:
+                            self.on_discard(record[2])
+                self.segments.pop(0)
+                self.first_seqs.pop(0)
+                oldest.unmap()
+                for path in (oldest.log_path, oldest.idx_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _close_active(self):
+        if self.log_file is None:
+            return
+        self._flush()
+        self._fsync()
+        self.log_file.close()
+        self.idx_file.close()
+        self.log_file = self.idx_file = None
+
+    # ---------- Escrita ----------
+
+    @property
+    def first_seq(self):
+        return self.segments[0].first_seq if self.segments else 1
+
+    @property
+    def next_seq(self):
+        """Numero de sequencia seguinte ao ultimo registro gravado"""
+        return self.segments[-1].next_seq if self.segments else 1
+
+    def append(self, seq, timestamp, message):
+        """
+        Acrescenta uma mensagem ao log
+        - seq deve ser maior que o ultimo gravado (lacunas sao permitidas)
+        - Retorna False se a escrita falhou (o erro e repassado a on_error)
+        """
+        payload = json.dumps(message, ensure_ascii=False).encode(FORMAT)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq, timestamp) + payload
+        with self.lock:
+            if self.closed:
+                return False
+            try:
+                active = self.segments[-1] if self.segments else None
+                if active is None or seq != active.next_seq or \
+                        (active.size and active.size + len(record) > self.segment_max_bytes):
+                    self._roll(seq)
+                    active = self.segments[-1]
+                elif self.log_file is None:
+                    self._open_active()
+
+                self.log_file.write(record)
+                self.idx_file.write(_index_to_bytes(array.array("Q", (active.size,))))
+                active.offsets.append(active.size)
+                active.size += len(record)
+                self.unflushed = True
+                return True
+            except OSError as e:
+                self.write_errors += 1
+                if self.on_error is not None:
+                    self.on_error(f"Falha ao gravar mensagem {seq} no log: {e}")
+                return False
+
+    def _flush(self):
+        if self.unflushed and self.log_file is not None:
+            self.log_file.flush()
+            self.idx_file.flush()
+            self.unflushed = False
+            self.unsynced = True
+
+    def _fsync(self):
+        if self.unsynced and self.log_file is not None:
+            os.fsync(self.log_file.fileno())
+            os.fsync(self.idx_file.fileno())
+            self.unsynced = False
+
+    def sync(self):
+        """Entrega ao SO e forca para o disco tudo o que foi gravado ate agora"""
+        with self.lock:
+            try:
+                self._flush()
+                self._fsync()
+            except OSError as e:
+                self.write_errors += 1
+                if self.on_error is not None:
+                    self.on_error(f"Falha ao sincronizar o log: {e}")
+
+    def _sync_loop(self):
+        """Thread de fsync periodico: limita a perda em uma queda a fsync_interval segundos"""
+        while not self.stop_event.wait(self.fsync_interval):
+            self.sync()
+
+    # ---------- Leitura ----------
+
+    def _read(self, seq):
+        """Le o registro seq via mmap; None se nao existir (lacuna ou segmento apagado)"""
+        position = bisect.bisect_right(self.first_seqs, seq) - 1
+        if position < 0:
+            return None
+        segment = self.segments[position]
+        index = seq - segment.first_seq
+        if index >= len(segment.offsets):
+            return None
+        view = segment.view()
+        offset = segment.offsets[index]
+        length, _, record_seq, timestamp = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size
+        return record_seq, timestamp, json.loads(view[start:start + length])
+
+    def page(self, before=None, limit=50):
+        """
+        Mesma interface de MessageHistory.page, lida do disco
+        - Retorna ([(seq, timestamp, mensagem), ...] em ordem cronologica, ha_mais_antigas)
+        """
+        with self.lock:
+            if not self.segments:
+                return [], False
+            self._flush() # O mmap enxerga apenas o que ja foi entregue ao SO
+            first = self.first_seq
+            end = self.next_seq if before is None else max(first, min(before, self.next_seq))
+            start = max(first, end - limit)
+            page = []
+            for seq in range(start, end):
+                record = self._read(seq)
+                if record is not None:
+                    page.append(record)
+            return page, start > first
+
+    def scan(self):
+        """Gera todos os registros ainda em disco, do mais antigo ao mais novo: (seq, timestamp, mensagem)"""
+        with self.lock:
+            self._flush()
+            first, end = self.first_seq, self.next_seq
+        for seq in range(first, end):
+            with self.lock:
+                record = self._read(seq)
+            if record is not None:
+                yield record
+
+    def stats(self):
+        """Estatisticas do log: segmentos, registros e bytes em disco"""
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "records": sum(len(segment.offsets) for segment in self.segments),
+                "bytes": sum(segment.size for segment in self.segments),
+                "recovered_bytes": self.recovered_bytes,
+                "write_errors": self.write_errors
+            }
+
+    def close(self):
+        """Grava o que estiver pendente, faz fsync e libera arquivos e mapeamentos"""
+        self.stop_event.set()
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self._close_active()
+            except OSError as e:
+                self.write_errors += 1
+                if self.on_error is not None:
+                    self.on_error(f"Falha ao fechar o log: {e}")
+            for segment in self.segments:
+                segment.unmap()
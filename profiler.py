@@ -0,0 +1,311 @@
+#profiler.py
+
+import argparse
+import collections
+import datetime
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+# MODO DE PERFIL DO SERVIDOR (CPU + MEMORIA), SEM DEPURADOR:
+#
+# - CPU: uma thread amostra a pilha de todas as threads a cada intervalo
+#   (sys._current_frames). Onde o SO informa o tempo de CPU por thread
+#   (pthread_getcpuclockid), so contam as threads que usaram CPU desde a
+#   amostra anterior: threads paradas em recv/wait nao aparecem.
+# - Memoria: tracemalloc guarda a origem das alocacoes; cada relatorio
+#   compara o snapshot atual com o anterior e com o primeiro (crescimento
+#   acumulado, ex: historico de mensagens).
+#
+# Arquivos gravados em <diretorio> a cada intervalo, no sinal SIGUSR1 e ao
+# encerrar (o perfil de CPU de cada arquivo cobre o periodo desde o anterior):
+#
+#   <instante>-cpu.folded    pilhas no formato "a;b;c amostras" (flamegraph.pl,
+#                            speedscope, https://www.speedscope.app)
+#   <instante>-cpu.txt       funcoes com mais amostras (proprias e acumuladas)
+#   <instante>-mem.snapshot  snapshot do tracemalloc (Snapshot.load)
+#   <instante>-mem.txt       maiores alocacoes e crescimento entre snapshots
+#
+# Comparar snapshots gravados, fora do servidor:
+#   python profiler.py memory-report profiles/B-mem.snapshot --previous profiles/A-mem.snapshot
+
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_INTERVAL = 0.01  # Segundos entre amostras de pilha (100 Hz)
+PROFILE_DUMP_INTERVAL = 60.0    # Segundos entre cada gravacao dos relatorios
+PROFILE_MEMORY_FRAMES = 10      # Quadros guardados por alocacao no tracemalloc (0 desativa)
+PROFILE_TOP = 30                # Linhas em cada tabela dos relatorios
+PROFILE_REPORT_TIMEOUT = 60.0   # Espera maxima pelo ultimo relatorio de memoria ao encerrar
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    Amostragem periodica das pilhas de todas as threads
+    - start()/stop() controlam a thread amostradora
+    - take() devolve as contagens acumuladas e zera para o proximo periodo
+    """
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()  # "raiz;...;folha" -> amostras
+        self.lines = collections.Counter()   # folha com a linha atual -> amostras
+        self.samples = 0
+        self.cpu_times = {}                  # thread -> tempo de CPU na amostra anterior
+        self.cpu_only = hasattr(time, "pthread_getcpuclockid")
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            self.sample(own)
+
+    def _used_cpu(self, thread_id):
+        """True se a thread usou CPU desde a amostra anterior (ou se nao da para saber)"""
+        try:
+            used = time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (OSError, OverflowError):
+            return True
+        previous = self.cpu_times.get(thread_id)
+        self.cpu_times[thread_id] = used
+        return previous is None or used > previous
+
+    def sample(self, skip=None):
+        frames = sys._current_frames()
+        with self.lock:
+            self.samples += 1
+            for thread_id, frame in frames.items():
+                if thread_id == skip:
+                    continue
+                if self.cpu_only and not self._used_cpu(thread_id):
+                    continue
+                leaf = frame
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+                self.lines[f"{leaf.f_code.co_name} ({os.path.basename(leaf.f_code.co_filename)}:{leaf.f_lineno})"] += 1
+            # Threads encerradas nao voltam: evita crescer com o motor "threads"
+            if len(self.cpu_times) > 2 * len(frames):
+                self.cpu_times = {tid: used for tid, used in self.cpu_times.items() if tid in frames}
+
+    def take(self):
+        """(pilhas, linhas, amostras) do periodo atual; zera as contagens"""
+        with self.lock:
+            result = (self.stacks, self.lines, self.samples)
+            self.stacks = collections.Counter()
+            self.lines = collections.Counter()
+            self.samples = 0
+        return result
+
+def cpu_report(stacks, lines, samples, interval, cpu_only, top=PROFILE_TOP):
+    """Texto com as funcoes de mais amostras: proprias (folha) e acumuladas (em qualquer ponto da pilha)"""
+    total = sum(stacks.values())
+    cumulative = collections.Counter()
+    for stack, count in stacks.items():
+        for label in set(stack.split(";")):
+            cumulative[label] += count
+    mode = "CPU (apenas threads que usaram CPU)" if cpu_only else "tempo de parede (todas as threads)"
+    out = [f"Amostras: {samples} a cada {interval * 1000:.0f}ms - {mode}",
+           f"Pilhas amostradas: {total}", "",
+           "Próprias (linha em execução):"]
+    for label, count in lines.most_common(top):
+        out.append(f"{count:>8} {count / max(total, 1):>7.1%}  {label}")
+    out += ["", "Acumuladas (função na pilha):"]
+    for label, count in cumulative.most_common(top):
+        out.append(f"{count:>8} {count / max(total, 1):>7.1%}  {label}")
+    return "\n".join(out) + "\n"
+
+def memory_report(current_path, previous_path=None, first_path=None, top=PROFILE_TOP):
+    """
+    Texto com as maiores alocacoes de um snapshot do tracemalloc e o crescimento
+    em relacao ao snapshot anterior e ao primeiro (com a pilha de alocacao)
+    Roda fora do servidor (ver MemoryTracker): agrupar centenas de milhares de
+    alocacoes em Python, com o tracemalloc ligado, travaria o servidor por segundos.
+    """
+    def relevant(stat):
+        filename = stat.traceback[0].filename
+        return filename != tracemalloc.__file__ and not filename.startswith("<frozen importlib")
+
+    snapshot = tracemalloc.Snapshot.load(current_path)
+    size = sum(stat.size for stat in snapshot.statistics("filename"))
+    out = [f"Snapshot: {os.path.basename(current_path)}",
+           f"Memória rastreada: {size / 1024 / 1024:.1f}MB em {len(snapshot.traces)} alocações", "",
+           "Maiores alocações atuais (por linha):"]
+    stats = [stat for stat in snapshot.statistics("lineno") if relevant(stat)]
+    for stat in stats[:top]:
+        out.append(f"{stat.size / 1024:>10.1f}KB {stat.count:>8} blocos  {stat.traceback[0]}")
+
+    if previous_path:
+        out += ["", f"Crescimento desde {os.path.basename(previous_path)}:"]
+        previous = tracemalloc.Snapshot.load(previous_path)
+        growth = [stat for stat in snapshot.compare_to(previous, "lineno") if stat.size_diff and relevant(stat)]
+        for stat in growth[:top]:
+            out.append(f"{stat.size_diff / 1024:>+10.1f}KB {stat.count_diff:>+8} blocos  {stat.traceback[0]}")
+    if first_path and first_path != previous_path:
+        out += ["", f"Crescimento desde o início ({os.path.basename(first_path)}), com a pilha de alocação:"]
+        first = tracemalloc.Snapshot.load(first_path)
+        growth = [stat for stat in snapshot.compare_to(first, "traceback") if stat.size_diff > 0 and relevant(stat)]
+        for stat in growth[:top // 3]:
+            out.append(f"{stat.size_diff / 1024:>+10.1f}KB {stat.count_diff:>+8} blocos")
+            out.extend(f"      {line}" for line in stat.traceback.format())
+    return "\n".join(out) + "\n"
+
+class MemoryTracker:
+    """
+    Snapshots do tracemalloc gravados em disco e comparados ao longo do tempo
+    - snapshot(prefixo) grava <prefixo>-mem.snapshot (take_snapshot e dump
+      sao feitos em C) e gera <prefixo>-mem.txt em um processo separado
+      (python profiler.py memory-report), fora do GIL do servidor
+    - Mantem em disco apenas o primeiro snapshot e os dois mais recentes
+    """
+    def __init__(self, frames=PROFILE_MEMORY_FRAMES):
+        self.started_here = not tracemalloc.is_tracing()
+        if self.started_here:
+            tracemalloc.start(frames)
+        self.snapshots = []  # Snapshots em disco: [primeiro, ..., atual]
+        self.reporter = None # Processo gerando o relatorio mais recente
+
+    def snapshot(self, prefix):
+        """Grava o snapshot e inicia a geracao do relatorio; retorna o caminho do relatorio"""
+        path = f"{prefix}-mem.snapshot"
+        tracemalloc.take_snapshot().dump(path)
+        self.wait()
+        first = self.snapshots[0] if self.snapshots else None
+        previous = self.snapshots[-1] if self.snapshots else None
+        self.snapshots.append(path)
+        # O anterior ao anterior nao e mais usado (o relatorio dele ja terminou)
+        while len(self.snapshots) > 3:
+            os.remove(self.snapshots.pop(1))
+
+        report = f"{prefix}-mem.txt"
+        command = [sys.executable, os.path.abspath(__file__), "memory-report", path, "-o", report]
+        if previous:
+            command += ["--previous", previous]
+        if first:
+            command += ["--first", first]
+        self.reporter = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        return report
+
+    def wait(self, timeout=None):
+        """Espera o relatorio em andamento terminar"""
+        if self.reporter is not None:
+            try:
+                self.reporter.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.reporter.kill()
+            self.reporter = None
+
+    def stop(self):
+        if self.started_here:
+            tracemalloc.stop()
+
+class ProfileSession:
+    """
+    Modo de perfil do servidor: amostragem de CPU + tracemalloc
+    - Grava os relatorios em directory a cada dump_interval segundos, ao
+      receber SIGUSR1 (se install_signal) e em close()
+    - memory_frames=0 desativa o tracemalloc (apenas CPU)
+    - on_dump(mensagem) opcional, para registrar no log do servidor
+    """
+    def __init__(self, directory=PROFILE_DIR, sample_interval=PROFILE_SAMPLE_INTERVAL,
+                 dump_interval=PROFILE_DUMP_INTERVAL, memory_frames=PROFILE_MEMORY_FRAMES,
+                 install_signal=True, on_dump=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.on_dump = on_dump
+        self.dump_lock = threading.Lock()
+        self.cpu = SamplingProfiler(sample_interval)
+        self.memory = MemoryTracker(memory_frames) if memory_frames else None
+        self.signal_installed = False
+        if install_signal and hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            # O tratador roda na thread principal: a gravacao vai para outra thread
+            signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=self.dump, daemon=True).start())
+            self.signal_installed = True
+
+        self.stop_event = threading.Event()
+        self.cpu.start()
+        if self.memory is not None:
+            # Snapshot inicial: base do crescimento acumulado
+            self.memory.snapshot(os.path.join(directory, self._stamp()))
+        if dump_interval:
+            threading.Thread(target=self._dump_loop, args=(dump_interval,), name="profiler-dump", daemon=True).start()
+
+    def _dump_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            self.dump()
+
+    @staticmethod
+    def _stamp():
+        return datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+
+    def dump(self):
+        """Grava os relatorios do periodo; retorna o prefixo dos arquivos"""
+        with self.dump_lock:
+            prefix = os.path.join(self.directory, self._stamp())
+            stacks, lines, samples = self.cpu.take()
+            try:
+                with open(f"{prefix}-cpu.folded", "w", encoding="utf-8") as f:
+                    for stack, count in stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+                with open(f"{prefix}-cpu.txt", "w", encoding="utf-8") as f:
+                    f.write(cpu_report(stacks, lines, samples, self.cpu.interval, self.cpu.cpu_only))
+                if self.memory is not None:
+                    self.memory.snapshot(prefix)
+            except OSError as e:
+                if self.on_dump:
+                    self.on_dump(f"Erro ao gravar perfil em {prefix}: {e}")
+                return None
+            if self.on_dump:
+                self.on_dump(f"Perfil gravado em {prefix}-* ({samples} amostras)")
+            return prefix
+
+    def close(self):
+        """Para a amostragem, grava o ultimo periodo e desliga o tracemalloc"""
+        self.stop_event.set()
+        self.cpu.stop()
+        self.dump()
+        if self.signal_installed:
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        if self.memory is not None:
+            self.memory.wait(PROFILE_REPORT_TIMEOUT)
+            self.memory.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Relatórios do modo de perfil do servidor")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("memory-report", help="maiores alocações e crescimento entre snapshots")
+    report.add_argument("snapshot", help="snapshot do tracemalloc (<instante>-mem.snapshot)")
+    report.add_argument("--previous", default=None, help="snapshot anterior, para o crescimento no período")
+    report.add_argument("--first", default=None, help="primeiro snapshot, para o crescimento acumulado")
+    report.add_argument("--top", type=int, default=PROFILE_TOP, help="linhas em cada tabela")
+    report.add_argument("-o", "--output", default=None, help="arquivo do relatório (padrão: saída padrão)")
+    args = parser.parse_args()
+
+    text = memory_report(args.snapshot, args.previous, args.first, args.top)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text, end="")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#protocol.py
+
+import json
+import os
+import struct
+import threading
+
+# FORMATO DOS FRAMES (todas as conexoes TCP do chat):
+#
+# +-------------------+---------------+-------------------------+
+# | tamanho (4 bytes) | tipo (1 byte) | payload (tamanho bytes) |
+# +-------------------+---------------+-------------------------+
+#
+# - tamanho: inteiro sem sinal big-endian com o tamanho do payload
+# - tipo: define como o payload deve ser interpretado
+#
+# Como o TCP e um fluxo de bytes, uma unica leitura pode trazer varios
+# frames juntos ou apenas um pedaco de um frame. O FrameReader acumula os
+# bytes recebidos e so entrega frames completos.
+
+FORMAT = 'utf-8'                      # Codificação de caracteres
+HEADER = struct.Struct("!IB")         # tamanho (uint32) + tipo (uint8)
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 64 * 1024 * 1024     # Limite de seguranca por frame (64MB)
+RECV_SIZE = 64 * 1024                 # Tamanho de cada leitura do socket
+CHUNK_SIZE = 64 * 1024                # Bytes do arquivo por pedaco nas transferencias em streaming
+
+# Tipos de frame
+FRAME_JSON = 1    # Cliente -> Servidor: objeto JSON {"type", "control", "message", ...}
+FRAME_TEXT = 2    # Servidor -> Cliente: string "chave=valor"
+FRAME_BINARY = 3  # Ambos os sentidos: pedaco de arquivo em bytes crus (sem base64)
+
+# Payload do FRAME_BINARY: id da transferencia (uint32) + bytes do arquivo
+CHUNK_HEADER = struct.Struct("!I")
+
+# Recursos negociados na conexao: o cliente anuncia no campo "features" da
+# mensagem "name" e o servidor responde com "features=[...]". Quem nao
+# anuncia um recurso continua recebendo o formato antigo (base64 em texto).
+FEATURE_BINARY = "binary_chunks"  # Pedacos de arquivo em FRAME_BINARY
+FEATURE_HISTORY = "history_pages" # Historico enviado em paginas ("history=") sob demanda
+
+class FrameError(Exception):
+    """Erro de protocolo: frame invalido ou maior que o permitido"""
+
+def encode_frame(frame_type, payload):
+    """
+    Monta um frame completo (cabecalho + payload)
+    - payload pode ser str (codificado em utf-8) ou bytes
+    """
+    if isinstance(payload, str):
+        payload = payload.encode(FORMAT)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame de {len(payload)} bytes excede o limite de {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+def send_frame(sock, frame_type, payload):
+    """Envia um frame completo pelo socket (sendall garante envio integral)"""
+    sock.sendall(encode_frame(frame_type, payload))
+
+def send_json(sock, message):
+    """Envia um dicionario como frame JSON (Cliente -> Servidor)"""
+    send_frame(sock, FRAME_JSON, json.dumps(message))
+
+def send_text(sock, text):
+    """Envia uma string "chave=valor" como frame de texto (Servidor -> Cliente)"""
+    send_frame(sock, FRAME_TEXT, text)
+
+def encode_binary_chunk(transfer_id, data):
+    """Monta um FRAME_BINARY com um pedaco de arquivo (pode ser reutilizado para varios destinos)"""
+    return encode_frame(FRAME_BINARY, CHUNK_HEADER.pack(transfer_id) + data)
+
+def send_binary_chunk(sock, transfer_id, data):
+    """Envia um pedaco de arquivo como FRAME_BINARY"""
+    sock.sendall(encode_binary_chunk(transfer_id, data))
+
+def decode_binary_chunk(payload):
+    """Separa o payload de um FRAME_BINARY em (id_da_transferencia, bytes)"""
+    if len(payload) < CHUNK_HEADER.size:
+        raise FrameError("Frame binário sem id de transferência")
+    (transfer_id,) = CHUNK_HEADER.unpack_from(payload)
+    return transfer_id, payload[CHUNK_HEADER.size:]
+
+class FileFrame:
+    """
+    Frame cujo final do payload vem de um arquivo em disco
+    - head: cabecalho + inicio do payload (em memoria)
+    - file/size/offset: arquivo aberto com o restante do payload (size bytes a
+      partir de offset), enviado com os.sendfile direto do cache de paginas do
+      SO para o socket
+    - Nao guarda estado de envio: o mesmo FileFrame pode estar na fila de
+      varias conexoes (um arquivo para N usuarios e aberto uma unica vez)
+    """
+    def __init__(self, frame_type, prefix, file, size, offset=0):
+        if isinstance(prefix, str):
+            prefix = prefix.encode(FORMAT)
+        if len(prefix) + size > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame de {len(prefix) + size} bytes excede o limite de {MAX_FRAME_SIZE}")
+        self.head = HEADER.pack(len(prefix) + size, frame_type) + prefix
+        self.file = file
+        self.size = size
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.head) + self.size
+
+    def send_some(self, sock, sent):
+        """
+        Envia o frame a partir do byte `sent`; retorna quantos bytes foram enviados
+        Em socket nao bloqueante pode levantar BlockingIOError, como sock.send
+        """
+        if sent < len(self.head):
+            return sock.send(memoryview(self.head)[sent:])
+        position = sent - len(self.head)
+        count = self.size - position
+        position += self.offset
+        if hasattr(os, "sendfile"):
+            # Offset explicito: a posicao do arquivo compartilhado nao muda
+            sent_now = os.sendfile(sock.fileno(), self.file.fileno(), position, count)
+        else:
+            with _file_read_lock:
+                self.file.seek(position)
+                data = self.file.read(min(count, CHUNK_SIZE))
+            sent_now = sock.send(data) if data else 0
+        if sent_now == 0:
+            raise OSError("Arquivo terminou antes do tamanho anunciado no frame")
+        return sent_now
+
+    def send_to(self, sock):
+        """Envia o frame inteiro em um socket bloqueante"""
+        sent = 0
+        total = len(self)
+        while sent < total:
+            sent += self.send_some(sock, sent)
+
+_file_read_lock = threading.Lock() # Leitura com seek sem os.sendfile (ex: Windows)
+
+def is_file_data_frame(frame):
+    """
+    Indica se um frame ja montado (cabecalho + payload) carrega dados de arquivo:
+    FileFrame, FRAME_BINARY ou texto "file=..." / "file_chunk=..."
+    Usado para descartar primeiro os dados de arquivo de um consumidor lento
+    """
+    if isinstance(frame, FileFrame):
+        return True
+    frame_type = frame[HEADER_SIZE - 1]
+    if frame_type == FRAME_BINARY:
+        return True
+    if frame_type == FRAME_TEXT:
+        prefix = bytes(frame[HEADER_SIZE:HEADER_SIZE + 11])
+        return prefix.startswith(b"file=") or prefix.startswith(b"file_chunk=")
+    return False
+
+def is_file_control_frame(frame):
+    """
+    Indica se o frame abre, fecha ou cancela uma transferencia em streaming
+    ("file_start=", "file_end=", "file_abort="): sao pequenos e, se descartados,
+    o cliente ficaria com o arquivo parcial aberto para sempre
+    """
+    if isinstance(frame, FileFrame) or frame[HEADER_SIZE - 1] != FRAME_TEXT:
+        return False
+    prefix = bytes(frame[HEADER_SIZE:HEADER_SIZE + 11])
+    return prefix.startswith((b"file_start=", b"file_end=", b"file_abort="))
+
+def frame_kind(frame_type, buffer, start):
+    """
+    Nome curto do conteudo de um frame, para metricas: a chave dos frames de
+    texto ("msg", "file", "history", ...), "binary" ou "json"
+    """
+    if frame_type == FRAME_TEXT:
+        end = buffer.find(b"=", start, start + 20)
+        return buffer[start:end].decode(FORMAT) if end >= 0 else "text"
+    if frame_type == FRAME_BINARY:
+        return "binary"
+    return "json"
+
+def describe_frames(data):
+    """
+    Gera (tipo, tamanho) de cada frame de um envio: bytes com um ou mais
+    frames inteiros (ex: pagina do historico) ou um FileFrame
+    """
+    if isinstance(data, FileFrame):
+        yield frame_kind(data.head[HEADER_SIZE - 1], data.head, HEADER_SIZE), len(data)
+        return
+    offset = 0
+    while offset + HEADER_SIZE <= len(data):
+        length, frame_type = HEADER.unpack_from(data, offset)
+        yield frame_kind(frame_type, data, offset + HEADER_SIZE), HEADER_SIZE + length
+        offset += HEADER_SIZE + length
+
+class FrameReader:
+    """
+    Reconstroi frames a partir de um fluxo TCP
+    - feed(data) recebe bytes na ordem em que chegaram do socket
+    - Retorna a lista de frames completos: [(tipo, payload_bytes), ...]
+    - Bytes de um frame incompleto ficam guardados ate a proxima leitura
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        available = len(self.buffer)
+
+        while available - offset >= HEADER_SIZE:
+            length, frame_type = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame de {length} bytes excede o limite de {self.max_frame_size}")
+
+            start = offset + HEADER_SIZE
+            end = start + length
+            if end > available:
+                break  # Frame incompleto: aguardar mais dados
+
+            frames.append((frame_type, bytes(self.buffer[start:end])))
+            offset = end
+
+        # Descarta de uma vez so os bytes ja consumidos
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+def read_frames(sock, recv_size=RECV_SIZE):
+    """
+    Gerador que le o socket continuamente e produz (tipo, payload)
+    Termina quando a conexao e fechada pelo outro lado
+    """
+    reader = FrameReader()
+    while True:
+        data = sock.recv(recv_size)
+        if not data:
+            return
+        for frame in reader.feed(data):
+            yield frame
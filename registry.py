@@ -0,0 +1,57 @@
+#registry.py
+
+import threading
+
+class UserRegistry:
+    """
+    Registro dos usuarios conectados ao servidor
+    - Busca O(1) por nome
+    - Alteracoes (entrada/saida) protegidas por lock
+    - Leituras para broadcast usam snapshot(): uma tupla imutavel trocada a
+      cada alteracao (copy-on-write), entao percorrer os usuarios nunca
+      disputa com uma entrada ou saida e nao precisa de lock
+    Cada usuario e o dicionario criado pelo servidor:
+    {"conn": socket, "addr": tuple, "name": str, ...}
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = {}
+        self.users = ()  # Snapshot atual, na ordem de entrada
+
+    def add(self, user_conn):
+        """
+        Registra um usuario se o nome estiver livre
+        Retorna False se o nome ja estiver em uso (verificacao e insercao atomicas)
+        """
+        with self.lock:
+            if user_conn["name"] in self.by_name:
+                return False
+            self.by_name[user_conn["name"]] = user_conn
+            self.users = self.users + (user_conn,)
+            return True
+
+    def remove(self, user_conn):
+        """Remove o usuario (ignora se ja foi removido)"""
+        with self.lock:
+            if self.by_name.get(user_conn["name"]) is not user_conn:
+                return False
+            del self.by_name[user_conn["name"]]
+            self.users = tuple(user for user in self.users if user is not user_conn)
+            return True
+
+    def get(self, name):
+        """Usuario com o nome informado ou None"""
+        return self.by_name.get(name)
+
+    def snapshot(self):
+        """Tupla com os usuarios conectados neste instante (nao muda depois)"""
+        return self.users
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
@@ -1,31 +1,314 @@
 #server.py
 
 import socket
+import selectors
+import argparse
 import threading
-import time
 import json
-from tkinter import *
-from tkinter import scrolledtext
+import base64
 import datetime
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+try:
+    from tkinter import *
+    from tkinter import scrolledtext
+except ImportError:
+    # Servidores sem display/tkinter podem rodar apenas em modo --headless
+    Tk = None
+from attachments import AttachmentStore
+from history import MessageHistory, message_size
+from message_log import SEGMENT_MAX_BYTES, MessageLog
+from metrics import MetricsRegistry, start_metrics_server, stop_metrics_server
+from profiler import PROFILE_DIR, PROFILE_DUMP_INTERVAL, PROFILE_MEMORY_FRAMES, PROFILE_SAMPLE_INTERVAL, ProfileSession
+from registry import UserRegistry
+from tracing import Tracer
+from protocol import (CHUNK_HEADER, CHUNK_SIZE, FEATURE_BINARY, FEATURE_HISTORY, FRAME_BINARY, FRAME_JSON, FRAME_TEXT,
+                      MAX_FRAME_SIZE, RECV_SIZE, FrameError, HEADER_SIZE, FileFrame, FrameReader, decode_binary_chunk, describe_frames,
+                      encode_binary_chunk, encode_frame, is_file_control_frame, is_file_data_frame, send_text)
 
 SERVER_IP = "0.0.0.0" # Aceita conexoes de qualquer IP
 PORT = 5050 # Porta principal do chat
 DISC_PORT = 5051 # Porta para descoberta automatica
 ADDR = (SERVER_IP, PORT)
 FORMAT = 'utf-8'          # Codificação de caracteres
+ENGINES = ("threads", "events") # Motores disponiveis: thread por conexao ou loop de eventos
+SERVER_FEATURES = {FEATURE_BINARY, FEATURE_HISTORY} # Recursos do protocolo que o servidor sabe negociar
+LOG_TARGETS = ("console", "file", "none") # Destinos de log no modo headless
+
+# Limites do historico em memoria (None = sem limite)
+HISTORY_MAX_MESSAGES = 1000             # Mensagens por historico (global e privado)
+HISTORY_MAX_BYTES = 50 * 1024 * 1024    # 50MB por historico
+HISTORY_MAX_AGE = 24 * 60 * 60          # 24 horas
+HISTORY_PAGE_SIZE = 50                  # Mensagens enviadas ao entrar no chat (e por pagina pedida)
+HISTORY_MAX_PAGE_SIZE = 500             # Maior pagina que um cliente pode pedir
+HISTORY_PAGE_MAX_BYTES = 4 * 1024 * 1024 # Bytes (texto + arquivos) de cada pagina; as mais antigas ficam para a proxima
+
+DATA_DIR = "chat_data"                  # Diretorio do log de mensagens em disco
+LOG_MAX_SEGMENTS = 16                   # Segmentos (64MB cada) mantidos por log; os mais antigos sao apagados
+
+OUTBOUND_MAX_BYTES = 16 * 1024 * 1024   # Limite da fila de saida de cada conexao (16MB)
+
+# Consumidores lentos: ao passar da marca d'agua de bytes pendentes, aplica a politica
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "drop_files", "disconnect")
+SLOW_CONSUMER_POLICY = "drop_oldest"                # Politica padrao
+SLOW_CONSUMER_HIGH_WATER = 4 * 1024 * 1024          # Marca d'agua por conexao (4MB)
+STATS_REFRESH_MS = 500 # Intervalo de amostragem das estatisticas pela GUI
+METRICS_PORT = 9150    # Porta HTTP local das metricas (formato Prometheus); 0 desativa
+TRACE_FILE = "chat_trace.json" # Arquivo dos traces amostrados (formato de eventos do Chrome)
+MESSAGE_TYPES = ("name", "msg", "file", "online_usr", "history", "file_start", "file_chunk", "file_end")
+
+server = None   # Socket principal, criado em create_server_socket()
+running = False # Indica se os loops do servidor devem continuar
+
+def create_server_socket():
+    """Cria e associa o socket TCP principal (chamado apenas na inicializacao)"""
+    global server
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(ADDR)
+    return server
+
+def stop_server():
+    """Sinaliza o encerramento para todos os loops e fecha o socket principal"""
+    global running
+    if running:
+        log("[SERVIDOR] Encerrando servidor...")
+    running = False
+    try:
+        server.close()
+    except:
+        pass
+    close_message_logs()
+    close_attachment_store()
+    close_metrics_server()
+    close_tracer()
+    close_profiler()
+
+class ConsoleLogSink:
+    """Destino de log que imprime cada linha no console"""
+    def write(self, line):
+        print(line)
+
+class FileLogSink:
+    """Destino de log que grava cada linha em um arquivo (modo append)"""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding=FORMAT)
+
+    def write(self, line):
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+log_sink = ConsoleLogSink() # Destino atual do log (None = log desativado)
+
+def set_log_sink(sink):
+    """Troca o destino do log: ConsoleLogSink, FileLogSink, serverGUI ou None"""
+    global log_sink
+    log_sink = sink
+
+def log(message):
+    """Registra uma mensagem com timestamp no destino de log configurado"""
+    sink = log_sink
+    if sink is None:
+        return
+    with tracer.span("log"):
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        sink.write(f"[{timestamp}] {message}")
+
+class ServerStats:
+    """
+    Contadores do servidor atualizados pelo caminho quente
+    - Incrementar e barato (nenhuma chamada de interface)
+    - Observadores (ex: serverGUI) leem snapshot() no seu proprio ritmo
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+
+    def increment_messages(self):
+        with self.lock:
+            self.messages += 1
+
+    def snapshot(self):
+        global_history = global_messages.stats()
+        private_history = private_messages.stats()
+        return {
+            "connections": len(connections),
+            "messages": self.messages,
+            "history_messages": global_history["messages"] + private_history["messages"],
+            "history_bytes": global_history["bytes"] + private_history["bytes"],
+            "history_evicted": sum(global_history[k] + private_history[k]
+                                   for k in ("evicted_count", "evicted_bytes", "evicted_age")),
+            "slow_consumers": slow_consumers.snapshot(),
+            "attachments": attachments.stats() if attachments is not None else {}
+        }
+
+stats = ServerStats()
+
+class ServerMetrics:
+    """
+    Metricas do servidor expostas em http://127.0.0.1:METRICS_PORT/metrics
+    - Contadores e histogramas atualizados pelo caminho quente: mensagens e
+      bytes por tipo (entrada e saida), duracao do envio para os destinatarios
+      (fanout), conexoes e pedidos de descoberta
+    - Historico, filas de saida, consumidores lentos e anexos sao lidos a
+      cada consulta (collect), sem custo entre as consultas
+    """
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        registry = self.registry
+        self.connections_open = registry.gauge(
+            "chat_connections_open", "Conexoes TCP abertas (com ou sem nome definido)")
+        self.connections_accepted = registry.counter(
+            "chat_connections_accepted_total", "Conexoes TCP aceitas")
+        self.users_online = registry.gauge(
+            "chat_users_online", "Usuarios registrados (com nome) conectados")
+        self.messages_in = registry.counter(
+            "chat_messages_in_total", "Frames recebidos dos clientes por tipo de mensagem", ("type",))
+        self.bytes_in = registry.counter(
+            "chat_bytes_in_total", "Bytes recebidos dos clientes (com cabecalho) por tipo de mensagem", ("type",))
+        self.messages_out = registry.counter(
+            "chat_messages_out_total", "Frames colocados nas filas de saida por tipo", ("type",))
+        self.bytes_out = registry.counter(
+            "chat_bytes_out_total", "Bytes colocados nas filas de saida (com cabecalho) por tipo", ("type",))
+        self.fanout_seconds = registry.histogram(
+            "chat_fanout_seconds", "Duracao da entrega de uma mensagem a todos os destinatarios", ("kind",))
+        self.fanout_recipients = registry.counter(
+            "chat_fanout_recipients_total", "Destinatarios das entregas medidas em chat_fanout_seconds", ("kind",))
+        self.outbound_queue_bytes = registry.gauge(
+            "chat_outbound_queue_bytes", "Bytes pendentes nas filas de saida (soma e maior fila)", ("stat",))
+        self.outbound_queue_frames = registry.gauge(
+            "chat_outbound_queue_frames", "Frames pendentes em todas as filas de saida")
+        self.outbound_over_high_water = registry.gauge(
+            "chat_outbound_queue_over_high_water", "Conexoes acima da marca d'agua de consumidor lento")
+        self.slow_consumer_actions = registry.counter(
+            "chat_slow_consumer_actions_total", "Atuacoes da politica de consumidor lento e filas cheias", ("action",))
+        self.slow_consumer_dropped_frames = registry.counter(
+            "chat_slow_consumer_dropped_frames_total", "Frames descartados de consumidores lentos")
+        self.slow_consumer_dropped_bytes = registry.counter(
+            "chat_slow_consumer_dropped_bytes_total", "Bytes descartados de consumidores lentos")
+        self.history_messages = registry.gauge(
+            "chat_history_messages", "Mensagens no historico em memoria", ("history",))
+        self.history_bytes = registry.gauge(
+            "chat_history_bytes", "Bytes (estimados) do historico em memoria", ("history",))
+        self.history_evicted = registry.counter(
+            "chat_history_evicted_total", "Mensagens descartadas do historico em memoria", ("history", "reason"))
+        self.attachments_files = registry.gauge(
+            "chat_attachments_files", "Anexos guardados em disco")
+        self.attachments_bytes = registry.gauge(
+            "chat_attachments_bytes", "Bytes (originais) dos anexos guardados em disco")
+        self.discovery_requests = registry.counter(
+            "chat_discovery_requests_total", "Pedidos de descoberta (CHAT_DISCOVER) respondidos")
+        registry.add_collector(self.collect)
+
+    def count_in(self, kind, size):
+        self.messages_in.inc(kind)
+        self.bytes_in.inc(kind, amount=size)
+
+    def count_out(self, data):
+        """Conta cada frame de um envio (bytes com um ou mais frames ou FileFrame)"""
+        for kind, size in describe_frames(data):
+            self.messages_out.inc(kind)
+            self.bytes_out.inc(kind, amount=size)
+
+    def observe_fanout(self, kind, started, recipients):
+        self.fanout_seconds.observe(time.perf_counter() - started, kind)
+        self.fanout_recipients.inc(kind, amount=recipients)
+
+    def collect(self):
+        """Atualiza os valores lidos de outras estruturas (chamado a cada consulta)"""
+        users = connections.snapshot()
+        self.users_online.set(len(users))
+        pending = [user["conn"].pending_bytes for user in users if isinstance(user["conn"], OutboundQueue)]
+        self.outbound_queue_bytes.set(sum(pending), "total")
+        self.outbound_queue_bytes.set(max(pending, default=0), "max")
+        self.outbound_queue_frames.set(sum(len(user["conn"].queue) for user in users
+                                           if isinstance(user["conn"], OutboundQueue)))
+        self.outbound_over_high_water.set(sum(1 for size in pending if size > slow_consumers.high_water))
+        slow = slow_consumers.snapshot()
+        for action in SLOW_CONSUMER_POLICIES + ("overflow",):
+            self.slow_consumer_actions.set(slow[action], action)
+        self.slow_consumer_dropped_frames.set(slow["dropped_frames"])
+        self.slow_consumer_dropped_bytes.set(slow["dropped_bytes"])
+        for name, history in (("global", global_messages), ("private", private_messages)):
+            history_stats = history.stats()
+            self.history_messages.set(history_stats["messages"], name)
+            self.history_bytes.set(history_stats["bytes"], name)
+            for reason in ("count", "bytes", "age"):
+                self.history_evicted.set(history_stats[f"evicted_{reason}"], name, reason)
+        if attachments is not None:
+            attachment_stats = attachments.stats()
+            self.attachments_files.set(attachment_stats["files"])
+            self.attachments_bytes.set(attachment_stats["bytes"])
+
+metrics = ServerMetrics()
+metrics_server = None # Servidor HTTP das metricas; aberto em start()
+
+def open_metrics_server(port):
+    """Expoe as metricas em http://127.0.0.1:porta/metrics (falha apenas registra no log)"""
+    global metrics_server
+    try:
+        metrics_server = start_metrics_server(metrics.registry, port)
+        log(f"[SERVIDOR] Métricas em http://127.0.0.1:{port}/metrics")
+    except OSError as e:
+        log(f"[SERVIDOR] Métricas indisponíveis na porta {port}: {e}")
+
+def close_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        stop_metrics_server(metrics_server)
+        metrics_server = None
+
+# Modo de perfil (CPU + memoria), ativado com start(profile_dir=...) (ver profiler.py)
+profiler = None
+
+def open_profiler(directory, sample_interval, dump_interval, memory_frames):
+    """Inicia a amostragem de pilhas e o tracemalloc; relatorios em directory"""
+    global profiler
+    profiler = ProfileSession(directory, sample_interval, dump_interval, memory_frames,
+                              on_dump=lambda message: log(f"[PERFIL] {message}"))
+    trigger = " ou com SIGUSR1" if profiler.signal_installed else ""
+    log(f"[SERVIDOR] Perfil ativo: relatórios em {os.path.abspath(directory)} "
+        f"a cada {dump_interval:.0f}s{trigger}")
+
+def close_profiler():
+    """Grava o ultimo periodo do perfil e para a amostragem"""
+    global profiler
+    if profiler is not None:
+        session, profiler = profiler, None
+        session.close()
+
+# Traces por mensagem, desativados ate start(trace_sample=...) (ver tracing.py)
+tracer = Tracer()
+
+def close_tracer():
+    """Grava os traces pendentes no arquivo (se o rastreamento estiver ativo)"""
+    if tracer.sample_rate:
+        try:
+            count = tracer.close()
+            if count:
+                log(f"[SERVIDOR] {count} eventos de trace gravados em {tracer.path}")
+        except OSError as e:
+            log(f"[SERVIDOR] Erro ao gravar traces em {tracer.path}: {e}")
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
 
 class serverGUI:
     """
     Classe para gerenciar a interface grafica do servidor
     - Exibe mensagens de status e conexoes ativas
     - Permite interacao com o servidor via GUI
+    - Funciona como observador: as linhas de log sao acumuladas em um buffer
+      e as estatisticas sao amostradas a cada STATS_REFRESH_MS, em vez de
+      agendar um callback do Tkinter por mensagem
     """
-    def __init__(self):
+    def __init__(self, console_sink=None):
         self.window = window_create()
-
+        self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
     # Frame para informações do servidor
         info_frame = Frame(self.window, bg="#34495e", relief="raised", bd=2)
         info_frame.pack(pady=10, padx=20, fill="x")
@@ -54,6 +337,11 @@ class serverGUI:
                                     font=("Arial", 12, "bold"), 
                                     bg="#2c3e50", fg="#3498db")
         self.messages_label.pack(side=LEFT, padx=20)
+        
+        self.history_label = Label(stats_frame, text="🗄️ Histórico: 0 (0.0KB)", 
+                                   font=("Arial", 12, "bold"), 
+                                   bg="#2c3e50", fg="#9b59b6")
+        self.history_label.pack(side=LEFT, padx=20)
     
     # Área de log com scroll
         log_frame = Frame(self.window, bg="#2c3e50")
@@ -84,109 +372,108 @@ class serverGUI:
         clear_btn.pack(pady=10)
 
     # Variáveis de controle
-        self.message_count = 0
-        self.running = True
-        
-    # Log inicial
-        self.log("[SERVIDOR] Iniciando servidor de chat...")
-        self.log(f"[SERVIDOR] Sistema de descoberta ativo na porta 5051")
-        self.log(f"[SERVIDOR] Servidor principal ouvindo em {SERVER_IP}:{PORT}")
-        self.log("[SERVIDOR] Aguardando conexões...")
-
-    def log(self, message):
-        """Adiciona uma mensagem ao log com timestamp"""
-        if not self.running:
-            return
-            
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        formatted_message = f"[{timestamp}] {message}\n"
-        
-        # Atualizar na thread principal do Tkinter
-        self.window.after(0, self._update_log, formatted_message)
-        
-        # Também imprimir no console
-        print(f"[{timestamp}] {message}")
+        self.console_sink = console_sink # Log tambem vai para o console, se definido
+        self.pending_lines = deque()     # Linhas aguardando a proxima amostragem
+
+        self.refresh()
 
-    def _update_log(self, message):
-        """Atualiza o log na interface (deve ser chamado na thread principal)"""
+    def write(self, line):
+        """Recebe uma linha de log (chamado de qualquer thread, sem tocar no Tkinter)"""
+        self.pending_lines.append(line)
+        if self.console_sink is not None:
+            self.console_sink.write(line)
+
+    def refresh(self):
+        """Descarrega o log pendente e atualiza as estatísticas (thread principal)"""
+        lines = []
+        while self.pending_lines:
+            lines.append(self.pending_lines.popleft())
         try:
-            self.log_text.insert(END, message)
-            self.log_text.see(END)
+            if lines:
+                self.log_text.insert(END, "\n".join(lines) + "\n")
+                self.log_text.see(END)
+
+            current = stats.snapshot()
+            self.connections_label.config(text=f"👥 Conexões ativas: {current['connections']}")
+            self.messages_label.config(text=f"💬 Mensagens: {current['messages']}")
+            self.history_label.config(text=f"🗄️ Histórico: {current['history_messages']} "
+                                           f"({current['history_bytes']/1024:.1f}KB)")
         except:
             pass
-    def update_stats(self, connections_count, messages_count=None):
-        """Atualiza as estatísticas na interface"""
-        if not self.running:
-            return
-            
-        if messages_count is not None:
-            self.message_count = messages_count
-        
-        def _update():
-            try:
-                self.connections_label.config(text=f"👥 Conexões ativas: {connections_count}")
-                self.messages_label.config(text=f"💬 Mensagens: {self.message_count}")
-            except:
-                pass
-        
-        self.window.after(0, _update)
-    def increment_message_count(self):
-        """Incrementa o contador de mensagens"""
-        self.message_count += 1
-        self.update_stats(len(connections))
-    
+        self.window.after(STATS_REFRESH_MS, self.refresh)
+
     def clear_log(self):
         """Limpa o log da interface"""
         self.log_text.delete(1.0, END)
-        self.log("[SERVIDOR] Log limpo pelo usuário")
+        log("[SERVIDOR] Log limpo pelo usuário")
     
     def on_closing(self):
         """Manipula o fechamento da janela"""
-        self.running = False
-        self.log("[SERVIDOR] Encerrando servidor...")
-        try:
-            server.close()
-        except:
-            pass
+        stop_server()
+        set_log_sink(self.console_sink)
         self.window.destroy()
 
 # FORMATO DAS MENSAGENS:
+#
+# Toda mensagem trafega dentro de um frame (ver protocol.py):
+# cabecalho com tamanho + tipo, seguido do payload.
 # 
-# Cliente -> Servidor (JSON):
+# Cliente -> Servidor (frame JSON):
 # {
-#   "type": "name|msg|file|online_usr",
+#   "type": "name|msg|file|online_usr|history|file_start|file_chunk|file_end",
 #   "control": "destinatario|4all|dontcare", 
 #   "message": "conteudo",
-#   "filename": "nome_arquivo" (apenas para files)
+#   "filename": "nome_arquivo" (apenas para file e file_start),
+#   "size": tamanho_em_bytes (apenas para file_start),
+#   "transfer_id": id_da_transferencia (apenas para file_start/chunk/end),
+#   "features": ["binary_chunks", "history_pages"] (opcional, apenas para name),
+#   "before": seq, "limit": n (opcional, apenas para history)
 # }
 #
-# Servidor -> Cliente (string):
+# Servidor -> Cliente (frame de texto):
 # "msg=conteudo_da_mensagem"
 # "file=remetente||nome_arquivo||dados_base64"
 # "online_users=json_array_usuarios"
+# "file_start=id||remetente||nome_arquivo||tamanho"
+# "file_chunk=id||dados_base64"
+# "file_end=id"
+# "file_abort=id" (remetente desconectou no meio da transferencia)
+# "features=json_array_recursos" (resposta a "name": recursos aceitos)
+# "history={"control": "4all|usuario", "messages": [...], "before": seq, "has_more": bool}"
+#   (com "history_pages"; control=usuario para a conversa privada com esse usuario)
+#
+# Frame binario (ambos os sentidos, apenas com o recurso "binary_chunks"):
+# id_da_transferencia (uint32) + bytes do arquivo, no lugar de file_chunk
+#
+# Transferencia em streaming: o cliente envia file_start, varios file_chunk
+# (cada um com ate CHUNK_SIZE bytes do arquivo) e um file_end. O servidor
+# repassa cada pedaco aos destinatarios assim que chega, sem guardar o
+# arquivo inteiro em memoria; os pedacos tambem sao gravados no spool de
+# anexos e, no file_end, o arquivo entra no historico como uma mensagem "file".
 
 def handle_discovery():
     """
     Gerencia a descoberta automatica do servidor na rede local
-    - Cria socket UDP na porta 5051
+    - Cria socket UDP na porta DISC_PORT (5051)
     - Escuta por mensagens "CHAT_DISCOVER" 
     - Responde com "CHAT_SERVER" para identificar o servidor
     """
     discover_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     discover_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     discover_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    discover_socket.bind(('', 5051))
+    discover_socket.bind(('', DISC_PORT))
     
     def discovery_loop():
         while True:
             try:
                 data, addr = discover_socket.recvfrom(1024)
                 if data == b"CHAT_DISCOVER":
-                    gui.log(f"[Descoberta] Requisição de {addr[0]}")
+                    log(f"[Descoberta] Requisição de {addr[0]}")
+                    metrics.discovery_requests.inc()
                     discover_socket.sendto(b"CHAT_SERVER", addr)
             except Exception as e:
-                if gui.running:
-                    gui.log(f"[Erro Descoberta] {e}")
+                if running:
+                    log(f"[Erro Descoberta] {e}")
                 break
     
     # Inicia thread separada para descoberta em background
@@ -194,52 +481,306 @@ def handle_discovery():
     discovery_thread.start()
 
 # Estruturas de dados globais
-connections = []     # Lista de usuarios conectados: [{"conn": socket, "addr": tuple, "name": str}]
-global_messages = []  # Historico de mensagens publicas
-private_messages = [] # Historico de mensagens privadas
+connections = UserRegistry() # Usuarios conectados: {"conn": socket, "addr": tuple, "name": str, "transfers": dict, "features": set}
+
+def conversation_key(message):
+    """Chave da conversa privada de uma mensagem: (remetente, destinatario)"""
+    return (message["sender"], message["destination"])
+
+# Anexos em disco sem duplicatas (ver attachments.py); aberto em start()
+attachments = None
+attachments_tmpdir = None # Diretorio temporario dos anexos quando nao ha persistencia
+
+def release_attachment(message):
+    """Libera a referencia ao anexo de uma mensagem descartada do historico"""
+    if message.get("type") == "file" and "hash" in message and attachments is not None:
+        attachments.release(message["hash"])
+
+def file_message_frames(message, binary):
+    """
+    Frames de entrega de uma mensagem de arquivo do historico
+    - binary (cliente com FEATURE_BINARY): a mesma sequencia de uma transferencia
+      em streaming, "file_start=", pedacos FRAME_BINARY e "file_end=", com os
+      pedacos enviados por sendfile direto do spool (bytes originais)
+    - Demais clientes: "file=remetente||nome_arquivo||dados_base64", um FileFrame
+      do spool em base64 (gerado uma unica vez, na primeira entrega); se o
+      base64 nao cabe em um frame (MAX_FRAME_SIZE), segue em streaming com
+      pedacos "file_chunk=" do mesmo spool
+    - Logs gravados antes do armazenamento de anexos trazem o conteudo embutido
+      (em base64): seguem sempre como "file="
+    - None se o anexo nao existir mais
+    Os mesmos frames podem ser enviados para varios destinatarios.
+    """
+    filename = message.get("filename", "arquivo_recebido")
+    prefix = f"file={message['sender']}||{filename}||"
+    if "content" in message:
+        return [encode_frame(FRAME_TEXT, prefix + message["content"])]
+    spool = attachments.open_spool(message["hash"], base64_text=not binary)
+    if spool is None:
+        log(f"[ARQUIVO] Anexo '{filename}' não encontrado no armazenamento")
+        return None
+    spool, size = spool
+    if not binary and len(prefix.encode(FORMAT)) + size <= MAX_FRAME_SIZE:
+        return [FileFrame(FRAME_TEXT, prefix, spool, size)]
+
+    transfer_id = next(transfer_ids)
+    if binary:
+        file_size = size
+        chunk_size = CHUNK_SIZE
+        chunk_type, chunk_prefix = FRAME_BINARY, CHUNK_HEADER.pack(transfer_id)
+    else:
+        # Pedacos com tamanho multiplo de 4: cada um decodifica sozinho no cliente
+        file_size = message["size"]
+        chunk_size = CHUNK_SIZE // 3 * 4
+        chunk_type, chunk_prefix = FRAME_TEXT, f"file_chunk={transfer_id}||"
+    frames = [encode_frame(FRAME_TEXT, f"file_start={transfer_id}||{message['sender']}||{filename}||{file_size}")]
+    for offset in range(0, size, chunk_size):
+        frames.append(FileFrame(chunk_type, chunk_prefix, spool, min(chunk_size, size - offset), offset))
+    frames.append(encode_frame(FRAME_TEXT, f"file_end={transfer_id}"))
+    return frames
+
+def send_frames(conn, frames, replay=False):
+    """
+    Envia os frames de uma entrega, em ordem
+    Se o envio falhar no meio de um arquivo em streaming ("file_start=" ja
+    enviado), avisa o cliente com "file_abort=" antes de repassar o erro:
+    sem isso o arquivo parcial ficaria aberto no cliente para sempre
+    """
+    open_transfer = None
+    try:
+        for frame in frames:
+            conn.sendall(frame, replay=replay)
+            if is_file_control_frame(frame):
+                key, _, value = bytes(frame[HEADER_SIZE:]).decode(FORMAT).partition("=")
+                open_transfer = value.split("||", 1)[0] if key == "file_start" else None
+    except Exception:
+        if open_transfer is not None:
+            try:
+                conn.sendall(encode_frame(FRAME_TEXT, f"file_abort={open_transfer}"), replay=replay)
+            except Exception:
+                pass
+        raise
+
+def message_frames(message, is_private, binary):
+    """Frames de entrega de uma mensagem do historico (msg= em texto ou o arquivo do spool)"""
+    if message["type"] == "msg":
+        if is_private:
+            text = f"[{message['sender']} -> {message['destination']}]: {message['content']}"
+        else:
+            text = f"[{message['sender']} -> todos]: {message['content']}"
+        return [encode_frame(FRAME_TEXT, f"msg={text}")]
+    if message["type"] == "file":
+        return file_message_frames(message, binary)
+    return None
+
+# Historicos com limite de quantidade, bytes e idade (ver history.py)
+global_messages = MessageHistory(HISTORY_MAX_MESSAGES, HISTORY_MAX_BYTES, HISTORY_MAX_AGE,
+                                 on_discard=release_attachment)  # Mensagens publicas
+private_messages = MessageHistory(HISTORY_MAX_MESSAGES, HISTORY_MAX_BYTES, HISTORY_MAX_AGE,
+                                  index_key=conversation_key,
+                                  on_discard=release_attachment) # Mensagens privadas, indexadas por conversa
+transfer_ids = itertools.count(1) # Ids das transferencias em streaming (unicos no servidor)
+
+def open_message_logs(data_dir, max_segments=LOG_MAX_SEGMENTS):
+    """
+    Abre (ou recupera) o log em disco de cada historico
+    - Globais: continuam em disco e as paginas antigas sao lidas via mmap
+    - Privadas: as mais recentes voltam para a memoria, pois a consulta por
+      conversa usa o indice em memoria
+    - max_segments: retencao de cada log (None = sem limite); ao apagar um
+      segmento, os anexos das mensagens dele sao liberados
+    - As referencias dos anexos sao recontadas a partir dos logs: sao eles que
+      guardam (e liberam) as mensagens de arquivo
+    """
+    references = {}
+    for name, history in (("global", global_messages), ("private", private_messages)):
+        message_log = MessageLog(os.path.join(data_dir, name), max_segments=max_segments,
+                                 on_error=lambda error: log(f"[ERRO LOG] {error}"),
+                                 on_discard=release_attachment)
+        if message_log.recovered_bytes:
+            log(f"[SERVIDOR] Log {name}: {message_log.recovered_bytes} bytes de registros incompletos descartados")
+        for _, _, message in message_log.scan():
+            if message.get("type") == "file" and "hash" in message:
+                references[message["hash"]] = references.get(message["hash"], 0) + 1
+        history.attach_log(message_log, preload=history is private_messages)
+    attachments.set_references(references)
+
+def close_message_logs():
+    """Grava o que estiver pendente e fecha os logs em disco"""
+    for history in (global_messages, private_messages):
+        if history.log is not None:
+            history.log.close()
+
+def open_attachment_store(data_dir):
+    """Abre o armazenamento de anexos em data_dir (ou em um diretorio temporario sem persistencia)"""
+    global attachments, attachments_tmpdir
+    if data_dir:
+        directory = os.path.join(data_dir, "attachments")
+    else:
+        directory = attachments_tmpdir = tempfile.mkdtemp(prefix="chat_attachments_")
+    attachments = AttachmentStore(directory)
+
+def close_attachment_store():
+    """Salva as referencias dos anexos (e apaga o diretorio temporario, se houver)"""
+    global attachments_tmpdir
+    if attachments is not None:
+        attachments.close()
+    if attachments_tmpdir:
+        shutil.rmtree(attachments_tmpdir, ignore_errors=True)
+        attachments_tmpdir = None
 
 def search_name_in_connections(name):
     """
-    Busca um usuario conectado pelo nome
+    Busca um usuario conectado pelo nome (O(1) pelo registro)
     Retorna o dicionario da conexao ou None se nao encontrado
     """
-    for conn in connections:
-        if conn["name"] == name:
-            return conn
-    return None
+    return connections.get(name)
 
-def name_already_exists(name):
+def delivery_size(message):
+    """Bytes aproximados para entregar uma mensagem do historico (arquivos pelo tamanho original)"""
+    if message["type"] == "file" and "content" not in message:
+        return message.get("size", 0)
+    return message_size(message)
+
+def replayable(message, max_bytes=HISTORY_PAGE_MAX_BYTES):
+    """
+    Indica se a mensagem e reenviada com o historico: arquivos maiores que uma
+    pagina inteira sao apenas anunciados (o reenvio passaria do limite da fila
+    de saida e o cliente ficaria com o arquivo pela metade)
+    """
+    return message["type"] != "file" or delivery_size(message) <= max_bytes
+
+def trim_page(page, max_bytes=HISTORY_PAGE_MAX_BYTES):
+    """
+    Limita uma pagina do historico em bytes, alem da quantidade de mensagens
+    - Descarta as mensagens mais antigas da pagina (a mais recente sempre fica;
+      arquivos fora do reenvio contam apenas os metadados, ver replayable)
+    - Retorna (pagina, cortada): as cortadas seguem disponiveis pela paginacao (before)
     """
-    Verifica se o nome ja esta sendo usado por outro usuario
-    Usado para evitar nomes duplicados no chat
+    total = 0
+    for index in range(len(page) - 1, -1, -1):
+        message = page[index][2]
+        total += delivery_size(message) if replayable(message, max_bytes) else message_size(message)
+        if total > max_bytes and index < len(page) - 1:
+            return page[index + 1:], True
+    return page, False
+
+def parse_history_request(message):
+    """
+    Valida "before" e "limit" de um pedido de historico (valores vindos do cliente)
+    - before: numero de sequencia (inteiro >= 0) ou ausente
+    - limit: inteiro (o tamanho da pagina e limitado depois a HISTORY_MAX_PAGE_SIZE)
+    Retorna (before, limit) ou None se algum dos dois for invalido
     """
-    for conn in connections:
-        if conn["name"] == name:
-            return True
-    return False
+    before = message.get("before")
+    if before is not None and (not isinstance(before, int) or isinstance(before, bool) or before < 0):
+        return None
+    try:
+        limit = int(message.get("limit", HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return before, limit
 
-def view_global_history(client_connection):
+def view_global_history(client_connection, before=None, limit=HISTORY_PAGE_SIZE):
     """
-    Envia todo o historico de mensagens globais para um cliente que acabou de se conectar
-    - Percorre a lista global_messages
-    - Envia cada mensagem formatada para o cliente
-    - Inclui delay entre mensagens para evitar spam
+    Envia uma pagina do historico de mensagens globais em um unico envio
+    - Por padrao, as ultimas HISTORY_PAGE_SIZE mensagens (cliente que acabou de entrar)
+    - before: numero de sequencia para pedir mensagens mais antigas (pagina anterior)
+    - Clientes com FEATURE_HISTORY recebem a pagina em um frame "history=" (JSON);
+      os demais recebem os frames antigos (msg=/file=) concatenados
+    - Arquivos do historico seguem logo apos a pagina, enviados do spool em disco
+      (em pedacos FRAME_BINARY para quem negociou FEATURE_BINARY, "file=" para os demais)
+    - A pagina e limitada tambem em bytes (HISTORY_PAGE_MAX_BYTES) e enviada como
+      reenvio (replay): a politica de consumidor lento nao descarta nem desconecta
+      por causa dela; arquivos maiores que a pagina inteira sao apenas anunciados
+    - Se o envio parar no meio de um arquivo, o cliente recebe "file_abort=" (ver send_frames)
     """
     conn = client_connection["conn"]
-    for msg in global_messages:
-        try:
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    page, has_more = global_messages.page(before, limit)
+    page, trimmed = trim_page(page)
+    has_more = has_more or trimmed
+
+    try:
+        # Montagem dentro do try: um anexo com problema nao derruba a entrada do cliente
+        paged = FEATURE_HISTORY in client_connection["features"]
+        binary = FEATURE_BINARY in client_connection["features"]
+        frames = []
+        file_frames = []
+        items = []
+        for seq, timestamp, msg in page:
             if msg["type"] == "msg":
                 message = f"[{msg['sender']} -> todos]: {msg['content']}"
-                conn.send(f"msg={message}".encode(FORMAT))
+                if paged:
+                    items.append({"seq": seq, "time": timestamp, "type": "msg", "text": message})
+                else:
+                    frames.append(encode_frame(FRAME_TEXT, f"msg={message}"))
             elif msg["type"] == "file":
-                filename = msg.get("filename", "arquivo_recebido")
-                data = msg["content"]
-                sender = msg["sender"]
-                # Formato: remetente||nome_arquivo||dados_base64
-                conn.send(f"file={sender}||{filename}||{data}".encode(FORMAT))
-            time.sleep(0.2) # Delay para nao sobrecarregar o cliente
-        except Exception as e:
-            gui.log(f"Erro ao enviar histórico para {client_connection['name']}: {e}")
+                message = f"[{msg['sender']} -> todos]: 📎 {msg.get('filename', 'arquivo_recebido')}"
+                if not replayable(msg):
+                    message += f" ({delivery_size(msg)/1024/1024:.1f}MB, grande demais para o histórico)"
+                    if paged:
+                        items.append({"seq": seq, "time": timestamp, "type": "file", "text": message})
+                    else:
+                        frames.append(encode_frame(FRAME_TEXT, f"msg={message}"))
+                    continue
+                delivery = file_message_frames(msg, binary)
+                if delivery is None:
+                    continue
+                if paged:
+                    items.append({"seq": seq, "time": timestamp, "type": "file", "text": message})
+                file_frames.extend(delivery)
+
+        if paged:
+            history_page = {
+                "control": "4all",
+                "messages": items,
+                "before": page[0][0] if page else before,
+                "has_more": has_more
+            }
+            frames.append(encode_frame(FRAME_TEXT, f"history={json.dumps(history_page)}"))
+
+        # Uma unica chamada de envio para a pagina inteira; arquivos seguem direto do disco
+        conn.sendall(b"".join(frames), replay=True)
+        send_frames(conn, file_frames, replay=True)
+    except Exception as e:
+        log(f"Erro ao enviar histórico para {client_connection['name']}: {e}")
+
+def view_private_history(client_connection, peer, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Envia uma pagina da conversa privada entre o cliente e outro usuario
+    - Junta as duas direcoes da conversa (enviadas e recebidas) pelo numero de sequencia
+    - Usa o indice por conversa: o custo depende do tamanho da pagina, nao do historico
+    - Responde com um frame "history=" com "control" igual ao nome do outro usuario
+    """
+    conn = client_connection["conn"]
+    name = client_connection["name"]
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    sent, sent_more = private_messages.page(before, limit, (name, peer))
+    received, received_more = private_messages.page(before, limit, (peer, name))
+    merged = sorted(sent + received, key=lambda entry: entry[0])
+    page, trimmed = trim_page(merged[-limit:])
+    has_more = sent_more or received_more or len(merged) > limit or trimmed
+
+    items = []
+    for seq, timestamp, msg in page:
+        if msg["type"] == "msg":
+            text = f"[{msg['sender']} -> {msg['destination']}]: {msg['content']}"
+        else:
+            text = f"[{msg['sender']} -> {msg['destination']}]: 📎 {msg.get('filename', 'arquivo_recebido')}"
+        items.append({"seq": seq, "time": timestamp, "type": msg["type"], "text": text})
+
+    history_page = {
+        "control": peer,
+        "messages": items,
+        "before": page[0][0] if page else before,
+        "has_more": has_more
+    }
+    try:
+        conn.sendall(encode_frame(FRAME_TEXT, f"history={json.dumps(history_page)}"), replay=True)
+    except Exception as e:
+        log(f"Erro ao enviar histórico privado para {name}: {e}")
 
 def send_online_users_list(client_connection):
     """
@@ -251,7 +792,7 @@ def send_online_users_list(client_connection):
     try:
         online_users = []
         # Para não incluir o próprio usuário na contagem:
-        for connection in connections:
+        for connection in connections.snapshot():
             if connection["name"] != client_connection["name"]:  # Excluir o próprio usuário
                 user_info = {
                     "name": connection["name"],
@@ -261,244 +802,979 @@ def send_online_users_list(client_connection):
         
         # Envia a lista como JSON
         users_data = json.dumps(online_users)
-        conn.send(f"online_users={users_data}".encode(FORMAT))
-        gui.log(f"[Lista de Usuários] Enviada para {client_connection['name']} - {len(online_users)} outros usuários online")
+        send_text(conn, f"online_users={users_data}")
+        log(f"[Lista de Usuários] Enviada para {client_connection['name']} - {len(online_users)} outros usuários online")
         
     except Exception as e:
-        gui.log(f"Erro ao enviar lista de usuários para {client_connection['name']}: {e}")
+        log(f"Erro ao enviar lista de usuários para {client_connection['name']}: {e}")
+
+def send_span_name(conn):
+    """
+    Nome do span da entrega a um destinatario: "send" quando sendall() envia
+    no socket; "enqueue" quando apenas coloca na fila e o span "send" e medido
+    pela thread escritora (QueuedConnection)
+    """
+    return "enqueue" if getattr(conn, "traces_writes", False) else "send"
 
-def send_message_to_user(sending_conn, client_connection, is_private):
+def send_message_to_user(message, client_connection, is_private):
     """
-    Envia a ultima mensagem de um usuario para outro usuario especifico
-    - sending_conn: quem enviou a mensagem
+    Envia uma mensagem (ja guardada no historico) para um usuario especifico
+    - message: a mensagem recebida, e nao a ultima do historico: com varios
+      remetentes ao mesmo tempo, a ultima pode ja ser de outra pessoa
     - client_connection: quem vai receber
     - is_private: True para mensagem privada, False para global
     """
     conn = client_connection["conn"]
     dest_name = client_connection["name"]
-    from_name = sending_conn["name"] if sending_conn != 0 else "Servidor"
 
-    messages_source = private_messages if is_private else global_messages
-    
-    if is_private:
-        # Para mensagens privadas, filtrar apenas mensagens para este usuario
-        messages_for_client = [
-            msg for msg in messages_source
-            if (msg["sender"] == from_name and msg["destination"] == dest_name)
-        ]
-    else:
-        # Para mensagens globais, pegar todas
-        messages_for_client = messages_source
-
-    if messages_for_client:
-        last_msg = messages_for_client[-1]
-        try:
-            if last_msg["type"] == "msg":
-                if is_private:
-                    message = f"[{last_msg['sender']} -> {last_msg['destination']}]: {last_msg['content']}"
-                else:
-                    message = f"[{last_msg['sender']} -> todos]: {last_msg['content']}"
-                conn.send(f"msg={message}".encode(FORMAT))
-            elif last_msg["type"] == "file":
-                filename = last_msg.get("filename", "arquivo_recebido")
-                data = last_msg["content"]
-                sender = last_msg["sender"]
-                # Formato: remetente||nome_arquivo||dados_base64
-                conn.send(f"file={sender}||{filename}||{data}".encode(FORMAT))
-        except Exception as e:
-            gui.log(f"Erro ao enviar mensagem para {dest_name}: {e}")
+    started = time.perf_counter()
+    frames = message_frames(message, is_private, FEATURE_BINARY in client_connection["features"])
+    if frames is None:
+        return
+    sent_at = time.perf_counter()
+    try:
+        send_frames(conn, frames)
+    except Exception as e:
+        log(f"Erro ao enviar mensagem para {dest_name}: {e}")
+    kind = "private" if is_private else "user"
+    metrics.observe_fanout(kind, started, 1)
+    trace = tracer.current()
+    if trace:
+        ended = time.perf_counter()
+        trace.add(send_span_name(conn), sent_at, ended, recipient=dest_name)
+        trace.add("fanout", started, ended, kind=kind, recipients=1)
 
-def send_message_to_all(user_conn):
+def send_message_to_all(message, user_conn):
     """
-    Envia a ultima mensagem global para todos os usuarios conectados
+    Envia uma mensagem global (ja guardada no historico) para todos os usuarios conectados
     Exclui o remetente da lista de destinatarios
+    Percorre um snapshot do registro: entradas e saidas durante o envio nao interferem
+    Os frames sao montados no maximo uma vez por formato (FRAME_BINARY ou texto);
+    arquivos sao abertos uma vez e enviados a cada destinatario com sendfile
     """
-    for conn in connections:
+    started = time.perf_counter()
+    variants = {} # FEATURE_BINARY do destinatario -> frames
+    trace = tracer.current() # Mensagem amostrada: um span "send" por destinatario
+    recipients = 0
+    for conn in connections.snapshot():
         if conn["conn"] != user_conn["conn"]:
-            send_message_to_user(user_conn, conn, is_private=False)
+            binary = FEATURE_BINARY in conn["features"]
+            if binary not in variants:
+                variants[binary] = message_frames(message, is_private=False, binary=binary)
+            frames = variants[binary]
+            if frames is None:
+                continue
+            recipients += 1
+            sent_at = time.perf_counter() if trace else 0
+            try:
+                send_frames(conn["conn"], frames)
+            except Exception as e:
+                log(f"Erro ao enviar mensagem para {conn['name']}: {e}")
+            if trace:
+                trace.add(send_span_name(conn["conn"]), sent_at, time.perf_counter(), recipient=conn["name"])
+    metrics.observe_fanout("global", started, recipients)
+    if trace:
+        trace.add("fanout", started, time.perf_counter(), kind="global", recipients=recipients)
 
-def handle_clients(conn, addr):
+def handle_frame(conn, addr, user_conn, frame_type, payload, received_at=None):
     """
-    Funcao principal para gerenciar cada cliente conectado
-    Roda em thread separada para cada conexao
-    Processa todos os tipos de mensagem JSON recebidas:
+    Interpreta um frame recebido (usado pelos dois motores do servidor)
+    - FRAME_JSON: mensagem do protocolo, tratada por handle_message
+    - FRAME_BINARY: pedaco de arquivo em bytes crus de uma transferencia em streaming
+    - received_at: instante (time.perf_counter) da leitura do socket que trouxe
+      o frame; inicio do trace quando a mensagem e amostrada
+    - Retorna o registro do usuario (ver handle_message)
+    """
+    with tracer.message(received_at) as trace:
+        if frame_type == FRAME_JSON:
+            with tracer.span("decode", bytes=len(payload)):
+                message = json.loads(payload.decode(FORMAT))
+            kind = message.get("type")
+            kind = kind if kind in MESSAGE_TYPES else "unknown"
+            metrics.count_in(kind, HEADER_SIZE + len(payload))
+            if trace:
+                trace.args.update(type=kind, user=user_conn["name"] if user_conn else None)
+            with tracer.span("route", type=kind):
+                return handle_message(conn, addr, user_conn, message)
+
+        if frame_type == FRAME_BINARY and user_conn is not None:
+            metrics.count_in("binary", HEADER_SIZE + len(payload))
+            if trace:
+                trace.args.update(type="binary", user=user_conn["name"])
+            with tracer.span("route", type="binary"):
+                transfer_id, data = decode_binary_chunk(payload)
+                relay_file_chunk(user_conn, transfer_id, raw=data)
+            return user_conn
+
+        log(f"[ERRO PROTOCOLO] {addr[0]}:{addr[1]} enviou frame de tipo inesperado ({frame_type})")
+        return user_conn
+
+def handle_message(conn, addr, user_conn, message):
+    """
+    Processa uma mensagem JSON recebida de um cliente
+    Usado pelos dois motores do servidor (threads e eventos)
+    - user_conn: registro do usuario (None enquanto o nome nao foi definido)
+    - Retorna o registro do usuario, que pode ter sido criado por "name"
+    Tipos de mensagem:
     - "name": definir nome do usuario
     - "online_usr": solicitar lista de usuarios
     - "msg": enviar mensagem de texto
     - "file": enviar arquivo
     """
-    gui.log(f"[Conexão] Novo usuário conectado: {addr}")
-    global connections
-    gui.update_stats(len(connections))
+    if message["type"] == "name":
+        name = message["message"]
+        
+        # Cada conexao registra um unico nome
+        if user_conn is not None:
+            send_text(conn, f"msg=[Servidor]: Você já está registrado como {user_conn['name']}.")
+            return user_conn
+        
+        # Criar registro do usuario
+        # Recursos anunciados pelo cliente (clientes antigos nao enviam "features")
+        features = set(message.get("features", [])) & SERVER_FEATURES
+        new_user = {"conn": conn, "addr": addr, "name": name, "transfers": {}, "features": features}
+        
+        # Verificar se o nome ja existe (verificacao e registro atomicos)
+        if not connections.add(new_user):
+            error_msg = f"❌ Nome '{name}' já está sendo usado! Escolha outro nome."
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            # Solicitar novo nome
+            send_text(conn, f"msg=[Servidor]: Digite um novo nome:")
+            log(f"[NOME REJEITADO] '{name}' já existe - solicitando novo nome para {addr[0]}")
+            return user_conn
+        
+        user_conn = new_user
+        log(f"[USUÁRIO CONECTADO] {name} conectado de {addr}")
+        
+        try:
+            # Confirmar os recursos aceitos antes das boas-vindas
+            send_text(conn, f"features={json.dumps(sorted(features))}")
+            
+            # Enviar mensagem de boas-vindas
+            welcome_msg = f"✅ Bem-vindo ao chat, {name}!"
+            send_text(conn, f"msg=[Servidor]: {welcome_msg}")
+            
+            # Enviar as mensagens globais mais recentes (paginas antigas sob demanda)
+            view_global_history(user_conn)
+        except Exception:
+            # user_conn ainda nao chegou a quem chamou: sem isso o nome ficaria
+            # registrado (e recebendo broadcasts) depois da desconexao
+            connections.remove(user_conn)
+            log(f"[DESCONEXÃO] '{name}' ({addr[0]}:{addr[1]}) removido: falha ao concluir a entrada")
+            raise
 
-    user_conn = None # Sera definido quando o usuario enviar seu nome
+    elif message["type"] == "history":
+        # Verificar se o usuário já se registrou
+        if user_conn is None:
+            error_msg = "❌ Você precisa definir um nome primeiro!"
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return user_conn
 
-    while True:
-        try:
-            data = conn.recv(2048 * 10) # Buffer grande para arquivos
-            if not data:
-                break
+        # Pagina de mensagens mais antigas, pedida sob demanda pelo cliente
+        # control: "4all" (ou ausente) = historico global; nome de usuario = conversa privada
+        control = message.get("control", "4all")
+        request = parse_history_request(message)
+        if request is None:
+            send_text(conn, "msg=[Servidor]: ❌ Pedido de histórico inválido (before/limit).")
+            log(f"[ERRO] {user_conn['name']} pediu histórico com before/limit inválidos")
+            return user_conn
+        before, limit = request
+        if control in ("4all", "dontcare"):
+            view_global_history(user_conn, before, limit)
+        else:
+            view_private_history(user_conn, control, before, limit)
 
-            message = json.loads(data.decode(FORMAT))
-
-            if message["type"] == "name":
-                name = message["message"]
-                
-                # Verificar se o nome ja existe
-                if name_already_exists(name):
-                    error_msg = f"❌ Nome '{name}' já está sendo usado! Escolha outro nome."
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    # Solicitar novo nome
-                    conn.send(f"msg=[Servidor]: Digite um novo nome:".encode(FORMAT))
-                    gui.log(f"[NOME REJEITADO] '{name}' já existe - solicitando novo nome para {addr[0]}")
-                    continue
-                
-                # Criar registro do usuario
-                user_conn = {"conn": conn, "addr": addr, "name": name}
-                connections.append(user_conn)
-                gui.log(f"[USUÁRIO CONECTADO] {name} conectado de {addr}")
-                gui.update_stats(len(connections))
-                
-                # Enviar mensagem de boas-vindas
-                welcome_msg = f"✅ Bem-vindo ao chat, {name}!"
-                conn.send(f"msg=[Servidor]: {welcome_msg}".encode(FORMAT))
-                
-                # Enviar historico de mensagens globais
-                view_global_history(user_conn)
-
-            elif message["type"] == "online_usr":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                # Envia a lista de usuários online
-                send_online_users_list(user_conn)
-
-            elif message["type"] == "msg":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                if message["control"] == "4all":
-                    # Mensagem global para todos
-                    new_message = {
-                        "sender": user_conn["name"],
-                        "destination": "all",
-                        "type": "msg",
-                        "content": message["message"]
-                    }
-                    global_messages.append(new_message)
-                    gui.log(f"[Mensagem Global] {user_conn['name']}: {message['message'][:50]}...")
-                    gui.increment_message_count()
-                    send_message_to_all(user_conn)
-                else:
-                    # Mensagem privada para usuario especifico
-                    destination = message["control"]
-                    dest_conn = search_name_in_connections(destination)
-                    if dest_conn:
-                        new_message = {
-                            "sender": user_conn["name"],
-                            "destination": destination,
-                            "type": "msg",
-                            "content": message["message"]
-                        }
-                        private_messages.append(new_message)
-                        gui.log(f"[Mensagem Privada] {user_conn['name']} -> {destination}: {message['message'][:50]}...")
-                        gui.increment_message_count()
-                        send_message_to_user(user_conn, dest_conn, is_private=True)
-                    else:
-                        # Enviar mensagem de erro para o remetente
-                        error_msg = f"❌ Usuário '{destination}' não encontrado ou offline."
-                        conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                        gui.log(f"[ERRO] {user_conn['name']} tentou enviar mensagem para '{destination}' (não encontrado)")
-
-            elif message["type"] == "file":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                destination = message["control"]
-                filename = message.get("filename", "arquivo_recebido")
-                file_data = message["message"] # Dados em base64
-                
-                # Verificar tamanho do arquivo (em Base64)
-                file_size_b64 = len(file_data)
-                file_size_bytes = (file_size_b64 * 3) // 4  # Aproximação do tamanho real
-                
-                gui.log(f"[ARQUIVO] {user_conn['name']} enviando '{filename}' ({file_size_bytes/1024:.1f}KB)")
-                
+    elif message["type"] == "online_usr":
+        # Verificar se o usuário já se registrou
+        if user_conn is None:
+            error_msg = "❌ Você precisa definir um nome primeiro!"
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return user_conn
+            
+        # Envia a lista de usuários online
+        send_online_users_list(user_conn)
+
+    elif message["type"] == "msg":
+        # Verificar se o usuário já se registrou
+        if user_conn is None:
+            error_msg = "❌ Você precisa definir um nome primeiro!"
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return user_conn
+            
+        if message["control"] == "4all":
+            # Mensagem global para todos
+            new_message = {
+                "sender": user_conn["name"],
+                "destination": "all",
+                "type": "msg",
+                "content": message["message"]
+            }
+            with tracer.span("store"):
+                global_messages.append(new_message)
+            log(f"[Mensagem Global] {user_conn['name']}: {message['message'][:50]}...")
+            stats.increment_messages()
+            send_message_to_all(new_message, user_conn)
+        else:
+            # Mensagem privada para usuario especifico
+            destination = message["control"]
+            dest_conn = search_name_in_connections(destination)
+            if dest_conn:
                 new_message = {
                     "sender": user_conn["name"],
                     "destination": destination,
-                    "type": "file",
-                    "content": file_data,
-                    "filename": filename
+                    "type": "msg",
+                    "content": message["message"]
                 }
-                
-                if destination == "4all":
-                    # Arquivo global para todos
-                    global_messages.append(new_message)
-                    gui.log(f"[ARQUIVO GLOBAL] {user_conn['name']}: {filename}")
-                    gui.increment_message_count()
-                    send_message_to_all(user_conn)
-                else:
-                    # Arquivo privado para usuario especifico
-                    dest_conn = search_name_in_connections(destination)
-                    if dest_conn:
-                        private_messages.append(new_message)
-                        gui.log(f"[ARQUIVO PRIVADO] {user_conn['name']} → {destination}: {filename}")
-                        gui.increment_message_count()
-                        send_message_to_user(user_conn, dest_conn, is_private=True)
-                    else:
-                        # Enviar mensagem de erro para o remetente
-                        error_msg = f"❌ Usuário '{destination}' não encontrado. Arquivo '{filename}' não foi entregue."
-                        conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
+                with tracer.span("store"):
+                    private_messages.append(new_message)
+                log(f"[Mensagem Privada] {user_conn['name']} -> {destination}: {message['message'][:50]}...")
+                stats.increment_messages()
+                send_message_to_user(new_message, dest_conn, is_private=True)
+            else:
+                # Enviar mensagem de erro para o remetente
+                error_msg = f"❌ Usuário '{destination}' não encontrado ou offline."
+                send_text(conn, f"msg=[Servidor]: {error_msg}")
+                log(f"[ERRO] {user_conn['name']} tentou enviar mensagem para '{destination}' (não encontrado)")
 
-        except json.JSONDecodeError as e:
-            gui.log(f"[ERRO JSON] Conexão {addr[0]}:{addr[1]} enviou dados inválidos: {e}")
-            break
+    elif message["type"] == "file":
+        # Verificar se o usuário já se registrou
+        if user_conn is None:
+            error_msg = "❌ Você precisa definir um nome primeiro!"
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return user_conn
+            
+        destination = message["control"]
+        filename = message.get("filename", "arquivo_recebido")
+        try:
+            with tracer.span("decode_file"):
+                file_data = base64.b64decode(message["message"]) # Dados em base64
+        except ValueError:
+            send_text(conn, f"msg=[Servidor]: ❌ Arquivo '{filename}' inválido (base64 corrompido).")
+            return user_conn
+
+        # O historico guarda apenas a referencia: o conteudo fica uma unica vez no disco
+        with tracer.span("store_attachment", bytes=len(file_data)):
+            file_hash, file_size = attachments.put(file_data)
+        log(f"[ARQUIVO] {user_conn['name']} enviando '{filename}' ({file_size/1024:.1f}KB)")
+        
+        new_message = {
+            "sender": user_conn["name"],
+            "destination": destination,
+            "type": "file",
+            "hash": file_hash,
+            "filename": filename,
+            "size": file_size
+        }
+        
+        if destination == "4all":
+            # Arquivo global para todos
+            with tracer.span("store"):
+                global_messages.append(new_message)
+            log(f"[ARQUIVO GLOBAL] {user_conn['name']}: {filename}")
+            stats.increment_messages()
+            send_message_to_all(new_message, user_conn)
+        else:
+            # Arquivo privado para usuario especifico
+            dest_conn = search_name_in_connections(destination)
+            if dest_conn:
+                with tracer.span("store"):
+                    private_messages.append(new_message)
+                log(f"[ARQUIVO PRIVADO] {user_conn['name']} → {destination}: {filename}")
+                stats.increment_messages()
+                send_message_to_user(new_message, dest_conn, is_private=True)
+            else:
+                # Nenhuma mensagem guardou o anexo: devolve a referencia
+                attachments.release(file_hash)
+                # Enviar mensagem de erro para o remetente
+                error_msg = f"❌ Usuário '{destination}' não encontrado. Arquivo '{filename}' não foi entregue."
+                send_text(conn, f"msg=[Servidor]: {error_msg}")
+
+    elif message["type"] in ("file_start", "file_chunk", "file_end"):
+        # Verificar se o usuário já se registrou
+        if user_conn is None:
+            error_msg = "❌ Você precisa definir um nome primeiro!"
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return user_conn
+
+        if "transfer_id" not in message:
+            send_text(conn, "msg=[Servidor]: ❌ Transferência de arquivo inválida (sem transfer_id).")
+            log(f"[ERRO] {user_conn['name']} enviou {message['type']} sem transfer_id")
+            return user_conn
+
+        if message["type"] == "file_start":
+            start_file_transfer(user_conn, message)
+        elif message["type"] == "file_chunk":
+            relay_file_chunk(user_conn, message["transfer_id"], b64=message.get("message", ""))
+        else:
+            finish_file_transfer(user_conn, message)
+
+    return user_conn
+
+def relay_to_recipients(recipients, text):
+    """
+    Envia o mesmo frame de texto para cada destinatario de uma transferencia
+    Remove da lista quem falhar, para nao tentar de novo a cada pedaco
+    """
+    for recipient in list(recipients):
+        try:
+            send_text(recipient["conn"], text)
         except Exception as e:
-            gui.log(f"[ERRO CONEXÃO] {addr[0]}:{addr[1]} - {e}")
-            break
+            log(f"Erro ao repassar arquivo para {recipient['name']}: {e}")
+            recipients.remove(recipient)
 
-    # Limpeza da conexao ao desconectar
+def start_file_transfer(user_conn, message):
+    """
+    Inicia uma transferencia de arquivo em streaming
+    - Recusa com uma mensagem de erro um tamanho invalido
+    - Resolve os destinatarios (todos ou um usuario especifico)
+    - Registra a transferencia no user_conn do remetente; um transfer_id
+      reaproveitado cancela a transferencia anterior com o mesmo id
+    - Abre o spool do anexo, gravado a cada pedaco (historico e novos usuarios)
+    - Avisa os destinatarios com "file_start"
+    """
+    conn = user_conn["conn"]
+    destination = message["control"]
+    filename = message.get("filename", "arquivo_recebido")
+    try:
+        size = int(message.get("size", 0))
+    except (TypeError, ValueError):
+        size = -1
+    if size < 0:
+        send_text(conn, f"msg=[Servidor]: ❌ Arquivo '{filename}' inválido (tamanho).")
+        log(f"[ERRO] {user_conn['name']} iniciou envio de '{filename}' com tamanho inválido")
+        return
+
+    if destination == "4all":
+        recipients = [c for c in connections.snapshot() if c["conn"] != conn]
+    else:
+        dest_conn = search_name_in_connections(destination)
+        if not dest_conn:
+            error_msg = f"❌ Usuário '{destination}' não encontrado. Arquivo '{filename}' não foi entregue."
+            send_text(conn, f"msg=[Servidor]: {error_msg}")
+            return
+        recipients = [dest_conn]
+
+    transfer = {
+        "id": next(transfer_ids),
+        "destination": destination,
+        "filename": filename,
+        "size": size,
+        "received": 0,
+        "recipients": recipients,
+        "upload": attachments.upload()
+    }
+    previous = user_conn["transfers"].pop(message["transfer_id"], None)
+    if previous is not None:
+        abort_file_transfer(user_conn, previous)
+    user_conn["transfers"][message["transfer_id"]] = transfer
+    log(f"[ARQUIVO] {user_conn['name']} iniciou envio de '{filename}' ({size/1024:.1f}KB) para {destination}")
+
+    relay_to_recipients(recipients, f"file_start={transfer['id']}||{user_conn['name']}||{filename}||{size}")
+
+def relay_file_chunk(user_conn, transfer_id, raw=None, b64=None):
+    """
+    Repassa um pedaco do arquivo para os destinatarios e grava no spool do anexo
+    - O pedaco chega em bytes crus (FRAME_BINARY) ou em base64 (clientes antigos);
+      base64 corrompido e recusado com uma mensagem de erro, sem cancelar a transferencia
+    - Cada formato de saida e montado no maximo uma vez por pedaco:
+      FRAME_BINARY para quem negociou FEATURE_BINARY, texto base64 para os demais
+    - O FRAME_BINARY e um FileFrame que envia o pedaco com sendfile a partir do
+      spool recem-gravado (o mesmo que vai para o historico)
+    """
+    transfer = user_conn["transfers"].get(transfer_id)
+    if transfer is None:
+        return # Transferencia desconhecida (ex: destinatario nao encontrado)
+
+    if raw is None:
+        try:
+            raw = base64.b64decode(b64)
+        except (TypeError, ValueError):
+            send_text(user_conn["conn"], f"msg=[Servidor]: ❌ Pedaço de '{transfer['filename']}' "
+                                         "inválido (base64 corrompido).")
+            log(f"[ERRO] {user_conn['name']} enviou pedaço com base64 corrompido de '{transfer['filename']}'")
+            return
+    transfer["received"] += len(raw)
+    position = store_file_chunk(user_conn, transfer, raw)
+
+    started = time.perf_counter()
+    binary_frame = None
+    text_frame = None
+    for recipient in list(transfer["recipients"]):
+        try:
+            if FEATURE_BINARY in recipient["features"]:
+                if binary_frame is None:
+                    if position is None:
+                        binary_frame = encode_binary_chunk(transfer["id"], raw)
+                    else:
+                        binary_frame = FileFrame(FRAME_BINARY, CHUNK_HEADER.pack(transfer["id"]),
+                                                 transfer["upload"].open_reader(), len(raw), position)
+                recipient["conn"].sendall(binary_frame)
+            else:
+                if text_frame is None:
+                    if b64 is None:
+                        b64 = base64.b64encode(raw).decode(FORMAT)
+                    text_frame = encode_frame(FRAME_TEXT, f"file_chunk={transfer['id']}||{b64}")
+                recipient["conn"].sendall(text_frame)
+        except Exception as e:
+            log(f"Erro ao repassar arquivo para {recipient['name']}: {e}")
+            transfer["recipients"].remove(recipient)
+    metrics.observe_fanout("file_chunk", started, len(transfer["recipients"]))
+
+def store_file_chunk(user_conn, transfer, data):
+    """
+    Grava o pedaco no spool e retorna a posicao dele no arquivo
+    Se o disco falhar, retorna None e o arquivo segue apenas ao vivo (fora do historico)
+    """
+    upload = transfer["upload"]
+    if upload is None:
+        return None
+    try:
+        return upload.write(data)
+    except OSError as e:
+        upload.abort()
+        transfer["upload"] = None
+        log(f"[ARQUIVO] '{transfer['filename']}' de {user_conn['name']} não será guardado no histórico: {e}")
+        return None
+
+def finish_file_transfer(user_conn, message):
+    """
+    Conclui a transferencia: avisa os destinatarios com file_end e guarda o
+    arquivo no historico (global ou privado), como uma mensagem "file"
+    """
+    transfer = user_conn["transfers"].pop(message["transfer_id"], None)
+    if transfer is None:
+        return
+
+    relay_to_recipients(transfer["recipients"], f"file_end={transfer['id']}")
+    stats.increment_messages()
+    log(f"[ARQUIVO] {user_conn['name']} → {transfer['destination']}: '{transfer['filename']}' "
+        f"concluído ({transfer['received']/1024:.1f}KB)")
+
+    if transfer["upload"] is None:
+        return
+    try:
+        with tracer.span("store_attachment", bytes=transfer["received"]):
+            file_hash, file_size = transfer["upload"].commit()
+    except OSError as e:
+        transfer["upload"].abort()
+        log(f"[ARQUIVO] Erro ao guardar '{transfer['filename']}' no histórico: {e}")
+        return
+    new_message = {
+        "sender": user_conn["name"],
+        "destination": transfer["destination"],
+        "type": "file",
+        "hash": file_hash,
+        "filename": transfer["filename"],
+        "size": file_size
+    }
+    with tracer.span("store"):
+        if transfer["destination"] == "4all":
+            global_messages.append(new_message)
+        else:
+            private_messages.append(new_message)
+
+def abort_file_transfer(user_conn, transfer):
+    """Cancela uma transferencia: avisa os destinatarios com file_abort e apaga o spool"""
+    relay_to_recipients(transfer["recipients"], f"file_abort={transfer['id']}")
+    if transfer["upload"] is not None:
+        transfer["upload"].abort()
+    log(f"[ARQUIVO] Envio de '{transfer['filename']}' por {user_conn['name']} interrompido")
+
+def abort_file_transfers(user_conn):
+    """Cancela as transferencias em andamento de um usuario que desconectou"""
+    for transfer in user_conn["transfers"].values():
+        abort_file_transfer(user_conn, transfer)
+    user_conn["transfers"].clear()
+
+def disconnect_client(conn, addr, user_conn):
+    """
+    Remove o cliente das estruturas globais e fecha o socket
+    Chamado por ambos os motores quando a conexao termina
+    """
     if user_conn:
+        abort_file_transfers(user_conn)
         connections.remove(user_conn)
-        gui.log(f"[DESCONEXÃO] '{user_conn['name']}' ({addr[0]}:{addr[1]}) desconectado")
-        gui.update_stats(len(connections))
+        log(f"[DESCONEXÃO] '{user_conn['name']}' ({addr[0]}:{addr[1]}) desconectado")
     else:
-        # Remover conexao mesmo se user_conn nao foi criado (nome nao definido)
-        for i, conn_data in enumerate(connections):
-            if conn_data["conn"] == conn:
-                connections.pop(i)
-                gui.log(f"[DESCONEXÃO] Usuário não identificado ({addr[0]}:{addr[1]}) desconectado")
-                gui.update_stats(len(connections))
-                break
+        # Conexao encerrada antes de definir um nome (nunca entrou no registro)
+        log(f"[DESCONEXÃO] Usuário não identificado ({addr[0]}:{addr[1]}) desconectado")
     
     conn.close()
+    metrics.connections_open.dec()
+
+def handle_clients(conn, addr):
+    """
+    Funcao principal para gerenciar cada cliente conectado (motor "threads")
+    Roda em thread separada para cada conexao
+    Le os frames do socket e repassa cada mensagem para handle_message
+    """
+    log(f"[Conexão] Novo usuário conectado: {addr}")
+
+    user_conn = None # Sera definido quando o usuario enviar seu nome
+
+    try:
+        # Cada frame recebido corresponde a exatamente uma mensagem
+        reader = FrameReader()
+        while True:
+            data = conn.recv(RECV_SIZE)
+            if not data:
+                break
+            received_at = time.perf_counter()
+            for frame_type, payload in reader.feed(data):
+                user_conn = handle_frame(conn, addr, user_conn, frame_type, payload, received_at)
+
+    except json.JSONDecodeError as e:
+        log(f"[ERRO JSON] Conexão {addr[0]}:{addr[1]} enviou dados inválidos: {e}")
+    except FrameError as e:
+        log(f"[ERRO PROTOCOLO] Conexão {addr[0]}:{addr[1]} - {e}")
+    except Exception as e:
+        log(f"[ERRO CONEXÃO] {addr[0]}:{addr[1]} - {e}")
+
+    # Limpeza da conexao ao desconectar
+    disconnect_client(conn, addr, user_conn)
+
+class SlowConsumerPolicy:
+    """
+    Configuracao e contadores globais da politica para consumidores lentos
+    - "drop_oldest": descarta os frames mais antigos ainda nao enviados
+    - "drop_files": descarta primeiro os dados de arquivo pendentes (e os novos),
+      mantendo as mensagens de texto
+    - "disconnect": desconecta o cliente que parou de ler
+    Nenhuma politica descarta o reenvio do historico pedido pelo proprio cliente
+    (sendall(..., replay=True), limitado por HISTORY_PAGE_MAX_BYTES) nem os
+    frames que abrem/fecham transferencias (file_start/file_end/file_abort)
+    Contadores: quantas vezes cada politica atuou, frames descartados e
+    frames recusados por estourar o limite absoluto (OUTBOUND_MAX_BYTES)
+    """
+    def __init__(self, name=SLOW_CONSUMER_POLICY, high_water=SLOW_CONSUMER_HIGH_WATER):
+        self.lock = threading.Lock()
+        self.configure(name, high_water)
+        self.counts = {"drop_oldest": 0, "drop_files": 0, "disconnect": 0,
+                       "dropped_frames": 0, "dropped_bytes": 0, "overflow": 0}
+
+    def configure(self, name=SLOW_CONSUMER_POLICY, high_water=SLOW_CONSUMER_HIGH_WATER):
+        self.name = name
+        self.high_water = high_water
+
+    def record(self, event, frames=0, size=0):
+        with self.lock:
+            self.counts[event] += 1
+            self.counts["dropped_frames"] += frames
+            self.counts["dropped_bytes"] += size
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+slow_consumers = SlowConsumerPolicy()
+
+class ReplayFrame(bytes):
+    """Frame do reenvio do historico na fila de saida (ver OutboundQueue)"""
+
+def is_replay_frame(frame):
+    return type(frame) is ReplayFrame or (isinstance(frame, FileFrame) and getattr(frame, "replay", False))
+
+class OutboundQueue:
+    """
+    Fila de saida de uma conexao (base de QueuedConnection e BufferedConnection)
+    - Guarda frames inteiros, do mais antigo ao mais novo
+    - Acima da marca d'agua (slow_consumers.high_water) aplica a politica
+      configurada para consumidores lentos
+    - Frames de reenvio do historico (replay) nao contam para a marca d'agua
+      e nunca sao descartados: a pagina ja e limitada em bytes e foi pedida
+      pelo proprio cliente (ao entrar ou sob demanda)
+    - Acima de max_bytes o novo frame e recusado com OSError (exceto os avisos
+      file_start/file_end/file_abort, que sao pequenos)
+    - Chamadores devem garantir acesso exclusivo (lock ou thread unica)
+    """
+    def _init_queue(self, addr, max_bytes):
+        self.addr = addr
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.pending_bytes = 0 # Bytes na fila + bytes sendo enviados
+        self.replay_bytes = 0  # Parte de pending_bytes que e reenvio do historico
+        self.locked_head = False # True se o primeiro frame ja comecou a ser enviado
+        self.slow_counts = {"drop_oldest": 0, "drop_files": 0, "disconnect": 0}
+
+    def _enqueue(self, data, replay=False):
+        """Coloca um frame na fila aplicando a politica; retorna False se o frame foi descartado"""
+        if not replay and self.pending_bytes - self.replay_bytes + len(data) > slow_consumers.high_water:
+            if not self._apply_slow_policy(data):
+                return False
+
+        # Avisos de transferencia (file_start/file_end/file_abort) sao pequenos e sempre
+        # entram: um "file_abort" recusado deixaria o arquivo parcial aberto no cliente
+        if self.pending_bytes + len(data) > self.max_bytes and not is_file_control_frame(data):
+            slow_consumers.record("overflow", 1, len(data))
+            raise OSError(f"Fila de saída cheia ({self.pending_bytes/1024:.0f}KB pendentes)")
+
+        if replay:
+            if isinstance(data, FileFrame):
+                data.replay = True
+            else:
+                data = ReplayFrame(data)
+            self.replay_bytes += len(data)
+        self.queue.append(data)
+        self.pending_bytes += len(data)
+        metrics.count_out(data)
+        return True
+
+    def _sent(self, frames):
+        """Desconta frames ja enviados dos bytes pendentes"""
+        self.pending_bytes -= sum(len(frame) for frame in frames)
+        self.replay_bytes -= sum(len(frame) for frame in frames if is_replay_frame(frame))
+
+    def _apply_slow_policy(self, data):
+        """Aplica a politica de consumidor lento; retorna False se o novo frame deve ser descartado"""
+        policy = slow_consumers.name
+        if self.slow_counts[policy] == 0:
+            log(f"[CONSUMIDOR LENTO] {self.addr[0]}:{self.addr[1]} com {self.pending_bytes/1024:.0f}KB "
+                f"pendentes - política {policy}")
+        self.slow_counts[policy] += 1
+
+        if policy == "disconnect":
+            slow_consumers.record("disconnect")
+            self.evict()
+            raise OSError("Cliente desconectado por não ler as mensagens (consumidor lento)")
+
+        # O primeiro frame pode estar no meio do envio e nao pode ser descartado
+        start = 1 if self.locked_head else 0
+        kept = deque(list(self.queue)[:start])
+        candidates = list(self.queue)[start:]
+        dropped_frames = 0
+        dropped_bytes = 0
+        target = slow_consumers.high_water - len(data)
+        droppable = is_file_data_frame if policy == "drop_files" else \
+            lambda frame: not is_file_control_frame(frame)
+
+        for frame in candidates:
+            if self.pending_bytes - self.replay_bytes - dropped_bytes > target \
+                    and not is_replay_frame(frame) and droppable(frame):
+                dropped_frames += 1
+                dropped_bytes += len(frame)
+            else:
+                kept.append(frame)
+
+        self.queue = kept
+        self.pending_bytes -= dropped_bytes
+        accept_new = True
+        if policy == "drop_files" and \
+                self.pending_bytes - self.replay_bytes + len(data) > slow_consumers.high_water \
+                and is_file_data_frame(data):
+            # Ainda acima da marca: o novo dado de arquivo tambem e descartado
+            dropped_frames += 1
+            dropped_bytes += len(data)
+            accept_new = False
+
+        slow_consumers.record(policy, dropped_frames, dropped_bytes)
+        return accept_new
+
+def coalesce_frames(frames):
+    """Junta frames em memoria consecutivos em um unico envio; cada FileFrame segue separado"""
+    run = []
+    for frame in frames:
+        if isinstance(frame, FileFrame):
+            if run:
+                yield run[0] if len(run) == 1 else b"".join(run)
+                run = []
+            yield frame
+        else:
+            run.append(frame)
+    if run:
+        yield run[0] if len(run) == 1 else b"".join(run)
+
+class QueuedConnection(OutboundQueue):
+    """
+    Socket com fila de saida propria, usado pelo motor "threads"
+    - sendall() apenas coloca o frame na fila e retorna: um broadcast para N
+      usuarios custa N insercoes, sem esperar nenhum destinatario
+    - Uma thread escritora por conexao esvazia a fila, juntando os frames
+      pendentes em um unico envio; FileFrame e enviado do disco com sendfile
+    - A fila e limitada em bytes (ver OutboundQueue); acima disso sendall()
+      falha para esse destinatario, sem afetar os demais
+    - Frames de mensagens amostradas pelo tracer ganham o span "send" na
+      thread escritora, em volta do envio real do lote que os contem
+    """
+    traces_writes = True # O span "send" e medido pela thread escritora (ver send_span_name)
+
+    def __init__(self, sock, addr, max_bytes=OUTBOUND_MAX_BYTES):
+        self.sock = sock
+        self._init_queue(addr, max_bytes)
+        self.condition = threading.Condition() # Usa RLock: evict() pode ser chamado com o lock adquirido
+        self.closed = False
+        self.traced = [] # (frame na fila, trace_id) das mensagens amostradas ainda nao enviadas
+        self.writer = threading.Thread(target=self._writer_loop, name=f"writer-{addr[0]}:{addr[1]}", daemon=True)
+        self.writer.start()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, data, replay=False):
+        with self.condition:
+            if self.closed:
+                raise OSError("Conexão já encerrada")
+            if self._enqueue(data, replay):
+                trace = tracer.current()
+                if trace:
+                    self.traced.append((self.queue[-1], trace.trace_id))
+                self.condition.notify()
+
+    def evict(self):
+        """Politica "disconnect": fecha o socket; o leitor percebe e faz a limpeza"""
+        self.close()
+
+    def _writer_loop(self):
+        """Thread escritora: envia tudo o que estiver na fila, na ordem de chegada"""
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                batch = list(self.queue)
+                self.queue.clear()
+                traced, self.traced = self.traced, []
+
+            started = time.perf_counter()
+            try:
+                for data in coalesce_frames(batch):
+                    if isinstance(data, FileFrame):
+                        data.send_to(self.sock) # sendfile: o arquivo nao passa pelo Python
+                    else:
+                        self.sock.sendall(data)
+            except OSError:
+                # Destinatario com problema: encerra a conexao (o leitor percebe e faz a limpeza)
+                self.close()
+                return
+            if traced:
+                self._trace_sent(traced, batch, started)
+
+            with self.condition:
+                if not self.closed:
+                    self._sent(batch)
+            # Solta os frames enviados antes de esperar: os arquivos dos FileFrames fecham agora
+            batch = data = None
+
+    def _trace_sent(self, traced, batch, started):
+        """Span "send" de cada mensagem amostrada do lote (descartadas pela politica nao contam)"""
+        ended = time.perf_counter()
+        in_batch = {id(frame) for frame in batch}
+        recipient = f"{self.addr[0]}:{self.addr[1]}"
+        size = sum(len(frame) for frame in batch)
+        for frame, trace_id in traced:
+            if id(frame) in in_batch:
+                tracer.add_span(trace_id, "send", started, ended, recipient=recipient,
+                                frames=len(batch), bytes=size)
+
+    def close(self):
+        """Descarta o que estiver pendente e fecha o socket (acorda leitor e escritor)"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+            self.traced = []
+            self.pending_bytes = 0
+            self.replay_bytes = 0
+            self.condition.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
 
 def server_loop():
     """Loop principal do servidor em thread separada"""
     server.listen()
     
-    while gui.running:
+    while running:
         try:
             conn, addr = server.accept() # Aceita nova conexao
+            # Envios para este cliente passam pela fila de saida da conexao
+            conn = QueuedConnection(conn, addr)
+            metrics.connections_accepted.inc()
+            metrics.connections_open.inc()
             # Cria thread separada para cada cliente
             thread = threading.Thread(target=handle_clients, args=(conn, addr))
             thread.daemon = True
             thread.start()
         except Exception as e:
-            if gui.running:
-                gui.log(f"[ERRO SERVIDOR] {e}")
+            if running:
+                log(f"[ERRO SERVIDOR] {e}")
+            break
+
+class BufferedConnection(OutboundQueue):
+    """
+    Socket nao bloqueante usado pelo motor de eventos
+    - Expoe sendall() como um socket comum, para que send_text funcione igual
+    - sendall() tenta enviar na hora; o que sobrar fica na fila de saida
+    - Aceita tambem FileFrame, enviado do disco com os.sendfile
+    - O loop de eventos termina de enviar quando o socket fica pronto para escrita
+    - A fila de saida tem os mesmos limites e politicas da QueuedConnection
+    """
+    def __init__(self, sock, addr, selector, on_evict, max_bytes=OUTBOUND_MAX_BYTES):
+        self.sock = sock
+        self.selector = selector
+        self.on_evict = on_evict # Chamado quando a politica "disconnect" atua
+        self._init_queue(addr, max_bytes)
+        self.head_sent = 0 # Bytes ja enviados do primeiro frame da fila
+        self.reader = FrameReader()
+        self.events = selectors.EVENT_READ
+        self.user_conn = None # Sera definido quando o usuario enviar seu nome
+        self.closed = False
+        self.evicted = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def sendall(self, data, replay=False):
+        if self.closed or self.evicted:
+            raise OSError("Conexão já encerrada")
+        was_empty = not self.queue
+        if self._enqueue(data, replay) and was_empty:
+            # Se ja havia dados pendentes, o loop vai enviar quando o socket liberar
+            self.flush()
+
+    def flush(self):
+        """Envia o maximo possivel da fila sem bloquear"""
+        while self.queue:
+            head = self.queue[0]
+            try:
+                if isinstance(head, FileFrame):
+                    sent = head.send_some(self.sock, self.head_sent) # os.sendfile nao bloqueante
+                else:
+                    sent = self.sock.send(memoryview(head)[self.head_sent:])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.head_sent += sent
+            if self.head_sent < len(head):
+                self.locked_head = True
+                break
+            self.queue.popleft()
+            self.pending_bytes -= len(head)
+            if is_replay_frame(head):
+                self.replay_bytes -= len(head)
+            self.head_sent = 0
+            self.locked_head = False
+        self._update_events()
+
+    def _update_events(self):
+        """So pede notificacao de escrita enquanto houver dados pendentes"""
+        events = selectors.EVENT_READ
+        if self.queue:
+            events |= selectors.EVENT_WRITE
+        if events != self.events and not self.closed:
+            self.selector.modify(self.sock, events, data=self)
+            self.events = events
+
+    def evict(self):
+        """Politica "disconnect": descarta a fila e agenda a desconexao no loop de eventos"""
+        if self.evicted:
+            return
+        self.evicted = True
+        self.queue.clear()
+        self.pending_bytes = 0
+        self.replay_bytes = 0
+        self.on_evict(self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+
+def event_server_loop():
+    """
+    Loop principal do servidor no motor "events"
+    - Uma unica thread atende todas as conexoes com sockets nao bloqueantes
+    - selectors escolhe o melhor mecanismo do sistema (epoll, kqueue, ...)
+    - Cada conexao custa apenas um BufferedConnection, sem thread dedicada
+    """
+    selector = selectors.DefaultSelector()
+    evicted = [] # Conexoes desconectadas pela politica de consumidor lento
+    server.listen(socket.SOMAXCONN)
+    server.setblocking(False)
+    selector.register(server, selectors.EVENT_READ, data=None)
+
+    def accept():
+        try:
+            conn, addr = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        buffered = BufferedConnection(conn, addr, selector, evicted.append)
+        selector.register(conn, selectors.EVENT_READ, data=buffered)
+        metrics.connections_accepted.inc()
+        metrics.connections_open.inc()
+        log(f"[Conexão] Novo usuário conectado: {addr}")
+
+    def close(buffered):
+        if not buffered.closed:
+            disconnect_client(buffered, buffered.addr, buffered.user_conn)
+
+    def read(buffered):
+        addr = buffered.addr
+        try:
+            data = buffered.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log(f"[ERRO CONEXÃO] {addr[0]}:{addr[1]} - {e}")
+            close(buffered)
+            return
+        if not data:
+            close(buffered)
+            return
+        received_at = time.perf_counter()
+
+        try:
+            # Uma leitura pode conter varios frames (ou nenhum frame completo)
+            for frame_type, payload in buffered.reader.feed(data):
+                buffered.user_conn = handle_frame(buffered, addr, buffered.user_conn,
+                                                  frame_type, payload, received_at)
+        except json.JSONDecodeError as e:
+            log(f"[ERRO JSON] Conexão {addr[0]}:{addr[1]} enviou dados inválidos: {e}")
+            close(buffered)
+        except FrameError as e:
+            log(f"[ERRO PROTOCOLO] Conexão {addr[0]}:{addr[1]} - {e}")
+            close(buffered)
+        except Exception as e:
+            log(f"[ERRO CONEXÃO] {addr[0]}:{addr[1]} - {e}")
+            close(buffered)
+
+    def write(buffered):
+        try:
+            buffered.flush()
+        except OSError as e:
+            log(f"[ERRO CONEXÃO] {buffered.addr[0]}:{buffered.addr[1]} - {e}")
+            close(buffered)
+
+    while running:
+        try:
+            events = selector.select(timeout=1)
+        except Exception as e:
+            if running:
+                log(f"[ERRO SERVIDOR] {e}")
             break
 
+        for key, mask in events:
+            buffered = key.data
+            if buffered is None:
+                accept()
+                continue
+            if mask & selectors.EVENT_WRITE and not buffered.closed:
+                write(buffered)
+            if mask & selectors.EVENT_READ and not buffered.closed:
+                read(buffered)
+        while evicted:
+            close(evicted.pop())
+
+    selector.close()
+
 def window_create():
     """
     Cria a janela principal do servidor
@@ -517,38 +1793,168 @@ def window_create():
     title.pack(pady=15)   
     return window
 
-def start():
+def start(engine="threads", headless=False, log_target="console", log_file="server.log",
+          history_max_messages=HISTORY_MAX_MESSAGES, history_max_bytes=HISTORY_MAX_BYTES,
+          history_max_age=HISTORY_MAX_AGE, slow_policy=SLOW_CONSUMER_POLICY,
+          slow_high_water=SLOW_CONSUMER_HIGH_WATER, data_dir=DATA_DIR, log_max_segments=LOG_MAX_SEGMENTS,
+          metrics_port=METRICS_PORT,
+          trace_sample=0.0, trace_file=TRACE_FILE, profile_dir=None,
+          profile_sample_interval=PROFILE_SAMPLE_INTERVAL, profile_dump_interval=PROFILE_DUMP_INTERVAL,
+          profile_memory_frames=PROFILE_MEMORY_FRAMES):
     """
     Funcao principal do servidor
-    - Cria a interface gráfica
+    - Cria o socket principal
+    - Aplica os limites do historico (quantidade, bytes e idade)
+    - Configura a politica para consumidores lentos
+    - Abre o log de mensagens e os anexos em data_dir (None = apenas em memoria),
+      mantendo ate log_max_segments segmentos por log (None = sem limite)
+    - Expoe as metricas em HTTP local na porta metrics_port (0 = desativado)
+    - Com trace_sample > 0, rastreia essa fracao das mensagens em trace_file
+    - Com profile_dir, ativa o modo de perfil: amostragem de pilhas de todas as
+      threads e snapshots do tracemalloc, gravados em profile_dir
+    - Configura o destino do log: interface gráfica ou, no modo headless,
+      console, arquivo ou nenhum
     - Inicia o sistema de descoberta automatica
-    - Inicia o servidor em thread separada
-    - Executa o loop da interface
+    - Inicia o servidor com o motor escolhido:
+      "threads" (uma thread por conexao) ou "events" (loop de eventos unico)
+    - Sem headless, executa o loop da interface na thread principal
     """
-    global gui
-    
-    # Criar interface gráfica
-    gui = serverGUI()
-    
+    global running
+
+    create_server_socket()
+    running = True
+
+    # Limites do historico em memoria
+    for history in (global_messages, private_messages):
+        history.configure(history_max_messages, history_max_bytes, history_max_age)
+    slow_consumers.configure(slow_policy, slow_high_water)
+
+    # Configurar destino do log
+    if log_target == "file":
+        console_sink = FileLogSink(log_file)
+    elif log_target == "none":
+        console_sink = None
+    else:
+        console_sink = ConsoleLogSink()
+
+    gui = None
+    if headless:
+        set_log_sink(console_sink)
+    else:
+        if Tk is None:
+            raise RuntimeError("tkinter indisponível: execute com --headless")
+        # A GUI observa o log e as estatísticas, repassando o log ao console
+        gui = serverGUI(console_sink)
+        set_log_sink(gui)
+
+    # Log inicial
+    log("[SERVIDOR] Iniciando servidor de chat...")
+    log(f"[SERVIDOR] Sistema de descoberta ativo na porta {DISC_PORT}")
+    log(f"[SERVIDOR] Servidor principal ouvindo em {SERVER_IP}:{PORT}")
+    log(f"[SERVIDOR] Motor de conexões: {engine}")
+    log(f"[SERVIDOR] Histórico: até {history_max_messages} mensagens, "
+        f"{history_max_bytes/1024/1024:.0f}MB e {history_max_age/3600:.1f}h")
+    open_attachment_store(data_dir)
+    if data_dir:
+        open_message_logs(data_dir, log_max_segments)
+        log(f"[SERVIDOR] Log de mensagens em {os.path.abspath(data_dir)} "
+            f"({global_messages.log.stats()['records']} globais, {len(private_messages)} privadas recentes)")
+        if log_max_segments:
+            log(f"[SERVIDOR] Retenção do log: até {log_max_segments} segmentos de "
+                f"{SEGMENT_MAX_BYTES/1024/1024:.0f}MB por histórico")
+    if metrics_port:
+        open_metrics_server(metrics_port)
+    if trace_sample:
+        tracer.configure(trace_sample, trace_file)
+        log(f"[SERVIDOR] Rastreando {trace_sample:.1%} das mensagens em {os.path.abspath(trace_file)}")
+    if profile_dir:
+        open_profiler(profile_dir, profile_sample_interval, profile_dump_interval, profile_memory_frames)
+    log("[SERVIDOR] Aguardando conexões...")
+
     # Iniciar descoberta automática
     handle_discovery()
-    
+
+    loop = event_server_loop if engine == "events" else server_loop
+    if headless:
+        # Sem interface: o loop do servidor ocupa a thread principal
+        try:
+            loop()
+        finally:
+            stop_server()
+        return
+
     # Iniciar servidor em thread separada
-    server_thread = threading.Thread(target=server_loop, daemon=True)
+    server_thread = threading.Thread(target=loop, daemon=True)
     server_thread.start()
     
     # Executar interface gráfica (loop principal)
     gui.window.mainloop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor de chat")
+    parser.add_argument("--engine", choices=ENGINES, default="threads",
+                        help="threads: uma thread por conexao | events: loop de eventos (milhares de conexoes)")
+    parser.add_argument("--headless", action="store_true",
+                        help="executa sem interface grafica (sem tkinter)")
+    parser.add_argument("--log", choices=LOG_TARGETS, default="console", dest="log_target",
+                        help="destino do log: console, arquivo ou nenhum")
+    parser.add_argument("--log-file", default="server.log",
+                        help="arquivo usado com --log file (padrao: server.log)")
+    parser.add_argument("--history-max-messages", type=int, default=HISTORY_MAX_MESSAGES,
+                        help="mensagens mantidas em cada historico (global e privado)")
+    parser.add_argument("--history-max-mb", type=float, default=HISTORY_MAX_BYTES / (1024 * 1024),
+                        help="memoria maxima de cada historico, em MB")
+    parser.add_argument("--history-max-age", type=float, default=HISTORY_MAX_AGE,
+                        help="idade maxima das mensagens no historico, em segundos")
+    parser.add_argument("--slow-policy", choices=SLOW_CONSUMER_POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="o que fazer com clientes que nao leem: descartar antigas, "
+                             "descartar arquivos ou desconectar")
+    parser.add_argument("--slow-high-water-mb", type=float, default=SLOW_CONSUMER_HIGH_WATER / (1024 * 1024),
+                        help="bytes pendentes por conexao (MB) a partir dos quais a politica atua")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="diretorio do log de mensagens em disco (padrao: chat_data)")
+    parser.add_argument("--log-max-segments", type=int, default=LOG_MAX_SEGMENTS,
+                        help="segmentos de 64MB mantidos em disco por historico; os mais antigos "
+                             "(e seus anexos) sao apagados (0 = sem limite)")
+    parser.add_argument("--no-persist", action="store_true",
+                        help="mantem as mensagens apenas em memoria")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="porta HTTP local das metricas no formato Prometheus (0 desativa)")
+    parser.add_argument("--trace-sample", type=float, default=0.0,
+                        help="fracao das mensagens rastreadas por etapa (ex: 0.01 = 1%%; 0 desativa)")
+    parser.add_argument("--trace-file", default=TRACE_FILE,
+                        help="arquivo dos traces, no formato do chrome://tracing / Perfetto")
+    parser.add_argument("--profile", action="store_true",
+                        help="modo de perfil: amostragem de CPU e tracemalloc, com relatorios em --profile-dir")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR,
+                        help="diretorio dos relatorios de perfil (padrao: profiles)")
+    parser.add_argument("--profile-interval", type=float, default=PROFILE_DUMP_INTERVAL,
+                        help="segundos entre relatorios (tambem gravados com SIGUSR1 e ao encerrar)")
+    parser.add_argument("--profile-sample-ms", type=float, default=PROFILE_SAMPLE_INTERVAL * 1000,
+                        help="intervalo entre amostras de pilha, em ms")
+    parser.add_argument("--profile-memory-frames", type=int, default=PROFILE_MEMORY_FRAMES,
+                        help="quadros guardados por alocacao no tracemalloc (0 desativa a memoria)")
+    args = parser.parse_args()
+
     try:
-        start()
+        start(engine=args.engine, headless=args.headless,
+              log_target=args.log_target, log_file=args.log_file,
+              history_max_messages=args.history_max_messages,
+              history_max_bytes=int(args.history_max_mb * 1024 * 1024),
+              history_max_age=args.history_max_age,
+              slow_policy=args.slow_policy,
+              slow_high_water=int(args.slow_high_water_mb * 1024 * 1024),
+              data_dir=None if args.no_persist else args.data_dir,
+              log_max_segments=args.log_max_segments or None,
+              metrics_port=args.metrics_port,
+              trace_sample=args.trace_sample, trace_file=args.trace_file,
+              profile_dir=args.profile_dir if args.profile else None,
+              profile_sample_interval=args.profile_sample_ms / 1000,
+              profile_dump_interval=args.profile_interval,
+              profile_memory_frames=args.profile_memory_frames)
     except KeyboardInterrupt:
         print("\n[Servidor] Servidor encerrado pelo usuário.")
     except Exception as e:
         print(f"[Erro crítico] {e}")
     finally:
-        try:
-            server.close()
-        except:
-            pass
\ No newline at end of file
+        stop_server()
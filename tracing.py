@@ -0,0 +1,203 @@
+#tracing.py
+
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# RASTREAMENTO (TRACING) POR MENSAGEM, OPCIONAL E POR AMOSTRAGEM:
+#
+# Uma fracao das mensagens (sample_rate) e acompanhada do recebimento ate
+# a entrega: cada etapa vira um intervalo (span) com inicio e duracao.
+# Os spans sao exportados no formato de eventos do Chrome (Trace Event
+# Format, "traceEvents" com eventos "X"), que abre em chrome://tracing ou
+# https://ui.perfetto.dev. Spans da mesma mensagem ficam na mesma thread
+# e aparecem aninhados pelo tempo:
+#
+# message
+# ├── receive   bytes ja lidos do socket ate o inicio do processamento
+# ├── decode    json.loads
+# └── route     handle_message
+#     ├── store     historico (memoria + log em disco)
+#     ├── log       log do servidor (GUI/console/arquivo)
+#     └── fanout    entrega
+#         ├── send     um por destinatario (socket, motor "events")
+#         └── enqueue  um por destinatario (fila de saida, motor "threads")
+#
+# send (thread escritora)  envio real do lote com o frame no socket, motor
+#                          "threads": fica na linha da thread escritora, ligado
+#                          a mensagem pelo mesmo trace_id (ver add_span)
+#
+# A mensagem atual de cada thread fica em um threading.local, entao as
+# funcoes do servidor nao precisam receber o trace como parametro. Sem
+# amostragem (sample_rate=0) o custo e uma consulta ao threading.local.
+
+TRACE_MAX_EVENTS = 100000    # Eventos guardados em memoria (os mais antigos saem primeiro)
+TRACE_FLUSH_INTERVAL = 10.0  # Segundos entre cada gravacao do arquivo
+
+NULL_SPAN = contextlib.nullcontext()
+
+class _ThreadState(threading.local):
+    trace = None  # Valor padrao na classe: ler sem trace nao levanta AttributeError (caminho rapido)
+
+class Span:
+    """Intervalo de uma etapa: registrado no trace ao sair do bloco with"""
+    __slots__ = ("trace", "name", "args", "start")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.perf_counter(), **self.args)
+
+class MessageTrace:
+    """Spans de uma mensagem amostrada (usado apenas pela thread que a processa)"""
+    def __init__(self, trace_id, started):
+        self.trace_id = trace_id
+        self.started = started
+        self.args = {"trace_id": trace_id}  # Argumentos do span raiz ("message")
+        self.spans = []                     # [(nome, inicio, fim, argumentos), ...]
+
+    def add(self, name, start, end, **args):
+        self.spans.append((name, start, end, args))
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+class Tracer:
+    """
+    Amostragem e exportacao dos traces
+    - configure(sample_rate, path): 0 desativa; 0.01 = 1% das mensagens
+    - message(received_at): bloco with de uma mensagem; retorna o MessageTrace
+      se ela foi amostrada, senao None
+    - span(nome, **args): bloco with de uma etapa da mensagem atual da thread
+      (sem efeito se ela nao foi amostrada)
+    - current(): MessageTrace atual da thread ou None (para laços quentes)
+    - add_span(trace_id, nome, inicio, fim): span de uma mensagem medido em
+      outra thread, depois que o trace dela ja terminou (ex: thread escritora)
+    - flush(): grava o arquivo com os eventos em memoria (tambem feito
+      periodicamente e em close())
+    """
+    def __init__(self):
+        self.local = _ThreadState()
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=TRACE_MAX_EVENTS)
+        self.thread_names = {}
+        self.sample_rate = 0.0
+        self.path = None
+        self.origin = time.perf_counter()
+        self.next_id = 1
+        self.dirty = False
+        self.stop_event = threading.Event()
+        self.flusher = None
+
+    def configure(self, sample_rate, path, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.path = path
+        if self.sample_rate and flush_interval and self.flusher is None:
+            self.stop_event.clear()
+            self.flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+            self.flusher.start()
+
+    def current(self):
+        return self.local.trace
+
+    def span(self, name, **args):
+        trace = self.local.trace
+        if trace is None:
+            return NULL_SPAN
+        return trace.span(name, **args)
+
+    @contextlib.contextmanager
+    def _traced(self, trace):
+        self.local.trace = trace
+        try:
+            yield trace
+        finally:
+            self.local.trace = None
+            self._record(trace, time.perf_counter())
+
+    def message(self, received_at=None):
+        """
+        Inicia o trace de uma mensagem (se sorteada pela amostragem)
+        - received_at: instante (perf_counter) em que os bytes sairam do socket;
+          gera o span "receive" ate agora
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return NULL_SPAN
+        now = time.perf_counter()
+        with self.lock:
+            trace_id = self.next_id
+            self.next_id += 1
+        trace = MessageTrace(trace_id, received_at if received_at is not None else now)
+        if received_at is not None:
+            trace.add("receive", received_at, now)
+        return self._traced(trace)
+
+    def add_span(self, trace_id, name, start, end, **args):
+        args["trace_id"] = trace_id
+        thread = threading.current_thread()
+        event = self._event(name, start, end, os.getpid(), thread.ident, args)
+        with self.lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+            self.dirty = True
+
+    def _record(self, trace, ended):
+        """Converte os spans para eventos do Chrome e guarda no buffer"""
+        pid = os.getpid()
+        thread = threading.current_thread()
+        tid = thread.ident
+        events = [self._event("message", trace.started, ended, pid, tid, trace.args)]
+        for name, start, end, args in trace.spans:
+            args["trace_id"] = trace.trace_id
+            events.append(self._event(name, start, end, pid, tid, args))
+        with self.lock:
+            self.thread_names.setdefault(tid, thread.name)
+            self.events.extend(events)
+            self.dirty = True
+
+    def _event(self, name, start, end, pid, tid, args):
+        return {"name": name, "cat": "chat", "ph": "X", "pid": pid, "tid": tid,
+                "ts": round((start - self.origin) * 1e6, 3), "dur": round((end - start) * 1e6, 3),
+                "args": args}
+
+    def flush(self):
+        """Grava o arquivo de trace (substituicao atomica); retorna quantos eventos"""
+        with self.lock:
+            if not self.dirty or not self.path:
+                return 0
+            events = list(self.events)
+            names = dict(self.thread_names)
+            self.dirty = False
+        pid = os.getpid()
+        traced = {event["tid"] for event in events}
+        metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in names.items() if tid in traced]
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f, default=str)
+        os.replace(temporary, self.path)
+        return len(events)
+
+    def _flush_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def close(self):
+        """Para a gravacao periodica e grava o que estiver pendente"""
+        self.stop_event.set()
+        self.flusher = None
+        return self.flush()